@@ -3,6 +3,8 @@ import sys
 sys.path.insert(0, './')
 import txtai
 
+from src.data.features.VietnameseToneNormalization import normalize_texts
+
 from setup_db import \
     (setup_database, drop_tables, query, insert_data)
 
@@ -71,9 +73,10 @@ data = query("inference_pipeline/dbs/documents.db",
               query_string='''SELECT * FROM documents''',
               fetch_size=50000)
 # print(data)
+# Same normalization as insert_doc, so the index entries and the queries below match
 data_str = []
-for row in data:
-    data_str.append({"id": row[0], "text": row[1], "source": row[2]})
+for row, text in zip(data, normalize_texts([row[1] for row in data])):
+    data_str.append({"id": row[0], "text": text, "source": row[2]})
     # print({"id": row[0], "text": row[1], "source": row[2]})
 # embeddings_MiniLM = txtai.Embeddings(hybrid=True,
 #                                      content=True,
@@ -94,7 +97,7 @@ embeddings_mpnet = txtai.Embeddings()
 embeddings_mpnet.load("./inference_pipeline/embeddings_index/mpnet")
 
 # Run an embeddings search for each query
-for query_str in sample_queries:
+for query_str in normalize_texts(sample_queries):
     semantic_MiniLM = embeddings_MiniLM.search(query_str, 1)[0]
     uid_paraphrase, score_paraphrase = semantic_MiniLM['id'], semantic_MiniLM['score']
     semantic_mpnet = embeddings_mpnet.search(query_str, 1)[0]
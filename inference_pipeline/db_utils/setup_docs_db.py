@@ -1,5 +1,4 @@
 import os
-import re
 import sys
 from abc import abstractmethod
 
@@ -8,6 +7,7 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from datasets import load_dataset
 
 from src.utils import ForceBaseCallMeta, force_super_call
+from src.data.features.VietnameseToneNormalization import normalize_texts
 
 from setup_db import \
     (setup_database, drop_tables, query, insert_data)
@@ -19,9 +19,6 @@ def insert_doc(database_path: str,
                                     split="train")[:max_examples]
     print(f"Dataset length: {len(ctx_wiki_dataset)}\n")
 
-    def rm_underscore(data: str) -> str:
-        return re.sub('_', " ", data)
-
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=512,
         chunk_overlap=512 * 0.1,
@@ -31,7 +28,7 @@ def insert_doc(database_path: str,
         keep_separator=True
     )
     texts = text_splitter.create_documents(ctx_wiki_dataset['segmented_text'])
-    docs = [rm_underscore(text.page_content) for text in texts]
+    docs = normalize_texts([text.page_content for text in texts])
     data_to_insert = []
     for doc in docs:
         data_to_insert.append({"doc": doc, "source": "EddieChen372/vietnamese-wiki-segmented"})
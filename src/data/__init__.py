@@ -1 +1,9 @@
 from .dataloader import QADataloader, AdvanceQa
+from .example_arena import ExampleArena, TokenArena
+from .tokenized_dataset import TokenizedDataset
+from .tokenized_cache import TokenizedCache
+from .packing import PackedDataset, PackedCollator
+from .collators import CompletionOnlyCollator
+from .samplers import ResumableBatchSampler, ShuffledBatchSampler, LengthGroupedBatchSampler
+from .mixture import TokenMixture, TokenMixtureBatchSampler
+from .streaming import StreamingQa
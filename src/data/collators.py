@@ -0,0 +1,173 @@
+import sys
+from typing import List, Dict, Optional
+sys.path.insert(0, r'./')
+
+import numpy as np
+import torch
+
+from src.data.example_arena import TokenArena
+from src.data.packing import IGNORE_INDEX, find_last_subsequence
+
+
+def find_response_starts(token_arena: TokenArena, response_token_ids: List[int],
+                         pad_token_id: Optional[int] = None) -> np.ndarray:
+    """
+    Start of the last occurrence of the response template in every example of the arena (-1 if it has none),
+    searched over all the flat ids at once. Like DataCollatorForCompletionOnlyLM, which searches the labels,
+    a template containing the pad token never matches.
+    """
+    flat_token_ids = np.asarray(token_arena.ids, dtype=np.int32)
+    offsets = np.asarray(token_arena.offsets, dtype=np.int64)
+    response_starts = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    template_length = len(response_token_ids)
+    num_positions = len(flat_token_ids) - template_length + 1
+    if not template_length or num_positions <= 0 or pad_token_id in response_token_ids:
+        return response_starts
+
+    matches = np.ones(num_positions, dtype=bool)
+    for template_idx, token_id in enumerate(response_token_ids):
+        matches &= flat_token_ids[template_idx:template_idx + num_positions] == token_id
+    positions = np.flatnonzero(matches)
+    example_indices = np.searchsorted(offsets, positions, side='right') - 1
+    # Drop the matches running over the end of their example
+    inside = positions + template_length <= offsets[example_indices + 1]
+    positions, example_indices = positions[inside], example_indices[inside]
+    # The positions are sorted, the last one of each example is its last occurrence
+    last = np.append(example_indices[1:] != example_indices[:-1], True) if len(positions) else positions.astype(bool)
+    response_starts[example_indices[last]] = positions[last] - offsets[example_indices[last]]
+    return response_starts
+
+
+class CompletionOnlyCollator:
+    """
+    Drop-in for trl's DataCollatorForCompletionOnlyLM on the tokenized examples: pads the batch and trains only on
+    the tokens after the last response template of each example (nothing if it has none), the pad tokens ignored.
+    The template start comes with the example (response_start, found once at tokenization by find_response_starts)
+    and is otherwise searched here, the labels of the whole batch are then masked in one array op.
+    """
+    def __init__(self, response_token_ids: List[int], pad_token_id: int, padding_side: str = "right",
+                 ignore_index: int = IGNORE_INDEX) -> None:
+        self.response_token_ids = list(response_token_ids)
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.ignore_index = ignore_index
+
+    def response_start(self, token_ids: List[int]) -> int:
+        labels = [self.ignore_index if token_id == self.pad_token_id else token_id for token_id in token_ids]
+        response_start = find_last_subsequence(labels, self.response_token_ids)
+        return -1 if response_start is None else response_start
+
+    def __call__(self, examples: List[Dict]) -> Dict[str, torch.Tensor]:
+        lengths = np.fromiter((len(example["input_ids"]) for example in examples), dtype=np.int64, count=len(examples))
+        max_length = int(lengths.max())
+        pad_offsets = max_length - lengths if self.padding_side == "left" else np.zeros_like(lengths)
+        input_ids = np.full((len(examples), max_length), self.pad_token_id, dtype=np.int64)
+        for row_idx, example in enumerate(examples):
+            input_ids[row_idx, pad_offsets[row_idx]:pad_offsets[row_idx] + lengths[row_idx]] = example["input_ids"]
+        response_starts = np.fromiter((example["response_start"] if "response_start" in example
+                                       else self.response_start(example["input_ids"]) for example in examples),
+                                      dtype=np.int64, count=len(examples))
+
+        positions = np.arange(max_length)
+        attention_mask = (positions >= pad_offsets[:, None]) & (positions < (pad_offsets + lengths)[:, None])
+        response_ends = np.where(response_starts >= 0,
+                                 pad_offsets + response_starts + len(self.response_token_ids),
+                                 max_length)
+        labels = np.where((positions < response_ends[:, None]) | (input_ids == self.pad_token_id),
+                          self.ignore_index, input_ids)
+        return {"input_ids": torch.from_numpy(input_ids),
+                "attention_mask": torch.from_numpy(attention_mask.astype(np.int64)),
+                "labels": torch.from_numpy(labels)}
+
+
+if __name__ == "__main__":
+    import time
+    import random
+    from transformers import AutoTokenizer
+
+    from src.data.configs import AdvanceInstructSample
+
+    # Hand computed labels on raw ids, the response template is [7, 8] and 0 pads
+    response_token_ids, pad_token_id = [7, 8], 0
+    cases = [("template at the start", [7, 8, 3, 4, 5], 0, [-100, -100, 3, 4, 5]),
+             ("template in the middle", [1, 2, 7, 8, 3, 4], 2, [-100, -100, -100, -100, 3, 4]),
+             ("last of two templates", [7, 8, 1, 7, 8, 2], 3, [-100, -100, -100, -100, -100, 2]),
+             ("template missing", [1, 2, 3, 4], -1, [-100, -100, -100, -100]),
+             # Truncation cut the template after its first token, the next example starts with the rest of it
+             ("template split across truncation", [1, 2, 3, 7], -1, [-100, -100, -100, -100]),
+             ("template rest after truncation", [8, 5, 6], -1, [-100, -100, -100])]
+    token_arena = TokenArena()
+    token_arena.extend([token_ids for _, token_ids, _, _ in cases])
+    response_starts = find_response_starts(token_arena, response_token_ids, pad_token_id)
+    for (name, token_ids, response_start, _), found in zip(cases, response_starts):
+        assert found == response_start, (name, found)
+    assert (find_response_starts(token_arena, [3, 0], pad_token_id) == -1).all(), "A template with the pad token never matches"
+
+    max_length = max(len(token_ids) for _, token_ids, _, _ in cases)
+    def pad(values: List[int], value: int, padding_side: str) -> List[int]:
+        padding = [value] * (max_length - len(values))
+        return values + padding if padding_side == "right" else padding + values
+
+    for padding_side in ("right", "left"):
+        collator = CompletionOnlyCollator(response_token_ids, pad_token_id, padding_side=padding_side)
+        examples = [{"input_ids": token_ids} for _, token_ids, _, _ in cases]
+        for collated in (collator(examples), collator([dict(example, response_start=response_start) for example, response_start
+                                                       in zip(examples, response_starts)])):
+            for row_idx, (name, token_ids, _, labels) in enumerate(cases):
+                assert collated["input_ids"][row_idx].tolist() == pad(token_ids, pad_token_id, padding_side), (padding_side, name)
+                assert collated["attention_mask"][row_idx].tolist() == pad([1] * len(token_ids), 0, padding_side), (padding_side, name)
+                assert collated["labels"][row_idx].tolist() == pad(labels, -100, padding_side), (padding_side, name)
+    print(f"CompletionOnlyCollator matches the hand computed labels on {len(cases)} cases")
+
+    try:
+        from trl import DataCollatorForCompletionOnlyLM
+    except ImportError:
+        print("trl is not installed, skipping the equivalence with DataCollatorForCompletionOnlyLM")
+        sys.exit(0)
+
+    # Equivalence with trl on the instruct prompts, tokenized like the train and generative eval splits
+    tokenizer = AutoTokenizer.from_pretrained(sys.argv[1] if len(sys.argv) > 1 else "EleutherAI/gpt-neo-125m")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    response_template = " %%%%%%% Response:"
+    response_token_ids = tokenizer.encode(response_template, add_special_tokens=False)
+
+    random.seed(42)
+    words = "the a python model answer question context file list data train loop value".split()
+    sentence = lambda: " ".join(random.choices(words, k=random.randint(1, 20)))
+    texts = []
+    for _ in range(500):
+        # Some answers quote the template, the last occurrence starts the response
+        answer = sentence() + (response_template + " " + sentence() if random.random() < 0.1 else "")
+        example = AdvanceInstructSample(qas_id="0", system_prompt=sentence(), question_text=sentence(),
+                                        orig_answer_texts=answer)
+        texts.append(example.get_example(is_training=True, task_type="CAUSAL_LM")["prompt"] + f" {tokenizer.eos_token}")
+        texts.append(example.get_example(is_training=False, do_generative_eval=True, task_type="CAUSAL_LM")["prompt"])
+    # Without the template, and truncated through it
+    texts += [sentence() for _ in range(50)]
+    token_arena = TokenArena()
+    token_arena.extend(tokenizer(texts, truncation=True, max_length=256)["input_ids"])
+    response_starts = find_response_starts(token_arena, response_token_ids, tokenizer.pad_token_id)
+    examples = [{"input_ids": token_arena[idx], "attention_mask": [1] * len(token_arena[idx])} for idx in range(len(token_arena))]
+
+    for padding_side in ("right", "left"):
+        tokenizer.padding_side = padding_side
+        trl_collator = DataCollatorForCompletionOnlyLM(response_template, tokenizer=tokenizer, mlm=False)
+        collator = CompletionOnlyCollator(response_token_ids, tokenizer.pad_token_id, padding_side=padding_side)
+        for start in range(0, len(examples), 8):
+            batch = examples[start:start + 8]
+            with_starts = [dict(example, response_start=response_starts[start + idx]) for idx, example in enumerate(batch)]
+            expected = trl_collator(batch)
+            for collated in (collator(with_starts), collator(batch)):
+                for key in ("input_ids", "attention_mask", "labels"):
+                    assert torch.equal(collated[key], expected[key]), (padding_side, start, key)
+    print(f"CompletionOnlyCollator matches DataCollatorForCompletionOnlyLM on {len(examples)} examples")
+
+    tokenizer.padding_side = "right"
+    with_starts = [dict(example, response_start=response_starts[idx]) for idx, example in enumerate(examples)]
+    for name, collate in (("trl", DataCollatorForCompletionOnlyLM(response_template, tokenizer=tokenizer, mlm=False)),
+                          ("vectorized", CompletionOnlyCollator(response_token_ids, tokenizer.pad_token_id))):
+        start_time = time.perf_counter()
+        for start in range(0, len(with_starts), 8):
+            collate(with_starts[start:start + 8] if name == "vectorized" else examples[start:start + 8])
+        print(f"{name} collate: {(time.perf_counter() - start_time) / (len(examples) / 8) * 1000:.3f}ms per batch of 8")
@@ -8,6 +8,9 @@ from typing import List, Dict
 from dataclasses import dataclass, field, asdict, fields
 from .response_template import QA_TEMPLATE
 
+# Shared across examples, the templates are compiled once at import
+qa_template = QA_TEMPLATE()
+
 
 @dataclass
 class AdvanceQAExample:
@@ -80,18 +83,18 @@ class AdvanceQAExample:
                     targets_column: str="target") -> Dict:
         if is_training:
             straightened_docs = self.straighten_docs(self.doc_tokens)
-            prompt = QA_TEMPLATE().get_random_prompt(question=self.question_text,
-                                                             context=straightened_docs)
+            prompt = qa_template.get_random_prompt(question=self.question_text,
+                                                   context=straightened_docs)
             if not self.is_impossible:
                 if self.is_trivial and not self.doc_tokens:
-                    label = QA_TEMPLATE().get_random_trivial_response(question=self.question_text,
-                                                                              answer=self.orig_answer_texts)
+                    label = qa_template.get_random_trivial_response(question=self.question_text,
+                                                                    answer=self.orig_answer_texts)
                 elif self.doc_tokens:
-                    label = QA_TEMPLATE().get_random_norm_response(answer=self.orig_answer_texts)
+                    label = qa_template.get_random_norm_response(answer=self.orig_answer_texts)
                 else:
-                    label = QA_TEMPLATE().get_random_neg_response(question=self.question_text)
+                    label = qa_template.get_random_neg_response(question=self.question_text)
             else:
-                label = QA_TEMPLATE().get_random_neg_response(question=self.question_text)
+                label = qa_template.get_random_neg_response(question=self.question_text)
 
             return {inputs_column: prompt,
                     targets_column: label}
@@ -100,7 +103,7 @@ class AdvanceQAExample:
     def straighten_docs(docs_list: List[str]) -> str:
         ctxs = []
         if not docs_list:
-            return f"[ERROR]{QA_TEMPLATE().get_no_docs_msg(id=1)}[ERROR]"
+            return f"[ERROR]{qa_template.get_no_docs_msg(id=1)}[ERROR]"
         for idx, doc in enumerate(docs_list):
             ctxs.append(f" [CTX{idx}]: {doc} [ECTX{idx}] ")
         return "".join(ctxs)
@@ -1,3 +1,4 @@
+import re
 import random
 import sys
 import warnings
@@ -5,7 +6,7 @@ from functools import partialmethod
 from abc import ABC, abstractmethod
 sys.path.insert(0, r'./')
 
-from typing import List, Callable
+from typing import List, Dict, Tuple, Callable
 from dataclasses import dataclass
 
 from src.utils.utils import set_seed
@@ -286,9 +287,58 @@ NO_DOCS_MESSAGE1 = f" Không documents nào có điểm đủ cao để query ch
 NO_DOCS_MESSAGE2 = f" Database không chứa documents nào phù hợp cho câu hỏi. "
 
 
+TEMPLATE_TYPES = ("NO_ANS_RESPONSE", "TRIVIAL_ANS", "RESPONSE", "PROMPT_INPUT", "GENERIC_SYSTEM_PROMPT", "NO_DOCS_MESSAGE")
+TEMPLATE_FIELDS = {"[QUESTION]": "question", "[CONTEXT]": "context", "[ANSWER]": "answer"}
+TEMPLATE_FIELDS_PATTERN = re.compile("(" + "|".join(re.escape(placeholder) for placeholder in TEMPLATE_FIELDS) + ")")
+
+
+class CompiledTemplate:
+    """
+    A template pre-split on its placeholders: literals[0] field[0] literals[1] ... field[n-1] literals[n],
+    rendering is a single join instead of a replace/scan pass per placeholder.
+    """
+    __slots__ = ("template", "literals", "fields")
+
+    def __init__(self, template: str) -> None:
+        segments = TEMPLATE_FIELDS_PATTERN.split(template)
+        self.template = template
+        self.literals = tuple(segments[0::2])
+        self.fields = tuple(TEMPLATE_FIELDS[placeholder] for placeholder in segments[1::2])
+
+    def render(self, question: str = None, context: str = None, answer: str = None) -> str:
+        if not self.fields:
+            return self.template
+        values = {"question": question, "context": context, "answer": answer}
+        parts = [self.literals[0]]
+        missing_field = False
+        for field_name, literal in zip(self.fields, self.literals[1:]):
+            value = values[field_name]
+            if not value:
+                missing_field = True
+                value = f"[{field_name.upper()}]"
+            parts.append(value)
+            parts.append(literal)
+        if missing_field:
+            warnings.warn("Missing field(s) in template!")
+        return "".join(parts)
+
+
+def compile_templates(namespace: dict) -> Dict[str, Tuple[CompiledTemplate, ...]]:
+    # TYPE1, TYPE2, ... module constants become registry[TYPE] = (template of id 1, template of id 2, ...)
+    registry = {}
+    for template_type in TEMPLATE_TYPES:
+        templates = []
+        while f"{template_type}{len(templates) + 1}" in namespace:
+            templates.append(CompiledTemplate(namespace[f"{template_type}{len(templates) + 1}"]))
+        registry[template_type] = tuple(templates)
+    return registry
+
+
+TEMPLATE_REGISTRY = compile_templates(globals())
+
+
 @dataclass
 class TEMPLATE(ABC):
-    all_attr: dict = globals().items()
     max_template: int = 20
 
     def __post_init__(self):
@@ -298,11 +348,7 @@ class TEMPLATE(ABC):
     def get(self, id: int, type: str=None, **kwargs):
         assert id <= self.max_template, "Invalid template id"
         assert type is not None, "Please specified the type of template"
-        existed = False
-        for existed_type in dict(self.all_attr).keys():
-            if type in existed_type:
-                existed = True
-        assert existed, "The template type provided does not exist"
+        assert type in TEMPLATE_REGISTRY, "The template type provided does not exist"
         pass
 
     @classmethod
@@ -315,18 +361,33 @@ class QA_TEMPLATE(TEMPLATE):
     def get(self, id: int, type: str, question: str=None,
             context: str=None, answer: str=None):
         super(QA_TEMPLATE, self).get(id=id, type=type)
-        template = dict(super(QA_TEMPLATE, self).all_attr)[type+str(id)]
-
-        if question:
-            template = template.replace("[QUESTION]", question)
-        if context:
-            template = template.replace("[CONTEXT]", context)
-        if answer:
-            template = template.replace("[ANSWER]", answer)
-
-        if "[QUESTION]" in template or "[CONTEXT]" in template or "[ANSWER]" in template:
-            warnings.warn("Missing field(s) in template!")
-        return template
+        return TEMPLATE_REGISTRY[type][id - 1].render(question, context, answer)
+
+    def get_random(self, type: str, question: str=None,
+                   context: str=None, answer: str=None):
+        # A new template is drawn on every call
+        templates = TEMPLATE_REGISTRY[type]
+        return templates[random.randrange(len(templates))].render(question, context, answer)
+
+    @staticmethod
+    def render_many(type: str, questions: List[str]=None, contexts: List[str]=None,
+                    answers: List[str]=None, ids: List[int]=None) -> List[str]:
+        """
+        Render a whole batch of templates of one type, the fields are lists (or None) of the same length,
+        ids picks the template of each row (1-indexed), a random one is drawn per row when ids is None.
+        """
+        assert type in TEMPLATE_REGISTRY, "The template type provided does not exist"
+        templates = TEMPLATE_REGISTRY[type]
+        num_rows = len(next(values for values in (questions, contexts, answers, ids, [None]) if values is not None))
+        questions = questions if questions is not None else [None] * num_rows
+        contexts = contexts if contexts is not None else [None] * num_rows
+        answers = answers if answers is not None else [None] * num_rows
+        if ids is None:
+            template_indices = [random.randrange(len(templates)) for _ in range(num_rows)]
+        else:
+            template_indices = [id - 1 for id in ids]
+        return [templates[template_idx].render(question, context, answer)
+                for template_idx, question, context, answer in zip(template_indices, questions, contexts, answers)]
 
     get_generic_system_prompt = partialmethod(get, answer=None,
                                                    context=None,
@@ -338,11 +399,14 @@ class QA_TEMPLATE(TEMPLATE):
     get_norm_response = partialmethod(get, question=None, context=None, type="RESPONSE")
     get_no_docs_msg = partialmethod(get, question=None, context=None, answer=None, type="NO_DOCS_MESSAGE")
 
-    get_random_generic_system_prompt = partialmethod(get_generic_system_prompt, id=TEMPLATE.get_random_id)
-    get_random_prompt = partialmethod(get_prompt, id=TEMPLATE.get_random_id)
-    get_random_neg_response = partialmethod(get_neg_response, id=TEMPLATE.get_random_id)
-    get_random_trivial_response = partialmethod(get_trivial_response, id=TEMPLATE.get_random_id)
-    get_random_norm_response = partialmethod(get_norm_response, id=TEMPLATE.get_random_id)
+    get_random_generic_system_prompt = partialmethod(get_random, answer=None,
+                                                                 context=None,
+                                                                 question=None,
+                                                                 type="GENERIC_SYSTEM_PROMPT")
+    get_random_prompt = partialmethod(get_random, answer=None, type="PROMPT_INPUT")
+    get_random_neg_response = partialmethod(get_random, answer=None, context=None, type="NO_ANS_RESPONSE")
+    get_random_trivial_response = partialmethod(get_random, context=None, type="TRIVIAL_ANS")
+    get_random_norm_response = partialmethod(get_random, question=None, context=None, type="RESPONSE")
 
 
 if __name__ == "__main__":
@@ -409,3 +473,6 @@ if __name__ == "__main__":
 
     prompt = QA_TEMPLATE().get_random_generic_system_prompt()
     print(prompt)
+
+    prompts = QA_TEMPLATE.render_many("PROMPT_INPUT", questions=python_questions, contexts=python_question_contexts)
+    print(prompts[0])
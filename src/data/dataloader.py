@@ -2,28 +2,38 @@ import gc
 import os
 import math
 import random
+import tempfile
 import warnings
 import sys
-from itertools import chain
+from itertools import islice
 
 sys.path.insert(0, r'./')
 
 from tqdm.contrib import tzip
-from typing import Optional, List, Union, Set
+from typing import Optional, List, Union, Set, Dict, Iterator, Tuple
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 import torch
 import torch.distributed as dist
-from torch.utils.data import RandomSampler, SequentialSampler
+from torch.utils.data import SequentialSampler, IterableDataset
 from torch.utils.data.dataloader import DataLoader, Dataset
 
 from datasets import load_dataset
 from datasets import Dataset as hfDataset
 from transformers import AutoTokenizer, DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
-from trl import DataCollatorForCompletionOnlyLM
 
 from src.data.configs import AdvanceQAExample, AdvanceInstructSample
+from src.data.example_arena import ExampleArena, TokenArena
+from src.data.tokenized_dataset import TokenizedDataset, tokenize_chunks
+from src.data.packing import PackedDataset, PackedCollator
+from src.data.collators import CompletionOnlyCollator, find_response_starts
+from src.data.samplers import LengthGroupedBatchSampler, ShuffledBatchSampler
+from src.data.mixture import TokenMixtureBatchSampler, format_mixture_report
+from src.data.streaming import StreamingQa, iter_columnar_records
+from src.data.tokenized_cache import TokenizedCache, fingerprint_file, fingerprint_tokenizer, fingerprint_templates
 from src.utils import dist_print, in_notebook
 
 
@@ -42,7 +52,7 @@ class AdvanceQa(Dataset):
                  get_example: bool = True, split: str='train', num_examples: int = 100000,
                  do_perplexity_eval: bool = False, do_generative_eval: bool = False,
                  tokenizer: AutoTokenizer = None, max_seq_length: int = 1024,
-                 percentage_weights: List[int]=None):
+                 percentage_weights: List[int]=None, tokenize_batch_size: int = 1000):
         assert task_type, "Please specified task type"
 
         # Uniform weights for all files if percentage weights is None
@@ -50,9 +60,27 @@ class AdvanceQa(Dataset):
             percentage_weights = [math.floor(100/len(json_file_paths)) for _ in range(len(json_file_paths))]
 
         self.task_type = task_type
-        self.full_json_data = []
+        # Examples are kept in a compact columnar arena and materialized back into dicts on access
+        self.full_json_data = ExampleArena()
         self.config_type = config_type
         self.get_example = get_example
+        self.split = split
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        # Columns to check against max_seq_length, mapped to whether the eos token is appended like the
+        # training input is. They are tokenized once in batches and the ids are kept for QADataloader.preprocess_data
+        self.tokenized_columns = {}
+        if get_example and task_type == 'CAUSAL_LM':
+            # This check is for DataCollatorForCompletionOnlyLM
+            assert tokenizer is not None, "Please provide a tokenizer to check the length of CAUSAL_LM examples"
+            if split == 'train' or do_generative_eval:
+                self.tokenized_columns['prompt'] = split == 'train'
+            if do_perplexity_eval:
+                self.tokenized_columns['perplexity'] = True
+        self.token_ids = {column: TokenArena() for column in self.tokenized_columns}
+        # The examples of each file are contiguous, file i spans [source_offsets[i], source_offsets[i + 1])
+        self.source_offsets = [0]
+
         for json_path, percentage_weight in tzip(json_file_paths,
                                                  percentage_weights,
                                                  desc=f"Loading {split} data",
@@ -68,52 +96,94 @@ class AdvanceQa(Dataset):
             try:
                 file_name = os.path.basename(json_path)
                 extension = json_path.split(".")[-1]
+                # Compressed parser outputs (eg: OpenOrca.json.gz) are loaded by the builder of the inner extension
+                if extension in ("gz", "zst"):
+                    extension = json_path.split(".")[-2]
                 dist_print(f"Loading {num_examples_each_file} examples with percentage of {percentage_weight} from {file_name}...")
-                iterable_json_data = load_dataset(extension, data_files=json_path,
-                                                  streaming=True, keep_in_memory=False)
-                for idx, data in enumerate(iter(iterable_json_data['train'])):
-                    if idx > num_examples_each_file:
+                if extension in ("parquet", "arrow"):
+                    iterable_json_data = {'train': iter_columnar_records(json_path)}
+                else:
+                    iterable_json_data = load_dataset(extension, data_files=json_path,
+                                                      streaming=True, keep_in_memory=False)
+                json_data_iterator = iter(iterable_json_data['train'])
+                num_loaded, idx = 0, 0
+                # Skipped examples are replaced by the next ones in the file, a batch never reads more
+                # examples than what is still missing from the file's share
+                while num_loaded <= num_examples_each_file:
+                    batch = list(islice(json_data_iterator,
+                                        min(tokenize_batch_size, num_examples_each_file + 1 - num_loaded)))
+                    if not batch:
                         break
                     if get_example:
-                        try:
-                            config_data = self.config_type(**data).get_example(is_training=split == 'train',
-                                                                               task_type=self.task_type,
-                                                                               do_perplexity_eval=do_perplexity_eval,
-                                                                               do_generative_eval=do_generative_eval)
-                            # Check if config data exceeds maximum length or not,
-                            # This check is for DataCollatorForCompletionOnlyLM
-                            if task_type == 'CAUSAL_LM':
-                                if split == 'train' or do_generative_eval:
-                                    config_data_tokenzied = tokenizer(config_data['prompt'])
-                                    if len(config_data_tokenzied['input_ids']) > max_seq_length:
-                                        total_skipped += 1
-                                        loading_bar.desc = f"{loading_bar_desc} (Total skipped {total_skipped})"
-                                        num_examples_each_file += 1
-                                        del config_data_tokenzied
-                                        continue
-                                if do_perplexity_eval:
-                                    config_data_tokenzied = tokenizer(config_data['perplexity'])
-                                    if len(config_data_tokenzied['input_ids']) > max_seq_length:
-                                        total_skipped += 1
-                                        loading_bar.desc = f"{loading_bar_desc} (Total skipped {total_skipped})"
-                                        num_examples_each_file += 1
-                                        del config_data_tokenzied
-                                        continue
-                        except KeyError as e:
-                            raise f"Missing keys to fill for {config_data} in item {idx} in {file_name}" \
-                                  f"Error message: {e}"
-                    else:
-                        config_data = data
-                    self.full_json_data.append(config_data)
-                    loading_bar.update(1)
+                        batch = [self.build_example(data, idx + batch_idx, file_name,
+                                                    do_perplexity_eval=do_perplexity_eval,
+                                                    do_generative_eval=do_generative_eval)
+                                 for batch_idx, data in enumerate(batch)]
+                    idx += len(batch)
+                    batch_token_ids, keep_mask = self.tokenize_batch(batch)
+                    for batch_idx, config_data in enumerate(batch):
+                        if not keep_mask[batch_idx]:
+                            total_skipped += 1
+                            continue
+                        self.full_json_data.append(config_data)
+                        for column, token_arena in self.token_ids.items():
+                            token_arena.append(batch_token_ids[column][batch_idx])
+                        num_loaded += 1
+                    loading_bar.update(sum(keep_mask))
+                    if total_skipped:
+                        loading_bar.desc = f"{loading_bar_desc} (Total skipped {total_skipped})"
                 loading_bar.close()
+                self.source_offsets.append(len(self.full_json_data))
                 dist_print(f"\nFinished loading from {file_name} with total loaded {len(self.full_json_data)} examples\n"
                            f"\nTotal data skipped: {total_skipped}\n")
-                del iterable_json_data,
+                del iterable_json_data, json_data_iterator
                 gc.collect()
             except IOError as e:
                 raise f"An error occurred while reading the data: {e}"
 
+    def build_example(self, data: Dict, idx: int, file_name: str,
+                      do_perplexity_eval: bool = False, do_generative_eval: bool = False) -> Dict:
+        try:
+            config_data = self.config_type(**data).get_example(is_training=self.split == 'train',
+                                                               task_type=self.task_type,
+                                                               do_perplexity_eval=do_perplexity_eval,
+                                                               do_generative_eval=do_generative_eval)
+        except KeyError as e:
+            raise f"Missing keys to fill for {data} in item {idx} in {file_name}" \
+                  f"Error message: {e}"
+        return config_data
+
+    def tokenize_batch(self, examples: List[Dict]) -> Tuple[Dict[str, List[Optional[List[int]]]], List[bool]]:
+        """
+        Tokenize the checked columns of a batch of examples in a single (fast) tokenizer call per column
+        and mark the examples longer than max_seq_length, a column is only tokenized for the examples kept so far.
+        """
+        keep_mask = [True] * len(examples)
+        batch_token_ids = {}
+        for column, add_eos in self.tokenized_columns.items():
+            kept_indices = [example_idx for example_idx, keep in enumerate(keep_mask) if keep]
+            eos_suffix = f" {self.tokenizer.eos_token}" if add_eos else ""
+            input_ids = self.tokenizer([examples[example_idx][column] + eos_suffix for example_idx in kept_indices],
+                                       return_attention_mask=False)['input_ids'] if kept_indices else []
+            column_token_ids = [None] * len(examples)
+            for example_idx, token_ids in zip(kept_indices, input_ids):
+                if len(token_ids) > self.max_seq_length:
+                    keep_mask[example_idx] = False
+                else:
+                    column_token_ids[example_idx] = token_ids
+            batch_token_ids[column] = column_token_ids
+
+        return batch_token_ids, keep_mask
+
+    @property
+    def source_ids(self) -> np.ndarray:
+        """Index of the file of every example"""
+        return np.repeat(np.arange(len(self.source_offsets) - 1), np.diff(self.source_offsets))
+
+    def has_token_ids(self, column: str, add_eos: bool) -> bool:
+        """Whether the ids of `column` were kept while loading, for the same input text (with or without eos)"""
+        return column in self.token_ids and self.tokenized_columns[column] == add_eos
+
     def __len__(self) -> int:
         return len(self.full_json_data)
 
@@ -157,13 +227,27 @@ class QADataloader:
                  block_size: int=768,
                  model_max_length: int=1024,
                  context_length: int=768,
-                 num_worker: int = 1,
+                 num_worker: int = 0,
+                 tokenize_num_proc: int = 1,
+                 prefetch_factor: int = 2,
+                 persistent_workers: bool = True,
+                 tokenize_batch_size: int = 1000,
                  seed: int = 42,
                  use_fast_tokenizer: bool=True,
+                 tokenized_cache_dir: Optional[str]=None,
+                 cache_wait_timeout: int=4 * 3600,
                  no_preprocess_data: bool=False,
                  do_perplexity_eval: bool=False,
                  do_generative_eval: bool=False,
                  do_group_texts: bool=False,
+                 do_packing: bool=False,
+                 group_by_length: bool=False,
+                 streaming: bool=False,
+                 shuffle_buffer_size: int=10000,
+                 length_grouping_mega_batch_mult: int=50,
+                 token_mixture: bool=False,
+                 mixture_temperature: float=1.0,
+                 mixture_epoch_weights: List[List[float]]=None,
                  response_template: str=" %%%%%%% Response:",
                  add_tokens_list: List[str]=None,
                  max_train_samples: Optional[int] = None,
@@ -172,6 +256,7 @@ class QADataloader:
                  config_type: Union[AdvanceQAExample, AdvanceInstructSample] = AdvanceQAExample
                  ) -> None:
 
+        self.model_name = model_name
         self.model_max_length = model_max_length
         self.tokenizer = AutoTokenizer.from_pretrained(model_name,
                                                        use_fast=use_fast_tokenizer,
@@ -195,20 +280,53 @@ class QADataloader:
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         global rank
+        # The process group is usually not initialized yet when the dataloader is built under accelerate launch,
+        # the launcher environment variables are used then
         if dist.is_initialized():
             rank = dist.get_rank()
         else:
-            rank = 0
+            rank = int(os.environ.get("RANK", 0))
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        self.world_size = dist.get_world_size() if dist.is_initialized() else int(os.environ.get("WORLD_SIZE", 1))
 
         self.text_column = text_column
         self.response_template = response_template
+        # Tokenized the way DataCollatorForCompletionOnlyLM does
+        self.response_token_ids = self.tokenizer.encode(self.response_template, add_special_tokens=False)
         self.target_column = target_column
         self.config_type = config_type
         self.task_type= task_type
         self.block_size = block_size
         self.context_length = context_length
         self.no_preprocess_data = no_preprocess_data
+        # Tokenized splits are cached there and memory mapped back by the next runs with the same data and settings
+        self.tokenized_cache_dir = tokenized_cache_dir
+        self.cache_wait_timeout = cache_wait_timeout
+        if self.world_size > 1 and not self.tokenized_cache_dir and not no_preprocess_data:
+            # The processes of a node share the tokenized data through the cache
+            self.tokenized_cache_dir = os.path.join(tempfile.gettempdir(), "qa_dataloader_cache")
+            dist_print(f"Distributed run without tokenized_cache_dir, caching the tokenized data in {self.tokenized_cache_dir}")
         self.do_group_texts = do_group_texts
+        # Bin pack the train examples into block_size rows, each example keeps its own positions and labels and only
+        # attends to itself through a 4D block diagonal mask (the trainer checks the model takes it)
+        assert not (do_packing and do_group_texts), "Please choose either packing or grouping texts"
+        assert not do_packing or task_type == "CAUSAL_LM", "Packing is only supported for CAUSAL_LM"
+        self.do_packing = do_packing
+        # Train and perplexity eval batches are grouped by token length to cut the padding
+        self.group_by_length = group_by_length
+        self.length_grouping_mega_batch_mult = length_grouping_mega_batch_mult
+        # Stream the train files instead of loading them (CAUSAL_LM), packing and caching do not apply then
+        assert not streaming or task_type == "CAUSAL_LM", "Streaming is only supported for CAUSAL_LM"
+        assert not (streaming and no_preprocess_data), "Streaming always tokenizes the data, please disable no_preprocess_data"
+        self.streaming = streaming
+        self.shuffle_buffer_size = shuffle_buffer_size
+        # Mix the train files by token share (each_train_file_percentage, the token count of each file by default)
+        # instead of by example count
+        assert not token_mixture or not (group_by_length or do_packing or do_group_texts or no_preprocess_data), \
+            "The token mixture draws the train batches itself, please disable length grouping, packing and grouping texts"
+        self.token_mixture = token_mixture
+        self.mixture_temperature = mixture_temperature
+        self.mixture_epoch_weights = mixture_epoch_weights
         self.do_perplexity_eval = do_perplexity_eval
         self.do_generative_eval = do_generative_eval
         if no_preprocess_data:
@@ -225,7 +343,14 @@ class QADataloader:
         self.test_batch_size = test_batch_size
 
         self.seed = seed
+        # DataLoader workers collate (and tokenize when streaming) ahead of the training step, prefetch_factor
+        # batches each, num_worker=0 collates in the training process
         self.num_worker = num_worker
+        # Processes tokenizing the loaded splits, unrelated to the DataLoader workers
+        self.tokenize_num_proc = tokenize_num_proc
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.tokenize_batch_size = tokenize_batch_size
         self.generator = torch.Generator()
         self.generator.manual_seed(self.seed)
 
@@ -268,50 +393,101 @@ class QADataloader:
         self.dataset = {}
         if self.train_file is not None:
             dist_print('\nLoading train datasets' + '.' * 10)
-            train_dataset = self.load_data(self.train_file, self.max_train_samples, split='train')
-            dataloaders['train'] = self.get_dataloader(train_dataset if self.no_preprocess_data else self.preprocess_data(train_dataset, split='train'),
+            train_cache = self.get_split_cache('train', self.train_file, self.max_train_samples)
+            if self.streaming:
+                # Prompts are built and tokenized on the fly by the DataLoader workers
+                train_dataset = StreamingQa(json_file_paths=self.train_file,
+                                            task_type=self.task_type,
+                                            tokenizer=self.tokenizer,
+                                            config_type=self.config_type,
+                                            num_examples=self.max_train_samples,
+                                            percentage_weights=self.each_train_file_percentage,
+                                            max_seq_length=self.model_max_length,
+                                            text_column=self.text_column,
+                                            shuffle_buffer_size=self.shuffle_buffer_size,
+                                            seed=self.seed,
+                                            token_mixture=self.token_mixture,
+                                            mixture_temperature=self.mixture_temperature,
+                                            mixture_epoch_weights=self.mixture_epoch_weights)
+                train_inputs = {'train': train_dataset}
+            elif self.wait_for_cache(train_cache):
+                dist_print(f"Loading the tokenized train split from the cache {train_cache.path}")
+                train_inputs, _ = train_cache.load()
+                train_dataset = train_inputs['train']
+            else:
+                train_dataset = self.load_data(self.train_file, self.max_train_samples, split='train')
+                train_inputs = {'train': train_dataset if self.no_preprocess_data else self.preprocess_data(train_dataset, split='train')}
+                if train_cache is not None and self.local_rank == 0:
+                    train_cache.save(train_inputs)
+            if self.do_packing and not self.no_preprocess_data and not self.streaming:
+                train_inputs['train'] = self.pack_data(train_inputs['train'])
+            dataloaders['train'] = self.get_dataloader(train_inputs['train'],
                                                        shuffle_flag=True,
-                                                       batch_size=self.train_batch_size)
+                                                       batch_size=self.train_batch_size,
+                                                       group_by_length=self.group_by_length)
             self.dataset['train'] = train_dataset
 
         if self.val_file is not None:
             dataloaders['eval'] = {}
             dist_print('\nLoading validation datasets' + '.' * 10)
-            eval_dataset = self.load_data(self.val_file,
-                                          self.max_eval_samples,
-                                          split='eval',
-                                          do_perplexity_eval=self.do_perplexity_eval,
-                                          do_generative_eval=self.do_generative_eval)
-            if self.do_generative_eval or self.task_type == "SEQ_2_SEQ_LM":
-                # eval_dataset_input = random.sample(list(eval_dataset), min(self.max_eval_generative_samples, len(eval_dataset)))
-                eval_dataset_input = eval_dataset[:self.max_eval_generative_samples]
-                eval_dataset_input = eval_dataset_input if self.no_preprocess_data else self.preprocess_data(eval_dataset_input)
-                dataloaders['eval']['generative_eval'] = self.get_dataloader(eval_dataset_input,
+            eval_cache = self.get_split_cache('eval', self.val_file, self.max_eval_samples)
+            if self.wait_for_cache(eval_cache):
+                dist_print(f"Loading the tokenized eval split from the cache {eval_cache.path}")
+                eval_inputs, eval_dataset = eval_cache.load()
+            else:
+                eval_dataset = self.load_data(self.val_file,
+                                              self.max_eval_samples,
+                                              split='eval',
+                                              do_perplexity_eval=self.do_perplexity_eval,
+                                              do_generative_eval=self.do_generative_eval)
+                eval_inputs = {}
+                if self.do_generative_eval or self.task_type == "SEQ_2_SEQ_LM":
+                    # eval_dataset_input = random.sample(list(eval_dataset), min(self.max_eval_generative_samples, len(eval_dataset)))
+                    eval_inputs['generative_eval'] = eval_dataset[:self.max_eval_generative_samples] if self.no_preprocess_data \
+                        else self.preprocess_data(eval_dataset, num_examples=self.max_eval_generative_samples)
+                if self.do_perplexity_eval and not self.task_type == "SEQ_2_SEQ_LM":
+                    eval_inputs['perplexity_eval'] = eval_dataset[:self.max_eval_perplexity_samples] if self.no_preprocess_data \
+                        else self.preprocess_data(eval_dataset,
+                                                  perplexity_eval=self.do_perplexity_eval,
+                                                  num_examples=self.max_eval_perplexity_samples)
+                # The eval examples are cached too, the trainer prints their questions and labels
+                if eval_cache is not None and self.local_rank == 0:
+                    eval_cache.save(eval_inputs, examples=eval_dataset.full_json_data)
+            if 'generative_eval' in eval_inputs:
+                dataloaders['eval']['generative_eval'] = self.get_dataloader(eval_inputs['generative_eval'],
                                                                              batch_size=self.generative_eval_batch_size)
-            if self.do_perplexity_eval and not self.task_type == "SEQ_2_SEQ_LM":
-                eval_dataset_input = eval_dataset[:self.max_eval_perplexity_samples]
-                eval_dataset_input = eval_dataset_input if self.no_preprocess_data else self.preprocess_data(eval_dataset_input,
-                                                                                        perplexity_eval=self.do_perplexity_eval)
-                dataloaders['eval']['perplexity_eval'] = self.get_dataloader(eval_dataset_input,
-                                                                             batch_size=self.perplexity_eval_batch_size)
+            if 'perplexity_eval' in eval_inputs:
+                dataloaders['eval']['perplexity_eval'] = self.get_dataloader(eval_inputs['perplexity_eval'],
+                                                                             batch_size=self.perplexity_eval_batch_size,
+                                                                             group_by_length=self.group_by_length)
             self.dataset['eval'] = eval_dataset
 
         if self.test_file is not None:
             dataloaders['test'] = {}
             dist_print('\nLoading test datasets' + '.' * 10)
-            test_dataset = self.load_data(self.test_file,
-                                          self.max_predict_samples,
-                                          split='test',
-                                          do_perplexity_eval=self.do_perplexity_eval,
-                                          do_generative_eval=self.do_generative_eval)
-
-            if self.do_generative_eval or self.task_type == "SEQ_2_SEQ_LM":
-                dataloaders['test']['generative_eval'] = self.get_dataloader(test_dataset if self.no_preprocess_data else self.preprocess_data(test_dataset),
-                                                          batch_size=self.test_batch_size)
-            if self.do_perplexity_eval and not self.task_type == "SEQ_2_SEQ_LM":
-                dataloaders['test']['perplexity_eval'] = self.get_dataloader(test_dataset if self.no_preprocess_data else self.preprocess_data(test_dataset,
-                                                                                                                                       perplexity_eval=self.do_perplexity_eval),
-                                                                     batch_size=self.test_batch_size)
+            test_cache = self.get_split_cache('test', self.test_file, self.max_predict_samples)
+            if self.wait_for_cache(test_cache):
+                dist_print(f"Loading the tokenized test split from the cache {test_cache.path}")
+                test_inputs, test_dataset = test_cache.load()
+            else:
+                test_dataset = self.load_data(self.test_file,
+                                              self.max_predict_samples,
+                                              split='test',
+                                              do_perplexity_eval=self.do_perplexity_eval,
+                                              do_generative_eval=self.do_generative_eval)
+                test_inputs = {}
+                if self.do_generative_eval or self.task_type == "SEQ_2_SEQ_LM":
+                    test_inputs['generative_eval'] = test_dataset if self.no_preprocess_data else self.preprocess_data(test_dataset)
+                if self.do_perplexity_eval and not self.task_type == "SEQ_2_SEQ_LM":
+                    test_inputs['perplexity_eval'] = test_dataset if self.no_preprocess_data else self.preprocess_data(test_dataset,
+                                                                                                                       perplexity_eval=self.do_perplexity_eval)
+                if test_cache is not None and self.local_rank == 0:
+                    test_cache.save(test_inputs, examples=test_dataset.full_json_data)
+            for eval_type, test_input in test_inputs.items():
+                # The generative eval keeps the dataset order, its predictions are matched back to the examples by index
+                dataloaders['test'][eval_type] = self.get_dataloader(test_input, batch_size=self.test_batch_size,
+                                                                     group_by_length=self.group_by_length and
+                                                                                     eval_type == 'perplexity_eval')
 
             self.dataset['test'] = test_dataset
 
@@ -319,6 +495,47 @@ class QADataloader:
 
         return dataloaders
 
+    def wait_for_cache(self, cache: Optional[TokenizedCache]) -> bool:
+        """
+        Whether the split can be loaded from the cache. In distributed runs only the local main process of each
+        node loads and tokenizes a split, the other processes wait for its cache and memory map it, so the
+        loading work and the memory of the tokenized data are not replicated per process.
+        """
+        if cache is None:
+            return False
+        if not cache.exists() and self.local_rank != 0:
+            print(f"Process {rank} is waiting for the local main process to cache the tokenized data in {cache.path}")
+            cache.wait(timeout=self.cache_wait_timeout)
+        return cache.exists()
+
+    def get_split_cache(self, split: str, data_files: Union[str, List[str]], num_examples: int) -> Optional[TokenizedCache]:
+        """The tokenized cache entry of a split, None when caching is disabled or the data is not preprocessed"""
+        if not self.tokenized_cache_dir or self.no_preprocess_data or (self.streaming and split == 'train'):
+            return None
+        data_files = [data_files] if isinstance(data_files, str) else data_files
+        return TokenizedCache(self.tokenized_cache_dir,
+                              {"split": split,
+                               "files": [fingerprint_file(data_file) for data_file in data_files],
+                               "each_train_file_percentage": self.each_train_file_percentage if split == 'train' else None,
+                               "num_examples": num_examples,
+                               "max_eval_generative_samples": self.max_eval_generative_samples if split == 'eval' else None,
+                               "max_eval_perplexity_samples": self.max_eval_perplexity_samples if split == 'eval' else None,
+                               "do_perplexity_eval": self.do_perplexity_eval,
+                               "do_generative_eval": self.do_generative_eval,
+                               "tokenizer": fingerprint_tokenizer(self.tokenizer, self.model_name),
+                               "model_max_length": self.model_max_length,
+                               "context_length": self.context_length,
+                               "block_size": self.block_size,
+                               "do_group_texts": self.do_group_texts,
+                               "task_type": self.task_type,
+                               "text_column": self.text_column,
+                               "target_column": self.target_column,
+                               "config_type": self.config_type.__name__,
+                               "templates": fingerprint_templates(),
+                               # The prompt templates are drawn with the seed, the response starts are cached
+                               "seed": self.seed,
+                               "response_token_ids": self.response_token_ids})
+
     def load_data(self, data_files: List[str], num_example: int=100000,
                   split: str='train', get_example: bool=True,
                   do_perplexity_eval: bool=False, do_generative_eval: bool=False) -> AdvanceQa:
@@ -344,6 +561,7 @@ class QADataloader:
                             do_generative_eval= do_generative_eval,
                             tokenizer=self.tokenizer,
                             max_seq_length=self.model_max_length,
+                            tokenize_batch_size=self.tokenize_batch_size,
                             )
 
         # Log a few random samples from the training set:
@@ -352,17 +570,97 @@ class QADataloader:
 
         return dataset
 
-    def preprocess_data(self, dataset, split=None, perplexity_eval: bool=False):
-        tokenized_dataset = list(map(lambda data: self.tokenize_function(data, split, perplexity_eval), dataset))
+    def preprocess_data(self, dataset, split=None, perplexity_eval: bool=False,
+                        num_examples: Optional[int]=None) -> TokenizedDataset:
+        """
+        Tokenize the first num_examples (all if None) examples of the dataset into a TokenizedDataset.
+        The ids kept by AdvanceQa while loading are reused when they were computed for the same input text,
+        the other examples are tokenized in batches of tokenize_batch_size, over tokenize_num_proc processes if > 1.
+        """
+        num_examples = len(dataset) if num_examples is None else min(num_examples, len(dataset))
+        max_length = self.model_max_length if split == "train" or perplexity_eval else self.context_length
+        fields = ("input_ids", "labels") if self.task_type == "SEQ_2_SEQ_LM" else ("input_ids",)
+        # The SEQ_2_SEQ_LM encodings have no special_tokens_mask, DataCollatorForSeq2Seq would pass it to the model
+        tokenized_dataset = TokenizedDataset(fields, *self.special_tokens_span(),
+                                             return_special_tokens_mask=self.task_type == "CAUSAL_LM")
+
+        input_column = "perplexity" if perplexity_eval else self.text_column
+        if self.task_type == "CAUSAL_LM" and isinstance(dataset, AdvanceQa) and \
+                dataset.has_token_ids(input_column, add_eos=perplexity_eval or split == 'train'):
+            self.reuse_token_ids(dataset, input_column, num_examples, max_length,
+                                 tokenized_dataset.input_ids, split, perplexity_eval)
+        else:
+            input_chunks = ([self.get_input_text(dataset[idx], split, perplexity_eval)
+                             for idx in range(start, min(start + self.tokenize_batch_size, num_examples))]
+                            for start in range(0, num_examples, self.tokenize_batch_size))
+            for flat_token_ids, lengths in tqdm(tokenize_chunks(input_chunks, max_length, self.tokenizer,
+                                                                num_proc=self.tokenize_num_proc),
+                                                total=math.ceil(num_examples / self.tokenize_batch_size),
+                                                desc=f"Tokenizing {split if split else 'eval'} data",
+                                                disable=rank != 0):
+                tokenized_dataset.input_ids.extend_flat(flat_token_ids, lengths)
+
+        if self.task_type == "SEQ_2_SEQ_LM":
+            target_chunks = ([dataset[idx][self.target_column]
+                              for idx in range(start, min(start + self.tokenize_batch_size, num_examples))]
+                             for start in range(0, num_examples, self.tokenize_batch_size))
+            for flat_token_ids, lengths in tokenize_chunks(target_chunks,
+                                                           self.model_max_length if split == "train" else self.context_length,
+                                                           self.tokenizer, num_proc=self.tokenize_num_proc):
+                tokenized_dataset.columns["labels"].extend_flat(flat_token_ids, lengths)
 
         if self.task_type == "CAUSAL_LM" and self.do_group_texts:
-            return tokenized_dataset.map(self.group_texts,
-                                         desc=f"Grouping texts in chunks of {self.block_size}",
-                                         batched=False,
-                                         num_proc=1)
+            dist_print(f"Grouping texts in chunks of {self.block_size}")
+            return self.group_texts(tokenized_dataset)
+
+        if split == 'train' and isinstance(dataset, AdvanceQa):
+            tokenized_dataset.source_ids = dataset.source_ids[:num_examples]
+
+        if self.task_type == "CAUSAL_LM":
+            # The template is known, find it once here instead of in every collate
+            tokenized_dataset.response_starts = find_response_starts(tokenized_dataset.input_ids,
+                                                                     self.response_token_ids,
+                                                                     self.tokenizer.pad_token_id)
 
         return tokenized_dataset
 
+    def reuse_token_ids(self, dataset: AdvanceQa, input_column: str, num_examples: int, max_length: int,
+                        token_arena: TokenArena, split: str=None, perplexity_eval: bool=False) -> None:
+        """Copy the ids kept while loading into token_arena, the examples longer than max_length are tokenized again"""
+        loaded_token_ids = dataset.token_ids[input_column]
+        flat_token_ids = np.frombuffer(loaded_token_ids.ids, dtype=np.int32)
+        offsets = np.frombuffer(loaded_token_ids.offsets, dtype=np.int64)
+        lengths = np.diff(offsets[:num_examples + 1])
+        for start in range(0, num_examples, self.tokenize_batch_size):
+            end = min(start + self.tokenize_batch_size, num_examples)
+            truncated_indices = np.flatnonzero(lengths[start:end] > max_length) + start
+            if not len(truncated_indices):
+                token_arena.extend_flat(flat_token_ids[offsets[start]:offsets[end]], lengths[start:end])
+                continue
+            # Let the tokenizer truncate, it keeps the room for the special tokens
+            chunk_token_ids = [loaded_token_ids[idx] for idx in range(start, end)]
+            truncated_texts = [self.get_input_text(dataset[idx], split, perplexity_eval) for idx in truncated_indices]
+            truncated_token_ids = self.tokenizer(truncated_texts,
+                                                 truncation="longest_first",
+                                                 max_length=max_length,
+                                                 return_attention_mask=False)["input_ids"]
+            for idx, token_ids in zip(truncated_indices, truncated_token_ids):
+                chunk_token_ids[idx - start] = token_ids
+            token_arena.extend(chunk_token_ids)
+
+    def special_tokens_span(self) -> Tuple[int, int]:
+        """Number of special tokens the tokenizer adds before and after a text"""
+        probe_mask = self.tokenizer("a", return_special_tokens_mask=True)["special_tokens_mask"]
+        return probe_mask.index(0), probe_mask[::-1].index(0)
+
+    def get_input_text(self, data: Dict, split: str=None, perplexity_eval: bool=False) -> str:
+        if self.task_type == "CAUSAL_LM":
+            if perplexity_eval:
+                return data["perplexity"] + f" {self.tokenizer.eos_token}"
+            elif split == 'train':
+                return data[self.text_column] + f" {self.tokenizer.eos_token}"
+        return data[self.text_column]
+
     def dynamic_collate(self, batch):
         """
         A collate function that tokenizes the inputs and targets, and applies dynamic padding and truncation
@@ -421,15 +719,7 @@ class QADataloader:
         #     warnings.warn(f"Cannot do perplexity eval on {self.task_type}")
         #     pass
 
-        if self.task_type == "CAUSAL_LM":
-            if perplexity_eval:
-                inputs = data["perplexity"] + f" {self.tokenizer.eos_token}"
-            elif split == 'train':
-                inputs = data[self.text_column] + f" {self.tokenizer.eos_token}"
-            else:
-                inputs = data[self.text_column]
-        else:
-            inputs = data[self.text_column]
+        inputs = self.get_input_text(data, split, perplexity_eval)
 
         inp_tokens = self.tokenizer(
             inputs,
@@ -451,13 +741,10 @@ class QADataloader:
                 return_special_tokens_mask=True,
                 max_length=self.model_max_length if split == "train" else self.context_length
             )
-            target_ids = tgt_tokens["input_ids"]
-            target_mask = tgt_tokens["attention_mask"].bool()
-            target_ids = target_ids.masked_fill(~target_mask, -100)
-
+            # Nothing is padded here, DataCollatorForSeq2Seq pads the labels with -100
             return {"input_ids": inp_tokens["input_ids"],
                     "attention_mask": inp_tokens["attention_mask"],
-                    "labels": target_ids}
+                    "labels": tgt_tokens["input_ids"]}
 
         elif self.task_type == "CAUSAL_LM":
             return inp_tokens
@@ -465,20 +752,29 @@ class QADataloader:
             raise f"Unsupported task type for {self.task_type}"
 
     # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
-    def group_texts(self, examples):
+    def group_texts(self, tokenized_dataset: TokenizedDataset) -> TokenizedDataset:
         # Concatenate all texts.
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
+        concatenated_ids = np.asarray(tokenized_dataset.input_ids.ids, dtype=np.int32)
         # We drop the small remainder, and if the total_length < block_size  we exclude this batch and return an empty dict.
         # We could add padding if the model supported it instead of this drop, you can customize this part to your needs.
-        total_length = (total_length // self.block_size) * self.block_size
-        # Split by chunks of max_len.
-        result = {
-            k: [t[i : i + self.block_size] for i in range(0, total_length, self.block_size)]
-            for k, t in concatenated_examples.items()
-        }
-        result["labels"] = result["input_ids"].copy()
-        return result
+        total_length = (len(concatenated_ids) // self.block_size) * self.block_size
+        # Split by chunks of max_len, the labels are the input ids (DataCollatorForLanguageModeling)
+        grouped_dataset = TokenizedDataset(("input_ids",), return_special_tokens_mask=False)
+        grouped_dataset.input_ids.extend_flat(concatenated_ids[:total_length],
+                                              np.full(total_length // self.block_size, self.block_size, dtype=np.int64))
+        return grouped_dataset
+
+    def pack_data(self, tokenized_dataset: TokenizedDataset) -> PackedDataset:
+        """Pack the tokenized examples into rows of block_size tokens with completion-only labels per example"""
+        packed_dataset = PackedDataset(tokenized_dataset,
+                                       block_size=self.block_size,
+                                       response_token_ids=self.response_token_ids,
+                                       pad_token_id=self.tokenizer.pad_token_id)
+        report = packed_dataset.efficiency_report()
+        dist_print(f"\nPacked {report['num_examples']} examples into {report['num_rows']} rows of {self.block_size} tokens "
+                   f"({report['examples_per_row']:.2f} examples per row), token efficiency "
+                   f"{report['packed_efficiency']:.2%} against {report['unpacked_efficiency']:.2%} unpacked\n")
+        return packed_dataset
 
     @staticmethod
     def seed_worker(worker_id):
@@ -486,28 +782,71 @@ class QADataloader:
         np.random.seed(worker_seed)
         random.seed(worker_seed)
 
-    def get_dataloader(self, dataset, shuffle_flag: bool = False, batch_size: int=1) -> DataLoader:
+    def worker_kwargs(self) -> Dict:
+        if self.num_worker <= 0:
+            return {"num_workers": 0}
+        return {"num_workers": self.num_worker,
+                "prefetch_factor": self.prefetch_factor,
+                "persistent_workers": self.persistent_workers}
+
+    def get_dataloader(self, dataset, shuffle_flag: bool = False, batch_size: int=1,
+                       group_by_length: bool = False) -> DataLoader:
         """
         :param dataset: (Dataset): dataset from which to load the data.
         :param shuffle_flag: set to ``True`` to have the data reshuffled
                 at every epoch (default: ``False``).
         :batch_size: The batch size of the dataset
+        :group_by_length: batch examples of similar token length together (tokenized or packed datasets only)
         :return: a dataloder object
 
         Args:
             batch_size:
 
         """
-        sampler = RandomSampler(data_source=dataset,
-                                generator=self.generator) if shuffle_flag else SequentialSampler(dataset)
+        batch_sampler = None
+        if group_by_length and not isinstance(dataset, IterableDataset):
+            if isinstance(dataset, PackedDataset):
+                lengths = dataset.row_lengths
+            elif isinstance(dataset, TokenizedDataset):
+                lengths = dataset.lengths
+            else:
+                lengths = None
+                warnings.warn("Grouping by length requires the preprocessed data, using the default sampler")
+            if lengths is not None:
+                batch_sampler = LengthGroupedBatchSampler(lengths,
+                                                          batch_size=batch_size,
+                                                          shuffle=shuffle_flag,
+                                                          seed=self.seed,
+                                                          mega_batch_mult=self.length_grouping_mega_batch_mult,
+                                                          num_replicas=self.world_size)
+                padding_report = batch_sampler.padding_report()
+                dist_print(f"Length grouped batches, padding ratio {padding_report['random_padding_ratio']:.2%} "
+                           f"without grouping -> {padding_report['grouped_padding_ratio']:.2%}")
+        elif shuffle_flag and self.token_mixture and isinstance(dataset, TokenizedDataset) and dataset.source_ids is not None:
+            batch_sampler = TokenMixtureBatchSampler(dataset.lengths, dataset.source_ids,
+                                                     batch_size=batch_size,
+                                                     weights=self.each_train_file_percentage,
+                                                     temperature=self.mixture_temperature,
+                                                     epoch_weights=self.mixture_epoch_weights,
+                                                     source_names=[os.path.basename(file_path) for file_path in self.train_file],
+                                                     seed=self.seed)
+            dist_print(f"Token mixture of the first epoch:\n{format_mixture_report(batch_sampler.mixture_report(0))}")
+        elif shuffle_flag and not isinstance(dataset, IterableDataset):
+            # Resumable in the middle of an epoch from its checkpointed position
+            batch_sampler = ShuffledBatchSampler(len(dataset), batch_size=batch_size, seed=self.seed)
+        sampler = SequentialSampler(dataset)
 
         if self.no_preprocess_data:
             collate_function = self.dynamic_collate
+        elif isinstance(dataset, PackedDataset):
+            collate_function = PackedCollator(self.tokenizer.pad_token_id,
+                                              padding_side=self.tokenizer.padding_side)
+        elif self.task_type == "CAUSAL_LM" and self.do_group_texts:
+            collate_function = DataCollatorForLanguageModeling(tokenizer=self.tokenizer, mlm=False)
         elif self.task_type == "CAUSAL_LM":
-            collate_function = DataCollatorForCompletionOnlyLM(self.response_template,
-                                                               tokenizer=self.tokenizer,
-                                                               mlm=False,
-                                                               )
+            collate_function = CompletionOnlyCollator(self.response_token_ids,
+                                                      pad_token_id=self.tokenizer.pad_token_id,
+                                                      padding_side=self.tokenizer.padding_side)
             # collate_function = DataCollatorForLanguageModeling(tokenizer=self.tokenizer, mlm=False)
         elif self.task_type == "SEQ_2_SEQ_LM":
             collate_function = DataCollatorForSeq2Seq(self.tokenizer)
@@ -516,21 +855,58 @@ class QADataloader:
 
         dist_print(f"Collate function {collate_function}")
 
+        if isinstance(dataset, IterableDataset):
+            # The streaming dataset shards the files over the workers, which build and tokenize the examples
+            dataloader = DataLoader(dataset,
+                                    collate_fn=collate_function,
+                                    batch_size=batch_size,
+                                    generator=self.generator,
+                                    pin_memory=torch.cuda.is_available(),
+                                    worker_init_fn=self.seed_worker,
+                                    **self.worker_kwargs()
+                                    )
+            return dataloader
+
+        if batch_sampler is not None:
+            dataloader = DataLoader(dataset,
+                                    batch_sampler=batch_sampler,
+                                    collate_fn=collate_function,
+                                    generator=self.generator,
+                                    pin_memory=torch.cuda.is_available(),
+                                    worker_init_fn=self.seed_worker,
+                                    **self.worker_kwargs()
+                                    )
+            return dataloader
+
         dataloader = DataLoader(dataset,
                                 sampler=sampler,
                                 collate_fn=collate_function,
                                 batch_size=batch_size,
                                 drop_last=False, # Keep this false for no model print evaluation mismatch
+                                generator=self.generator,
                                 pin_memory=torch.cuda.is_available(),
                                 worker_init_fn=self.seed_worker,
+                                **self.worker_kwargs()
                                 )
 
         return dataloader
 
 
 if __name__ == "__main__":
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "EleutherAI/gpt-neo-125m"
+
+    # The tokenized cache is keyed on everything the cached ids and response starts depend on
+    cache_args = {"model_name": model_name, "text_column": "prompt", "target_column": "target",
+                  "train_file": [__file__], "config_type": AdvanceInstructSample, "task_type": "CAUSAL_LM",
+                  "tokenized_cache_dir": tempfile.gettempdir()}
+    cache_keys = [QADataloader(**cache_args, **args).get_split_cache('train', [__file__], 100).key
+                  for args in ({}, {}, {"seed": 7}, {"response_template": " ### Answer:"})]
+    assert cache_keys[0] == cache_keys[1], "The same settings should hit the cache"
+    assert len(set(cache_keys[1:])) == 3, "Another seed or response template should miss the cache"
+    print("Tokenized cache key checks passed")
+
     dataloader_args = {
-        "model_name": "EleutherAI/gpt-neo-125m",
+        "model_name": model_name,
         "text_column": "prompt",
         "target_column": "target",
         "train_file": [
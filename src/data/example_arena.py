@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+from array import array
+from typing import List, Dict, Union, Iterable, Any
+
+import numpy as np
+sys.path.insert(0, r'./')
+
+
+# Row kinds of an arena column
+STR_KIND, NONE_KIND, JSON_KIND, MISSING_KIND, ZLIB_STR_KIND = 0, 1, 2, 3, 4
+
+
+class ArenaColumn:
+    """
+    One column of the arena: every value is utf-8 encoded into a single growing buffer with an offsets array,
+    plus one byte per row telling how to decode it back (str, None, json for lists/numbers/bools, missing key).
+    Strings of at least min_compress_bytes are zlib compressed when compression_level is set.
+    """
+    __slots__ = ("buffer", "offsets", "kinds", "compression_level", "min_compress_bytes")
+
+    def __init__(self, num_missing_rows: int = 0, compression_level: int = None,
+                 min_compress_bytes: int = 256) -> None:
+        self.buffer = bytearray()
+        self.offsets = array('q', [0] * (num_missing_rows + 1))
+        self.kinds = bytearray([MISSING_KIND] * num_missing_rows)
+        self.compression_level = compression_level
+        self.min_compress_bytes = min_compress_bytes
+
+    def append(self, value: Any) -> None:
+        if isinstance(value, str):
+            encoded_value = value.encode('utf-8')
+            if self.compression_level is not None and len(encoded_value) >= self.min_compress_bytes:
+                self.buffer += zlib.compress(encoded_value, self.compression_level)
+                self.kinds.append(ZLIB_STR_KIND)
+            else:
+                self.buffer += encoded_value
+                self.kinds.append(STR_KIND)
+        elif value is None:
+            self.kinds.append(NONE_KIND)
+        else:
+            self.buffer += json.dumps(value, ensure_ascii=False).encode('utf-8')
+            self.kinds.append(JSON_KIND)
+        self.offsets.append(len(self.buffer))
+
+    def append_missing(self) -> None:
+        self.kinds.append(MISSING_KIND)
+        self.offsets.append(len(self.buffer))
+
+    def get(self, idx: int) -> Any:
+        kind = self.kinds[idx]
+        if kind == STR_KIND:
+            return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8')
+        if kind == ZLIB_STR_KIND:
+            return zlib.decompress(self.buffer[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf-8')
+        if kind == JSON_KIND:
+            return json.loads(self.buffer[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8'))
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.buffer) + len(self.offsets) * self.offsets.itemsize + len(self.kinds)
+
+    def save(self, path_prefix: str) -> None:
+        with open(f"{path_prefix}.buf", 'wb') as buffer_file:
+            buffer_file.write(self.buffer)
+        np.save(f"{path_prefix}_offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        np.save(f"{path_prefix}_kinds.npy", np.asarray(self.kinds, dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path_prefix: str, compression_level: int = None) -> "ArenaColumn":
+        """Memory map a saved column (read only), the mmap buffer slices back into bytes like the bytearray does"""
+        column = cls(compression_level=compression_level)
+        with open(f"{path_prefix}.buf", 'rb') as buffer_file:
+            column.buffer = mmap.mmap(buffer_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(buffer_file.fileno()).st_size else b""
+        column.offsets = np.load(f"{path_prefix}_offsets.npy", mmap_mode='r')
+        column.kinds = np.load(f"{path_prefix}_kinds.npy", mmap_mode='r')
+        return column
+
+
+class ExampleArena:
+    """
+    Columnar storage for the loaded examples, the strings of each field are concatenated in one utf-8 buffer
+    (no per example dict, str and dataclass objects), rows are materialized back into dicts on access only.
+    Supports append/extend, len, integer and slice indexing like the list it replaces.
+    Long strings (prompts, docs, answers) are zlib compressed with compression_level (None to disable),
+    a row access decompresses only the fields of that row.
+    """
+    def __init__(self, examples: Iterable[Dict] = None, compression_level: int = 1) -> None:
+        self.columns: Dict[str, ArenaColumn] = {}
+        self.num_rows = 0
+        self.compression_level = compression_level
+        if examples is not None:
+            self.extend(examples)
+
+    def append(self, example: Dict) -> None:
+        for key, value in example.items():
+            column = self.columns.get(key)
+            if column is None:
+                # A key first seen now is missing from all the previous rows
+                column = self.columns[key] = ArenaColumn(num_missing_rows=self.num_rows,
+                                                         compression_level=self.compression_level)
+            column.append(value)
+        if len(example) != len(self.columns):
+            for key, column in self.columns.items():
+                if key not in example:
+                    column.append_missing()
+        self.num_rows += 1
+
+    def extend(self, examples: Iterable[Dict]) -> None:
+        for example in examples:
+            self.append(example)
+
+    def get_row(self, idx: int) -> Dict:
+        if idx < 0:
+            idx += self.num_rows
+        if not 0 <= idx < self.num_rows:
+            raise IndexError(f"Index {idx} out of range for arena of {self.num_rows} examples")
+        return {key: column.get(idx) for key, column in self.columns.items() if column.kinds[idx] != MISSING_KIND}
+
+    def get_column(self, key: str) -> List:
+        """Materialize a single field of every row (eg: all the prompts to tokenize them in batch)"""
+        column = self.columns[key]
+        return [column.get(idx) for idx in range(self.num_rows)]
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(idx, slice):
+            return [self.get_row(row_idx) for row_idx in range(*idx.indices(self.num_rows))]
+        return self.get_row(idx)
+
+    def __iter__(self):
+        for idx in range(self.num_rows):
+            yield self.get_row(idx)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def save(self, output_dir: str) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        for column_idx, column in enumerate(self.columns.values()):
+            column.save(os.path.join(output_dir, f"column_{column_idx}"))
+        with open(os.path.join(output_dir, "arena.json"), 'w', encoding='utf-8') as meta_file:
+            json.dump({"columns": list(self.columns.keys()),
+                       "num_rows": self.num_rows,
+                       "compression_level": self.compression_level}, meta_file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, input_dir: str) -> "ExampleArena":
+        """Memory map an arena written by save, the loaded arena is read only"""
+        with open(os.path.join(input_dir, "arena.json"), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        arena = cls(compression_level=meta["compression_level"])
+        arena.num_rows = meta["num_rows"]
+        arena.columns = {key: ArenaColumn.load(os.path.join(input_dir, f"column_{column_idx}"),
+                                               compression_level=meta["compression_level"])
+                         for column_idx, key in enumerate(meta["columns"])}
+        return arena
+
+
+class TokenArena:
+    """
+    Token ids of one input column kept as a single flat int32 array with an offsets array,
+    so the ids computed while loading can be reused by the preprocessing instead of tokenizing the text again.
+    """
+    __slots__ = ("ids", "offsets")
+
+    def __init__(self) -> None:
+        self.ids = array('i')
+        self.offsets = array('q', [0])
+
+    def append(self, token_ids: List[int]) -> None:
+        self.ids.extend(token_ids)
+        self.offsets.append(len(self.ids))
+
+    def extend(self, batch_token_ids: Iterable[List[int]]) -> None:
+        for token_ids in batch_token_ids:
+            self.append(token_ids)
+
+    def extend_flat(self, flat_token_ids: np.ndarray, lengths: np.ndarray) -> None:
+        """Append a batch given as its concatenated int32 ids and the length of each example"""
+        self.ids.frombytes(np.ascontiguousarray(flat_token_ids, dtype=np.int32).tobytes())
+        self.offsets.frombytes((self.offsets[-1] + np.cumsum(lengths, dtype=np.int64)).tobytes())
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(np.asarray(self.offsets, dtype=np.int64))
+
+    def length(self, idx: int) -> int:
+        return self.offsets[idx + 1] - self.offsets[idx]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> List[int]:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} out of range for token arena of {len(self)} examples")
+        return self.ids[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.ids) * self.ids.itemsize + len(self.offsets) * self.offsets.itemsize
+
+    def save(self, path_prefix: str) -> None:
+        np.save(f"{path_prefix}_ids.npy", np.asarray(self.ids, dtype=np.int32))
+        np.save(f"{path_prefix}_offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path_prefix: str) -> "TokenArena":
+        """Memory map the ids and offsets written by save, the loaded arena is read only"""
+        token_arena = cls()
+        token_arena.ids = np.load(f"{path_prefix}_ids.npy", mmap_mode='r')
+        token_arena.offsets = np.load(f"{path_prefix}_offsets.npy", mmap_mode='r')
+        return token_arena
+
+
+if __name__ == "__main__":
+    import random
+    import string
+    import tempfile
+    import tracemalloc
+
+    random.seed(42)
+    vietnamese_words = ["người", "Việt", "Nam", "của", "tôi", "là", "những", "được", "trong", "một", "có", "không"]
+    english_words = ["the", "model", "answer", "question", "context", "with", "for", "data"]
+
+    def random_text(num_words: int) -> str:
+        return " ".join(random.choices(vietnamese_words + english_words, k=num_words))
+
+    examples = [{"qas_id": ''.join(random.choices(string.hexdigits, k=32)),
+                 "system_prompt": random_text(20),
+                 "question_text": random_text(80),
+                 "orig_answer_texts": random_text(150),
+                 "answer_lengths": None} for _ in range(100000)]
+
+    arena = ExampleArena(examples)
+    assert arena.columns["orig_answer_texts"].kinds[0] == ZLIB_STR_KIND
+    for idx in random.sample(range(len(examples)), 1000):
+        assert arena[idx] == examples[idx]
+    assert arena[10:20] == examples[10:20] and arena[-1] == examples[-1]
+    mixed_arena = ExampleArena([{"a": "x"}, {"a": None, "b": [1, "ệ"]}, {"b": True}])
+    assert list(mixed_arena) == [{"a": "x"}, {"a": None, "b": [1, "ệ"]}, {"b": True}]
+    token_arena = TokenArena()
+    token_arena.extend([[1, 2, 3], [], [70000, 4]])
+    assert [token_arena[idx] for idx in range(len(token_arena))] == [[1, 2, 3], [], [70000, 4]]
+    assert token_arena.length(2) == 2 and token_arena[-1] == [70000, 4]
+    token_arena.extend_flat(np.array([5, 6, 7], dtype=np.int32), np.array([1, 0, 2]))
+    assert [token_arena[idx] for idx in range(3, 6)] == [[5], [], [6, 7]]
+    assert token_arena.lengths.tolist() == [3, 0, 2, 1, 0, 2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mixed_arena.save(os.path.join(tmp_dir, "mixed"))
+        arena.save(os.path.join(tmp_dir, "arena"))
+        token_arena.save(os.path.join(tmp_dir, "tokens"))
+        assert list(ExampleArena.load(os.path.join(tmp_dir, "mixed"))) == list(mixed_arena)
+        loaded_arena = ExampleArena.load(os.path.join(tmp_dir, "arena"))
+        assert loaded_arena[123] == examples[123] and len(loaded_arena) == len(examples)
+        loaded_token_arena = TokenArena.load(os.path.join(tmp_dir, "tokens"))
+        assert [loaded_token_arena[idx] for idx in range(6)] == [token_arena[idx] for idx in range(6)]
+        del loaded_arena, loaded_token_arena
+    print("Round trip check passed")
+
+    # Memory of the loaded examples, the list of dicts is rebuilt from json so nothing is shared with `examples`
+    serialized_examples = [json.dumps(example, ensure_ascii=False) for example in examples]
+    for name, build_fn in (("list of dicts", lambda: [json.loads(line) for line in serialized_examples]),
+                           ("ExampleArena (uncompressed)",
+                            lambda: ExampleArena((json.loads(line) for line in serialized_examples), compression_level=None)),
+                           ("ExampleArena", lambda: ExampleArena(json.loads(line) for line in serialized_examples))):
+        tracemalloc.start()
+        storage = build_fn()
+        current_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {current_memory / 1024 ** 2:.1f}MB ({current_memory / len(storage):.0f} bytes/example)")
+        del storage
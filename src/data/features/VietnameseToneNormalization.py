@@ -1,5 +1,11 @@
 # coding=utf-8
 # Copyright (c) 2021 VinAI Research
+import re
+import os
+import time
+import unicodedata
+from functools import lru_cache
+from typing import List, Dict, Tuple, FrozenSet, Iterable
 
 dict_map = {
     "òa": "oà",
@@ -50,7 +56,172 @@ dict_map = {
     }
 
 
+
+@lru_cache(maxsize=8)
+def compile_dict_map(dict_items: tuple) -> Tuple[re.Pattern, FrozenSet[str], bool]:
+    # Longest keys first so a key never shadows a longer one starting at the same position,
+    # the capturing group makes split() return the matched keys between the unchanged pieces
+    pattern = re.compile("(" + "|".join(re.escape(key) for key, _ in sorted(dict_items, key=lambda item: len(item[0]),
+                                                                            reverse=True)) + ")")
+    # A text without any of the first characters of the keys has nothing to replace
+    first_chars = frozenset(key[0] for key, _ in dict_items)
+    # With only non ascii first characters (the default keys all start with a toned vowel), ascii texts are skipped
+    # by str.isascii, which is O(1) (a flag of the str object) instead of a scan of the text
+    skip_ascii = not any(char.isascii() for char in first_chars)
+    return pattern, first_chars, skip_ascii
+
+
+TONE_MATCHER = compile_dict_map(tuple(dict_map.items()))
+
+
+def get_tone_matcher(dict_map: Dict[str, str]) -> Tuple[re.Pattern, FrozenSet[str], bool]:
+    return TONE_MATCHER if dict_map is globals()["dict_map"] else compile_dict_map(tuple(dict_map.items()))
+
+
+def substitute_keys(text: str, matcher: Tuple[re.Pattern, FrozenSet[str], bool], dict_map: Dict[str, str]) -> str:
+    pattern, first_chars, skip_ascii = matcher
+    if (skip_ascii and text.isascii()) or first_chars.isdisjoint(text):
+        return text
+    parts = pattern.split(text)
+    if len(parts) == 1:
+        return text
+    # The odd parts are the matched keys, looked up by dict.__getitem__ in C instead of a Python callback per match
+    parts[1::2] = map(dict_map.__getitem__, parts[1::2])
+    return "".join(parts)
+
+
 def replace_all(text, dict_map=dict_map):
+    """
+    Move the tone mark to the vowel expected by the new style ("òa" -> "oà", "ủy" -> "uỷ") in one regex pass,
+    texts without any candidate character are returned without running the regex.
+    None of the default replacements create another key, so this is the same as replacing each key in turn.
+    """
+    return substitute_keys(text, get_tone_matcher(dict_map), dict_map)
+
+
+def replace_all_reference(text, dict_map=dict_map):
+    # One str.replace per entry, kept to check replace_all against
     for i, j in dict_map.items():
         text = text.replace(i, j)
-    return text
\ No newline at end of file
+    return text
+
+
+def normalize_batch(texts: Iterable[str], dict_map: Dict[str, str] = dict_map) -> List[str]:
+    """replace_all over a batch of texts, the pattern is resolved once"""
+    matcher = get_tone_matcher(dict_map)
+    return [substitute_keys(text, matcher, dict_map) for text in texts]
+
+
+def normalize_file(input_path: str, output_path: str, batch_lines: int = 10000,
+                   dict_map: Dict[str, str] = dict_map) -> int:
+    """
+    Stream a text/jsonl file through normalize_batch, batch_lines lines at a time, returns the number of lines.
+    Json files must be written with ensure_ascii=False, escaped characters (\\u00f2) are not matched.
+    """
+    assert os.path.isfile(input_path), f"Invalid path file for {input_path}"
+    total_lines = 0
+    with open(input_path, 'r', encoding='utf-8', newline='') as input_file, \
+            open(output_path, 'w', encoding='utf-8', newline='') as output_file:
+        batch = []
+        for line in input_file:
+            batch.append(line)
+            if len(batch) == batch_lines:
+                output_file.write("".join(normalize_batch(batch, dict_map)))
+                total_lines += len(batch)
+                batch = []
+        output_file.write("".join(normalize_batch(batch, dict_map)))
+        total_lines += len(batch)
+
+    return total_lines
+
+
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+
+
+def collapse_whitespace_runs(text: str) -> str:
+    # str.split() collapses every run of whitespace at C speed, line breaks are kept
+    # and more than one blank line in a row becomes a single paragraph break
+    if "\n" not in text:
+        return " ".join(text.split())
+    text = "\n".join(" ".join(line.split()) for line in text.split("\n"))
+    return BLANK_LINES_PATTERN.sub("\n\n", text).strip("\n")
+
+
+def normalize_text(text: str, remove_underscore: bool = True, collapse_whitespace: bool = True) -> str:
+    """
+    Full normalization applied the same way to documents, index entries and queries:
+    Unicode NFC (tone marks composed with their vowel), tone mark placement (replace_all),
+    word segmentation underscores to spaces ("Việt_Nam" -> "Việt Nam") and whitespace collapse.
+    """
+    if not unicodedata.is_normalized("NFC", text):
+        text = unicodedata.normalize("NFC", text)
+    text = substitute_keys(text, TONE_MATCHER, dict_map)
+    if remove_underscore:
+        text = text.replace("_", " ")
+    if collapse_whitespace:
+        text = collapse_whitespace_runs(text)
+    return text
+
+
+def normalize_texts(texts: Iterable[str], remove_underscore: bool = True,
+                    collapse_whitespace: bool = True) -> List[str]:
+    return [normalize_text(text, remove_underscore, collapse_whitespace) for text in texts]
+
+
+if __name__ == "__main__":
+    import random
+
+    # Parity with the entry by entry replacement
+    random.seed(42)
+    pieces = list(dict_map.keys()) + list(dict_map.values()) + ["hoà", "thuỷ", "khoẻ", "Hòa Bình", "tàu thủy",
+                                                                "ò", "a", "Y", " ", "\n", "_"]
+    sample_texts = ["".join(random.choices(pieces, k=random.randint(0, 200))) for _ in range(5000)]
+    for sample_text in sample_texts:
+        assert replace_all(sample_text) == replace_all_reference(sample_text), sample_text
+    assert normalize_batch(sample_texts) == [replace_all_reference(text) for text in sample_texts]
+    ascii_map = {"colour": "color", "òa": "oà"}
+    assert replace_all("colour of Hòa", ascii_map) == replace_all_reference("colour of Hòa", ascii_map) == "color of Hoà"
+    print(f"Parity check passed on {len(sample_texts)} texts")
+
+    # Benchmark on document sized chunks, where one word in three has a tone mark to move,
+    # and on chunks already in the new style or without any candidate character (English text)
+    chunk_texts = [" ".join(random.choices(["Hòa", "thủy", "khỏe", "người", "Việt", "Nam", "của", "tôi", "là"],
+                                           k=300)) for _ in range(5000)]
+    new_style_texts = [" ".join(random.choices(["hoà", "thuỷ", "khoẻ", "người", "Việt", "Nam", "của", "tôi", "là"],
+                                               k=300)) for _ in range(5000)]
+    english_texts = [" ".join(random.choices(["the", "water", "is", "healthy", "today", "in", "Viet", "Nam"],
+                                             k=300)) for _ in range(5000)]
+    for texts_name, texts in (("chunks", chunk_texts), ("new style chunks", new_style_texts),
+                              ("english chunks", english_texts)):
+        timings = {}
+        for name, normalize_fn in (("replace_all_reference", lambda texts: [replace_all_reference(text) for text in texts]),
+                                   ("normalize_batch", normalize_batch)):
+            start_time = time.perf_counter()
+            normalized_texts = normalize_fn(texts)
+            timings[name] = time.perf_counter() - start_time
+        assert normalized_texts == [replace_all_reference(text) for text in texts]
+        print(f"{texts_name}: " + ", ".join(f"{name} {elapsed_time:.3f}s" for name, elapsed_time in timings.items()) +
+              f" ({timings['replace_all_reference'] / timings['normalize_batch']:.1f}x)")
+
+    # Streaming file normalization round trip
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path, output_path = os.path.join(tmp_dir, "input.txt"), os.path.join(tmp_dir, "output.txt")
+        with open(input_path, 'w', encoding='utf-8', newline='') as input_file:
+            input_file.write("\n".join(sample_texts))
+        total_lines = normalize_file(input_path, output_path, batch_lines=1000)
+        with open(output_path, 'r', encoding='utf-8', newline='') as output_file:
+            assert output_file.read() == replace_all_reference("\n".join(sample_texts))
+        print(f"normalize_file: {total_lines} lines normalized")
+
+    # Full normalization pipeline
+    assert normalize_text(unicodedata.normalize("NFD", "Hòa_Bình  có\t\tthủy   điện\n\n\n  Việt_Nam \n")) == \
+           "Hoà Bình có thuỷ điện\n\nViệt Nam"
+    assert normalize_texts(chunk_texts[:100]) == [normalize_text(text) for text in chunk_texts[:100]]
+    segmented_texts = [text.replace(" ", "_", 50) for text in chunk_texts]
+    start_time = time.perf_counter()
+    normalize_texts(segmented_texts)
+    elapsed_time = time.perf_counter() - start_time
+    total_mb = sum(len(text.encode('utf-8')) for text in segmented_texts) / 1024 ** 2
+    print(f"normalize_texts: {elapsed_time:.2f}s ({len(segmented_texts) / elapsed_time:.0f} texts/s, "
+          f"{total_mb / elapsed_time:.1f}MB/s)")
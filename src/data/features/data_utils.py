@@ -1,26 +1,107 @@
 import json
 import os.path
 import sys
-from typing import Union, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, List, Dict, Iterator
 sys.path.insert(0, r'./')
 
+from src.data.configs import AdvanceInstructSample
+from src.data.features.data_writer import JsonlWriter
 
-def reformat_data(data_paths: List[str], added_string: str="Formated"):
-    "Format json data to supported data type for pyarrow"
 
-    for file in data_paths:
-        assert os.path.isfile(file), f"Please provide the correct path, No path exist for {file}"
-        with open(file, "r", encoding="utf-8") as f:
-            json_data = json.load(f)
-            file_name = os.path.basename(file).split(".")[0]
-            formated_file = file.replace(file_name+".", file_name+added_string+".")
-            with open(formated_file, "w", encoding="utf-8") as f:
-                for item in json_data:
-                    json.dump(item, f, ensure_ascii=False)
-                    f.write("\n")
-        print(f"Finished converted {file}")
+NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+
+def iter_json_array(file_path: str, chunk_size: int = 1024 * 1024) -> Iterator[Union[Dict, List, str, int, float, bool, None]]:
+    """
+    Incrementally parse a file holding one top level JSON array and yield its items one by one.
+    Only the current chunk (and the item being decoded) is kept in memory, so the file size doesn't matter.
+    """
+    decoder = json.JSONDecoder()
+    # utf-8-sig also skips the BOM some editors add
+    with open(file_path, "r", encoding="utf-8-sig") as f:
+        buffer, pos = "", 0
+        end_of_file = False
+        array_started, expect_item = False, True
+        read_size = chunk_size
+
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos == len(buffer):
+                assert not end_of_file, f"Unexpected end of file in {file_path}, the json array is not closed"
+                buffer, pos = f.read(chunk_size), 0
+                end_of_file = len(buffer) < chunk_size
+                continue
+
+            char = buffer[pos]
+            if not array_started:
+                assert char == "[", f"{file_path} is not a json array, it should start with '['"
+                array_started = True
+                pos += 1
+                continue
+            if char == "]":
+                return
+            if not expect_item:
+                assert char == ",", f"Invalid json array in {file_path}, expected ',' between items"
+                expect_item = True
+                pos += 1
+                continue
+
+            try:
+                item, item_end = decoder.raw_decode(buffer, pos)
+                # A number cut by the chunk boundary ("-15" of "-15.5e3") decodes fine, it is only complete
+                # once followed by a character that can't continue it
+                complete = end_of_file or (item_end < len(buffer) and buffer[item_end] not in NUMBER_CHARS)
+            except json.JSONDecodeError:
+                assert not end_of_file, f"Invalid json item in {file_path}"
+                complete = False
+            if not complete:
+                # The item spans over the chunk boundary, read more (doubling for very large items) and retry
+                chunk = f.read(read_size)
+                end_of_file = len(chunk) < read_size
+                buffer, pos = buffer[pos:] + chunk, 0
+                read_size *= 2
+                continue
+
+            yield item
+            pos = item_end
+            expect_item = False
+            read_size = chunk_size
+
+
+def reformat_file(file: str, added_string: str = "Formated", schema_keys: List[str] = None,
+                  chunk_size: int = 1024 * 1024) -> str:
+    assert os.path.isfile(file), f"Please provide the correct path, No path exist for {file}"
+    file_name = os.path.basename(file).split(".")[0]
+    formated_file = file.replace(file_name+".", file_name+added_string+".")
+    with JsonlWriter(formated_file, schema_keys=schema_keys, verbose=False) as writer:
+        writer.write(iter_json_array(file, chunk_size=chunk_size), desc=f"Converting {os.path.basename(file)}")
+    print(f"Finished converted {file} ({writer.total_rows} items)")
+
+    return formated_file
+
+
+def reformat_data(data_paths: List[str], added_string: str="Formated",
+                  validate_keys: bool = False, target_config=AdvanceInstructSample,
+                  num_proc: int = 1, chunk_size: int = 1024 * 1024) -> List[str]:
+    """
+    Format json data to supported data type for pyarrow.
+    Each json array file is streamed item by item to a line-JSON file (constant memory), files are converted
+    in parallel with num_proc processes. With validate_keys every item must have the target_config keys.
+    """
+    schema_keys = target_config.get_keys() if validate_keys else None
+    if num_proc <= 1 or len(data_paths) <= 1:
+        return [reformat_file(file, added_string, schema_keys, chunk_size) for file in data_paths]
+
+    with ProcessPoolExecutor(max_workers=min(num_proc, len(data_paths))) as executor:
+        return list(executor.map(reformat_file, data_paths,
+                                 [added_string] * len(data_paths),
+                                 [schema_keys] * len(data_paths),
+                                 [chunk_size] * len(data_paths)))
 
 
 if __name__=="__main__":
     reformat_data([r"src/data/features/final_storge_converted/databricks-dolly-15k/databricks_dolly15k.json",
-                   r"src/data/features/final_storge_converted/databricks-dolly-15k/databricks_dolly15k_translated.json"])
\ No newline at end of file
+                   r"src/data/features/final_storge_converted/databricks-dolly-15k/databricks_dolly15k_translated.json"],
+                  validate_keys=True)
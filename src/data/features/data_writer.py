@@ -0,0 +1,300 @@
+import io
+import os
+import sys
+import time
+import gzip
+import typing
+import dataclasses
+sys.path.insert(0, r'./')
+from typing import List, Dict, Iterable, Union
+from abc import ABC, abstractmethod
+
+try:
+    import ujson
+    HAVE_UJSON = True
+except ImportError:
+    import json
+    HAVE_UJSON = False
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm.auto import tqdm
+
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+OUTPUT_FORMAT_EXTENSIONS = {"jsonl": ".json", "parquet": ".parquet", "arrow": ".arrow"}
+# Codecs each output format can be written with, the Arrow IPC format only supports lz4 and zstd
+OUTPUT_FORMAT_COMPRESSIONS = {"jsonl": (None, "gzip", "zstd"),
+                              "parquet": (None, "snappy", "gzip", "brotli", "lz4", "zstd"),
+                              "arrow": (None, "lz4", "zstd")}
+
+ARROW_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+}
+
+
+def encode_json(data: Dict) -> str:
+    if HAVE_UJSON:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def check_compression(output_format: str, compression: str = None) -> None:
+    """Fail before anything is converted or written when the codec does not fit the output format or is missing"""
+    assert compression in OUTPUT_FORMAT_COMPRESSIONS[output_format], \
+        f"Unsupported compression {compression} for output format {output_format}, " \
+        f"please choose one of {list(OUTPUT_FORMAT_COMPRESSIONS[output_format])}"
+    if compression is None:
+        return
+    if output_format == "jsonl":
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("zstd compression requires the zstandard package, please `pip install zstandard`")
+    else:
+        assert pa.Codec.is_available(compression), f"The {compression} codec is not available in this pyarrow build"
+
+
+def get_arrow_schema(config) -> pa.Schema:
+    """Derive the arrow schema from the fields of a config dataclass (AdvanceInstructSample, AdvanceQAExample)"""
+    type_hints = typing.get_type_hints(config)
+    arrow_fields = []
+    for config_field in dataclasses.fields(config):
+        field_type = type_hints[config_field.name]
+        if typing.get_origin(field_type) in (list, List):
+            arrow_type = pa.list_(ARROW_TYPES[typing.get_args(field_type)[0]])
+        else:
+            arrow_type = ARROW_TYPES[field_type]
+        arrow_fields.append(pa.field(config_field.name, arrow_type, nullable=True))
+    return pa.schema(arrow_fields)
+
+
+class DataWriter(ABC):
+    """
+    Base writer for the parser outputs.
+    The schema keys are resolved once and checked as a set per row, rows are written in batches
+    and the throughput (rows/s) is reported when the writer is closed.
+    """
+    def __init__(self, output_path: str,
+                 schema_keys: List[str] = None,
+                 batch_size: int = 2048,
+                 verbose: bool = True) -> None:
+        self.output_path = output_path
+        self.required_keys = frozenset(schema_keys) if schema_keys else frozenset()
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+        self.total_rows = 0
+        self.total_time = 0.
+        self.is_open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @abstractmethod
+    def open_file(self) -> None:
+        pass
+
+    @abstractmethod
+    def close_file(self) -> None:
+        pass
+
+    @abstractmethod
+    def write_rows(self, batch: List[Dict]) -> None:
+        pass
+
+    def open(self) -> None:
+        self.open_file()
+        self.is_open = True
+
+    def close(self) -> None:
+        if not self.is_open:
+            return
+        self.close_file()
+        self.is_open = False
+        if self.verbose:
+            rows_per_sec = self.total_rows / self.total_time if self.total_time > 0 else float("inf")
+            print(f"\n Wrote {self.total_rows} rows to {self.output_path} in {self.total_time:.2f} seconds "
+                  f"({rows_per_sec:.0f} rows/s)")
+
+    def validate_batch(self, batch: List[Dict]) -> None:
+        required_keys = self.required_keys
+        for data in batch:
+            if not required_keys <= data.keys():
+                missing_keys = sorted(required_keys - data.keys())
+                raise AssertionError(f"\n Invalid parser, the key(s) {missing_keys} is missing from {sorted(required_keys)}\n"
+                                     f"you can adjust the fields in the 'src/data/configs/'"
+                                     f"  or fill in the missing field")
+
+    def write_batch(self, batch: List[Dict]) -> int:
+        if not batch:
+            return 0
+        start_time = time.perf_counter()
+        if self.required_keys:
+            self.validate_batch(batch)
+        self.write_rows(batch)
+        self.total_time += time.perf_counter() - start_time
+        self.total_rows += len(batch)
+        return len(batch)
+
+    def write(self, rows: Iterable[Dict], desc: str = "Writing data to file") -> int:
+        assert self.is_open, "Please open the writer first, or use it as a context manager"
+        progress_bar = tqdm(desc=desc, unit=" rows", disable=not self.verbose)
+        total_written = 0
+        batch = []
+        for data in rows:
+            batch.append(data)
+            if len(batch) == self.batch_size:
+                total_written += self.write_batch(batch)
+                progress_bar.update(len(batch))
+                batch = []
+        total_written += self.write_batch(batch)
+        progress_bar.update(len(batch))
+        progress_bar.close()
+
+        return total_written
+
+
+class JsonlWriter(DataWriter):
+    """
+    Line-JSON writer, rows are serialized in batches (ujson when available) and written through
+    a large buffered, optionally gzip/zstd compressed, handle.
+    """
+    def __init__(self, output_path: str,
+                 schema_keys: List[str] = None,
+                 batch_size: int = 2048,
+                 buffer_size: int = 16 * 1024 * 1024,
+                 compression: str = None,
+                 compression_level: int = 3,
+                 verbose: bool = True) -> None:
+        check_compression("jsonl", compression)
+        super().__init__(output_path + COMPRESSION_SUFFIXES[compression],
+                         schema_keys=schema_keys,
+                         batch_size=batch_size,
+                         verbose=verbose)
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self.compression_level = compression_level
+
+        self._raw_file = None
+        self._file = None
+
+    def open_file(self) -> None:
+        self._raw_file = open(self.output_path, 'wb', buffering=self.buffer_size)
+        if self.compression == "gzip":
+            self._file = io.BufferedWriter(gzip.GzipFile(fileobj=self._raw_file, mode='wb',
+                                                         compresslevel=self.compression_level),
+                                           buffer_size=self.buffer_size)
+        elif self.compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                self._raw_file.close()
+                raise ImportError("zstd compression requires the zstandard package, please `pip install zstandard`")
+            compressor = zstandard.ZstdCompressor(level=self.compression_level)
+            self._file = io.BufferedWriter(compressor.stream_writer(self._raw_file, closefd=False),
+                                           buffer_size=self.buffer_size)
+        else:
+            self._file = self._raw_file
+
+    def close_file(self) -> None:
+        self._file.close()
+        if self._file is not self._raw_file:
+            self._raw_file.close()
+        self._file, self._raw_file = None, None
+
+    def write_rows(self, batch: List[Dict]) -> None:
+        self._file.write(("\n".join(map(encode_json, batch)) + "\n").encode('utf-8'))
+
+
+class ArrowWriter(DataWriter):
+    """
+    Columnar writer, each batch becomes a record batch with the schema derived from the config dataclass.
+    output_format 'parquet' writes a parquet file (compressed with `compression`, zstd by default),
+    'arrow' writes an Arrow IPC file that the dataloader can memory map zero-copy, keep it uncompressed for that.
+    """
+    def __init__(self, output_path: str,
+                 config,
+                 output_format: str = "parquet",
+                 batch_size: int = 2048,
+                 compression: str = None,
+                 verbose: bool = True) -> None:
+        assert output_format in ("parquet", "arrow"), f"Unsupported columnar format {output_format}"
+        check_compression(output_format, compression)
+        super().__init__(os.path.splitext(output_path)[0] + OUTPUT_FORMAT_EXTENSIONS[output_format],
+                         schema_keys=[config_field.name for config_field in dataclasses.fields(config)],
+                         batch_size=batch_size,
+                         verbose=verbose)
+        self.schema = get_arrow_schema(config)
+        self.output_format = output_format
+        self.compression = compression
+        self._writer = None
+
+    def open_file(self) -> None:
+        if self.output_format == "parquet":
+            self._writer = pq.ParquetWriter(self.output_path, self.schema,
+                                            compression=self.compression if self.compression else "zstd")
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=self.compression) if self.compression else None
+            self._writer = pa.ipc.new_file(self.output_path, self.schema, options=options)
+
+    def close_file(self) -> None:
+        self._writer.close()
+        self._writer = None
+
+    def write_rows(self, batch: List[Dict]) -> None:
+        record_batch = pa.RecordBatch.from_pylist(batch, schema=self.schema)
+        if self.output_format == "parquet":
+            self._writer.write_batch(record_batch)
+        else:
+            self._writer.write(record_batch)
+
+
+if __name__ == "__main__":
+    import random
+    import string
+    import tempfile
+
+    from src.data.configs import AdvanceInstructSample
+
+    sample_rows = [{"qas_id": str(idx),
+                    "system_prompt": "",
+                    "question_text": ''.join(random.choices(string.ascii_letters + " ", k=512)),
+                    "orig_answer_texts": ''.join(random.choices(string.ascii_letters + " ", k=1024)),
+                    "answer_lengths": None} for idx in range(100000)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for compression in COMPRESSION_SUFFIXES:
+            if compression == "zstd":
+                try:
+                    import zstandard
+                except ImportError:
+                    continue
+            with JsonlWriter(os.path.join(tmp_dir, "bench.json"),
+                             schema_keys=list(sample_rows[0].keys()),
+                             compression=compression) as writer:
+                writer.write(sample_rows, desc=f"Writing jsonl with compression {compression}")
+            print(f" File size: {os.path.getsize(writer.output_path) / 1024 ** 2:.2f}MB")
+
+        for output_format in ("parquet", "arrow"):
+            with ArrowWriter(os.path.join(tmp_dir, "bench.json"),
+                             AdvanceInstructSample,
+                             output_format=output_format) as writer:
+                writer.write(sample_rows, desc=f"Writing {output_format}")
+            print(f" File size: {os.path.getsize(writer.output_path) / 1024 ** 2:.2f}MB")
+
+        # A codec of another format is refused when the writer is created, not when the first batch is written
+        for output_format, compression in (("arrow", "gzip"), ("jsonl", "snappy"), ("parquet", "zip")):
+            try:
+                check_compression(output_format, compression)
+            except AssertionError as e:
+                print(f" {e}")
+            else:
+                raise AssertionError(f"{compression} should be refused for {output_format}")
@@ -1 +1,3 @@
-from .code_filters import have_code
\ No newline at end of file
+from .code_filters import have_code, have_code_batch
+from .filter_pipeline import (ExampleFilter, FilterPipeline, DuplicateIdFilter, EmptyAnswerFilter,
+                              LengthFilter, LanguageFilter, CodeFilter)
\ No newline at end of file
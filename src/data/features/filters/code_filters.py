@@ -1,33 +1,99 @@
 import re
-from typing import Tuple
+import time
+from collections import Counter, defaultdict
+from typing import Tuple, Dict, Sequence
+
+import numpy as np
+
+
+CODE_ELEMENTS = [
+    ';', '{', '}', 'function', 'class', 'var', 'int', 'void', 'public',
+    'import', 'for', 'while', 'elif', 'switch', 'case', 'break',
+    'def', 'return', 'const', 'let', 'async', 'await', 'public', 'private',
+    'protected', 'extends', 'implements', 'new', 'try', 'catch', 'throw',
+    'require', 'import', 'module.exports', 'console.log', 'printf', '#include',
+    'namespace', 'using', 'struct', 'typedef', 'enum', 'interface', 'const',
+    'final', 'abstract', 'static', 'main', 'int', 'float', 'double', 'bool',
+    'true', 'false', 'NULL', 'nil', 'void', 'var', 'let', 'const', 'val',
+    'try', 'catch', 'finally', 'raise', 'lambda', 'self', 'super',
+    'instanceof', 'enum', 'switch', 'case', 'break', 'default', 'console', 'python',
+    'csharp' , 'c', 'js', 'javascript', 'java', 'pytorch', 'php', 'asm', '//', '#', 'writeline', 'readline', '```',
+    'json', 'html', 'css', 'lxml', 'xml', '<', '>', '<html>', '<body>', '<li>', '</html>', '</body>', '</ul>', '<ul>', '</li>',
+    '[', ']', '<text>', '</', '<source>', '</source>' , '</text>', 'sql', 'select', 'from' , 'table', 'union', 'group' ,
+    'string', '()', 'Hello, world!', 'C# code', 'python code', 'import re', 'object', 'ABC', 'Ruby', 'regex', 'println'
+]
+
+# The vocabulary is lowercased and deduplicated once at import, an element listed several times
+# still counts once per listing (same score as scanning the raw list element by element)
+CODE_ELEMENT_COUNTS = Counter(element.lower() for element in CODE_ELEMENTS)
+ORDERED_CODE_ELEMENTS = [element.lower() for element in CODE_ELEMENTS]
+
+# Elements made only of word characters can only match a whole word (\bword\b), they never overlap
+# each other, so a single alternation finds all of them in one scan
+WORD_ELEMENTS = [element for element in CODE_ELEMENT_COUNTS if re.fullmatch(r'\w+', element)]
+WORD_PATTERN = re.compile(r'\b(?:' + '|'.join(re.escape(element) for element in
+                                              sorted(WORD_ELEMENTS, key=len, reverse=True)) + r')\b')
+
+# The symbol/phrase elements ('<', '<html>', '</', ...) can overlap each other, a zero-width lookahead
+# finds every position where at least one of them starts, the \b boundaries are checked per element after
+PHRASE_ELEMENTS = [element for element in CODE_ELEMENT_COUNTS if element not in set(WORD_ELEMENTS)]
+PHRASE_PATTERN = re.compile(r'(?=' + '|'.join(re.escape(element) for element in PHRASE_ELEMENTS) + r')')
+PHRASE_ELEMENTS_BY_FIRST_CHAR = defaultdict(list)
+for phrase_element in PHRASE_ELEMENTS:
+    PHRASE_ELEMENTS_BY_FIRST_CHAR[phrase_element[0]].append(phrase_element)
+
+
+def is_word_char(char: str) -> bool:
+    # Same definition as \w for str patterns
+    return char.isalnum() or char == '_'
+
+
+def count_phrase_elements(text: str) -> Dict[str, int]:
+    phrase_counts = defaultdict(int)
+    last_match_end = {}
+    text_length = len(text)
+    for match in PHRASE_PATTERN.finditer(text):
+        start = match.start()
+        prev_is_word = start > 0 and is_word_char(text[start - 1])
+        for element in PHRASE_ELEMENTS_BY_FIRST_CHAR[text[start]]:
+            if not text.startswith(element, start) or start < last_match_end.get(element, 0):
+                continue
+            end = start + len(element)
+            # \b at both ends of the element
+            if prev_is_word == is_word_char(element[0]):
+                continue
+            if (end < text_length and is_word_char(text[end])) == is_word_char(element[-1]):
+                continue
+            phrase_counts[element] += 1
+            last_match_end[element] = end
+    return phrase_counts
 
 
 def code_likelihood_score(text) -> Tuple[int, list]:
     # Calculate a score based on code-like elements
-    score = 0
-    code_elements = [
-        ';', '{', '}', 'function', 'class', 'var', 'int', 'void', 'public',
-        'import', 'for', 'while', 'elif', 'switch', 'case', 'break',
-        'def', 'return', 'const', 'let', 'async', 'await', 'public', 'private',
-        'protected', 'extends', 'implements', 'new', 'try', 'catch', 'throw',
-        'require', 'import', 'module.exports', 'console.log', 'printf', '#include',
-        'namespace', 'using', 'struct', 'typedef', 'enum', 'interface', 'const',
-        'final', 'abstract', 'static', 'main', 'int', 'float', 'double', 'bool',
-        'true', 'false', 'NULL', 'nil', 'void', 'var', 'let', 'const', 'val',
-        'try', 'catch', 'finally', 'raise', 'lambda', 'self', 'super',
-        'instanceof', 'enum', 'switch', 'case', 'break', 'default', 'console', 'python',
-        'csharp' , 'c', 'js', 'javascript', 'java', 'pytorch', 'php', 'asm', '//', '#', 'writeline', 'readline', '```',
-        'json', 'html', 'css', 'lxml', 'xml', '<', '>', '<html>', '<body>', '<li>', '</html>', '</body>', '</ul>', '<ul>', '</li>',
-        '[', ']', '<text>', '</', '<source>', '</source>' , '</text>', 'sql', 'select', 'from' , 'table', 'union', 'group' ,
-        'string', '()', 'Hello, world!', 'C# code', 'python code', 'import re', 'object', 'ABC', 'Ruby', 'regex', 'println'
-    ]
     text = text.lower()  # Convert the text to lowercase for case-insensitive comparison
+    element_counts = Counter(WORD_PATTERN.findall(text))
+    element_counts.update(count_phrase_elements(text))
+
     found_elements = []
-    for element in code_elements:
-        element = element.lower()  # Convert elements to lowercase for case-insensitive comparison
+    for element in ORDERED_CODE_ELEMENTS:
+        if element in element_counts:
+            found_elements.extend([element] * element_counts[element])
+    score = len(found_elements) # / (len(text.split(" ")) * 0.1)
+
+    return score, found_elements
+
+
+def code_likelihood_score_reference(text) -> Tuple[int, list]:
+    # Element by element scan (one regex pass per element), kept to check code_likelihood_score against
+    score = 0
+    text = text.lower()
+    found_elements = []
+    for element in CODE_ELEMENTS:
+        element = element.lower()
         matches = re.finditer(rf'\b{re.escape(element)}\b', text)
         found_elements.extend([match.group() for match in matches])
-    score += len(found_elements) # / (len(text.split(" ")) * 0.1)
+    score += len(found_elements)
 
     return score, found_elements
 
@@ -40,6 +106,15 @@ def have_code(text: str, threshold: int=5) -> Tuple[bool, int, list]:
     return False, score, found_elements
 
 
+def have_code_batch(texts: Sequence[str], threshold: int=5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score many texts at once, returns (mask, scores) where mask[i] is have_code(texts[i], threshold)[0].
+    The single pass scan is cheap enough that a process pool (pickling the texts to the workers) does not pay off.
+    """
+    scores = np.fromiter((code_likelihood_score(text)[0] for text in texts), dtype=np.int64, count=len(texts))
+
+    return scores >= threshold, scores
+
 if __name__ == "__main__":
     code_text =\
     '''
@@ -59,3 +134,27 @@ Once you have your list of keywords, combine them with this title prompt: "Can Y
         print("NO CODE")
         print(have_code(code_text)[1])
 
+
+    # Parity with the element by element scan, on the example above and on random code/prose mixes
+    import random
+    random.seed(42)
+    words = code_text.split() + CODE_ELEMENTS + ["Ngày", "hôm", "nay", "a;b", "x<html>y", "f()g", "__init__", "```py"]
+    separators = [" ", "", "\n", ", ", ".", "_", "\t"]
+    sample_texts = [code_text] + [''.join(random.choice(words) + random.choice(separators)
+                                          for _ in range(random.randint(0, 300))) for _ in range(2000)]
+    for sample_text in sample_texts:
+        assert code_likelihood_score(sample_text) == code_likelihood_score_reference(sample_text), sample_text
+    print(f"Parity check passed on {len(sample_texts)} texts")
+
+    # Benchmark on an OpenOrca sized sample (question + response, ~1.5k chars each)
+    orca_sized_texts = [''.join(random.choice(words) + random.choice(separators)
+                                for _ in range(250)) for _ in range(5000)]
+    for score_fn in (code_likelihood_score_reference, code_likelihood_score):
+        start_time = time.perf_counter()
+        for sample_text in orca_sized_texts:
+            score_fn(sample_text)
+        elapsed_time = time.perf_counter() - start_time
+        print(f"{score_fn.__name__}: {elapsed_time:.2f}s ({len(orca_sized_texts) / elapsed_time:.0f} texts/s)")
+
+    batch_mask, batch_scores = have_code_batch(orca_sized_texts)
+    assert batch_scores.tolist() == [code_likelihood_score(sample_text)[0] for sample_text in orca_sized_texts]
@@ -0,0 +1,216 @@
+import time
+from abc import ABC, abstractmethod
+from typing import List, Dict, Iterable, Iterator, Sequence, Union
+
+import numpy as np
+import xxhash
+from tqdm.auto import tqdm
+
+from .code_filters import have_code_batch
+
+
+# Letters that only (or almost only) show up in Vietnamese text, the tone marks and ă â đ ê ô ơ ư
+VIETNAMESE_CHARS = frozenset("ăâđêôơưàáảãạằắẳẵặầấẩẫậèéẻẽẹềếểễệìíỉĩịòóỏõọồốổỗộờớởỡợùúủũụừứửữựỳýỷỹỵ")
+
+
+def get_text(value: Union[str, List[str], None]) -> str:
+    # Fields can be a string, a list of strings (doc_tokens) or None
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return "\n".join(value)
+
+
+def guess_language(text: str, vietnamese_ratio: float = 0.05, ascii_ratio: float = 0.9) -> str:
+    """
+    Script based language guess between 'vi', 'en' and 'other', cheap enough to run on every example.
+    Vietnamese is detected from the ratio of its diacritic letters, 'en' is mostly plain ascii letters.
+    """
+    letters = [char for char in text.lower() if char.isalpha()]
+    if not letters:
+        return "other"
+    vietnamese_letters = sum(char in VIETNAMESE_CHARS for char in letters)
+    if vietnamese_letters / len(letters) >= vietnamese_ratio:
+        return "vi"
+    ascii_letters = sum(char.isascii() for char in letters)
+    if ascii_letters / len(letters) >= ascii_ratio:
+        return "en"
+    return "other"
+
+
+class ExampleFilter(ABC):
+    """
+    A filter over converted examples, keep_mask(examples) returns a boolean mask of the examples to keep.
+    cost is a rough relative cost per example, FilterPipeline runs the cheap filters first.
+    """
+    cost: float = 1.
+
+    def __init__(self) -> None:
+        self.passed = 0
+        self.rejected = 0
+        self.total_time = 0.
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    @abstractmethod
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        pass
+
+    def __call__(self, examples: List[Dict]) -> np.ndarray:
+        start_time = time.perf_counter()
+        mask = np.asarray(self.keep_mask(examples), dtype=bool)
+        self.total_time += time.perf_counter() - start_time
+        num_kept = int(mask.sum())
+        self.passed += num_kept
+        self.rejected += len(examples) - num_kept
+        return mask
+
+
+class DuplicateIdFilter(ExampleFilter):
+    """
+    Drop the examples whose id was already seen, the first occurrence is kept.
+    Only the 64 bits xxh3 hash of every id is remembered: the memory still grows with the number of distinct ids,
+    even in streaming mode, but by a fixed ~70 bytes per id whatever the id length (~700MB for 10M ids).
+    Two distinct ids share a hash with a probability of ~n^2 / 2^65 (~3e-6 for 10M ids), dropping one of them.
+    """
+    cost = 0.
+
+    def __init__(self, key: str = "qas_id") -> None:
+        super().__init__()
+        self.key = key
+        self.seen_ids = set()
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        mask = np.ones(len(examples), dtype=bool)
+        for idx, example in enumerate(examples):
+            example_id = xxhash.xxh3_64_intdigest(str(example[self.key]).encode("utf-8"))
+            if example_id in self.seen_ids:
+                mask[idx] = False
+            else:
+                self.seen_ids.add(example_id)
+        return mask
+
+
+class EmptyAnswerFilter(ExampleFilter):
+    """
+    Drop the examples with an empty or near empty (less than min_chars non blank characters) answer.
+    Set keep_none for AdvanceQAExample datasets where a None answer marks an impossible question.
+    """
+    cost = 0.1
+
+    def __init__(self, keys: Sequence[str] = ('orig_answer_texts',),
+                 min_chars: int = 1, keep_none: bool = False) -> None:
+        super().__init__()
+        self.keys = keys
+        self.min_chars = min_chars
+        self.keep_none = keep_none
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        return np.fromiter((all((self.keep_none and example[key] is None) or
+                                len(get_text(example[key]).strip()) >= self.min_chars for key in self.keys)
+                            for example in examples), dtype=bool, count=len(examples))
+
+
+class LengthFilter(ExampleFilter):
+    """Keep the examples whose fields are between min_length and max_length characters long"""
+    cost = 0.2
+
+    def __init__(self, keys: Sequence[str] = ('question_text', 'orig_answer_texts'),
+                 min_length: int = 0, max_length: int = None) -> None:
+        super().__init__()
+        self.keys = keys
+        self.min_length = min_length
+        self.max_length = max_length if max_length is not None else float("inf")
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        return np.fromiter((all(self.min_length <= len(get_text(example[key])) <= self.max_length
+                                for key in self.keys)
+                            for example in examples), dtype=bool, count=len(examples))
+
+
+class LanguageFilter(ExampleFilter):
+    """Keep the examples whose fields are guessed (see guess_language) as one of the languages"""
+    cost = 1.
+
+    def __init__(self, keys: Sequence[str] = ('question_text',),
+                 languages: Sequence[str] = ('en',)) -> None:
+        super().__init__()
+        self.keys = keys
+        self.languages = frozenset(languages)
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        return np.fromiter((all(guess_language(get_text(example[key])) in self.languages for key in self.keys)
+                            for example in examples), dtype=bool, count=len(examples))
+
+
+class CodeFilter(ExampleFilter):
+    """
+    Drop the examples where one of the fields looks like code (see have_code), the fields are scored
+    one after another and only for the examples still kept.
+    """
+    cost = 10.
+
+    def __init__(self, keys: Sequence[str] = ('question_text', 'orig_answer_texts'),
+                 threshold: int = 5) -> None:
+        super().__init__()
+        self.keys = keys
+        self.threshold = threshold
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        mask = np.ones(len(examples), dtype=bool)
+        for key in self.keys:
+            kept_indices = np.flatnonzero(mask)
+            if not len(kept_indices):
+                break
+            contain_code, scores = have_code_batch([get_text(examples[idx][key]) for idx in kept_indices],
+                                                   threshold=self.threshold)
+            mask[kept_indices[contain_code]] = False
+        return mask
+
+
+class FilterPipeline:
+    """
+    Run a list of ExampleFilter over the converted examples, cheapest filter first. Each filter only sees
+    the examples that passed the previous ones, so an example rejected early is never scored by the
+    expensive filters (code detection). Pass/reject counts and timings are kept per filter, see report().
+    """
+    def __init__(self, filters: List[ExampleFilter], verbose: bool = True) -> None:
+        self.filters = sorted(filters, key=lambda example_filter: example_filter.cost)
+        self.verbose = verbose
+        self.total_examples = 0
+        self.total_kept = 0
+
+    def keep_mask(self, examples: List[Dict]) -> np.ndarray:
+        mask = np.ones(len(examples), dtype=bool)
+        for example_filter in self.filters:
+            kept_indices = np.flatnonzero(mask)
+            if not len(kept_indices):
+                break
+            filter_mask = example_filter([examples[idx] for idx in kept_indices])
+            mask[kept_indices[~filter_mask]] = False
+        self.total_examples += len(examples)
+        self.total_kept += int(mask.sum())
+        return mask
+
+    def filter(self, examples: Iterable[Dict]) -> List[Dict]:
+        examples = examples if isinstance(examples, list) else list(examples)
+        return [example for example, keep in zip(examples, self.keep_mask(examples)) if keep]
+
+    def filter_stream(self, buffers: Iterable[List[Dict]]) -> Iterator[Dict]:
+        """Lazily filter the examples of a stream of buffers (eg: DataParser.iter_buffers), one buffer at a time"""
+        for buffer in buffers:
+            yield from self.filter(buffer)
+
+    def report(self) -> None:
+        if not self.verbose:
+            return
+        tqdm.write(f"\n Filter pipeline kept {self.total_kept}/{self.total_examples} examples")
+        for example_filter in self.filters:
+            seen = example_filter.passed + example_filter.rejected
+            examples_per_sec = seen / example_filter.total_time if example_filter.total_time > 0 else float("inf")
+            tqdm.write(f"  {example_filter.name:<20} passed: {example_filter.passed:<8} "
+                       f"rejected: {example_filter.rejected:<8} time: {example_filter.total_time:.2f}s "
+                       f"({examples_per_sec:.0f} examples/s)")
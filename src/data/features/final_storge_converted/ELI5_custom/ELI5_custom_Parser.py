@@ -38,11 +38,11 @@ class ELI5Parser(DataParser):
         super(ELI5Parser, self).convert()
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 data_dict['doc_tokens'] = data['context']
                 data_dict['doc_tokens'] = super().inject_random_ctx(data_dict['doc_tokens'])
-                data_dict['qas_id'] = self.id_generator(size=8)
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['question'])
                 data_dict['question_text'] = data['question']
 
                 data_dict['is_impossible'] = None
@@ -1,7 +1,5 @@
 import json
 import sys
-import random
-import string
 sys.path.insert(0,r'./')
 import os
 from tqdm.auto import tqdm
@@ -31,19 +29,15 @@ class ELI5Parser(DataParser):
 
         return None
 
-    @staticmethod
-    def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
-        return ''.join(random.choice(chars) for _ in range(size))
-
     def convert(self):
         super(ELI5Parser, self).convert()
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 data_dict['doc_tokens'] = data['contexts'][:self.max_ctxs]
                 # data_dict['doc_tokens'] = super().inject_random_ctx(data_dict['doc_tokens'])
-                data_dict['qas_id'] = self.id_generator(size=8)
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['question'])
                 data_dict['question_text'] = data['question']
 
                 data_dict['is_impossible'] = None
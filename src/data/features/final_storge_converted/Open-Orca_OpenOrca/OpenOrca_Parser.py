@@ -2,23 +2,41 @@ import json
 import sys
 sys.path.insert(0,r'./')
 import os
+from itertools import islice
+from typing import Dict, List
 from tqdm.auto import tqdm
 
 from datasets import load_dataset
 
 from src.data.features import DataParser
 from src.data.configs import AdvanceInstructSample
+from src.data.features.filters import ExampleFilter, DuplicateIdFilter, EmptyAnswerFilter
 
 
 PARSER_TYPE = "OpenOrca"
 
 
+def convert_example(data: Dict, index: int, split: str) -> Dict:
+    data_dict = {}
+    data_dict['system_prompt'] = data['system_prompt']
+    data_dict['qas_id'] = data['id']
+    data_dict['question_text'] = data['question']
+
+    data_dict['orig_answer_texts'] = data['response']
+    data_dict['answer_lengths'] = None
+    return data_dict
+
+
 class OpenOrcaParser(DataParser):
-    def __init__(self, file_path: str, output_path: str):
+    def __init__(self, file_path: str, output_path: str, streaming: bool = False, num_proc: int = 1,
+                 filters: List[ExampleFilter] = None):
         super().__init__(file_path, output_path,
                          parser_type=PARSER_TYPE,
                          do_translate=True,
-                         no_translated_code=True)
+                         no_translated_code=True,
+                         streaming=streaming,
+                         num_proc=num_proc,
+                         filters=filters)
         self.target_config = AdvanceInstructSample
         self.target_fields = ['question_text', 'orig_answer_texts']
         self.max_examples = 80000
@@ -26,6 +44,11 @@ class OpenOrcaParser(DataParser):
     def read(self):
         super(OpenOrcaParser, self).read()
         stream_data = load_dataset("Open-Orca/OpenOrca", streaming=True, keep_in_memory=False)
+        if self.streaming:
+            # Records are pulled from the hub lazily while convert() and save consume them
+            self.data_read = islice(stream_data['train'], self.max_examples + 1)
+            return None
+
         progress_bar = tqdm(total=self.max_examples, desc="Loading data")
         self.data_read = []
         for idx, data in enumerate(stream_data['train']):
@@ -39,25 +62,15 @@ class OpenOrcaParser(DataParser):
 
     def convert(self):
         super(OpenOrcaParser, self).convert()
-        data_converted = []
-        for data in tqdm(self.data_read, desc=f"Converting data"):
-            data_dict = {}
-            data_dict['system_prompt'] = data['system_prompt']
-            data_dict['qas_id'] = data['id']
-            data_dict['question_text'] = data['question']
-
-            data_dict['orig_answer_texts'] = data['response']
-            data_dict['answer_lengths'] = None
-            data_converted.append(data_dict)
-
-        self.converted_data = data_converted
+        self.converted_data = self.map_convert(self.data_read, convert_example, desc="Converting data")
 
         pass
 
 
 if __name__ == '__main__':
     open_orca_parser = OpenOrcaParser(r"src/data/features/final_storge_converted/Open-Orca_OpenOrca/dummy.txt",
-                                      r"src/data/features/final_storge_converted/Open-Orca_OpenOrca")
+                                      r"src/data/features/final_storge_converted/Open-Orca_OpenOrca",
+                                      filters=[DuplicateIdFilter(), EmptyAnswerFilter()])
     open_orca_parser.read()
     open_orca_parser.convert()
     open_orca_parser.save
@@ -33,11 +33,11 @@ class WizardLM70k(DataParser):
 
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 # Randomly assign generic system prompt to data
                 data_dict['system_prompt'] = QA_TEMPLATE().get_generic_system_prompt(random.randint(1, 20)) if bool(random.getrandbits(1)) else ""
-                data_dict['qas_id'] = self.id_generator()
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['instruction'])
                 data_dict['question_text'] = data['instruction']
 
                 data_dict['orig_answer_texts'] = data['output']
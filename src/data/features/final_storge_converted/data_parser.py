@@ -2,7 +2,6 @@ import json
 import logging
 import os
 import random
-import re
 import sys
 import string
 import multiprocessing
@@ -15,12 +14,16 @@ try:
 except ImportError:
     IN_COLAB = False
 from httpcore._exceptions import ConnectTimeout
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Iterable, Iterator, Callable
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from contextlib import nullcontext
+from itertools import islice
 from tqdm.auto import tqdm
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import xxhash
 from googletrans import Translator
 
 import torch
@@ -30,7 +33,17 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from src.data.configs import AdvanceQAExample, AdvanceInstructSample
 from src.utils import force_super_call, ForceBaseCallMeta, timeit
-from src.data.features.filters import have_code
+from src.data.features.filters import ExampleFilter, FilterPipeline, CodeFilter
+from src.data.features.VietnameseToneNormalization import normalize_texts
+from src.data.features.data_writer import DataWriter, JsonlWriter, ArrowWriter, OUTPUT_FORMAT_EXTENSIONS, \
+    check_compression
+
+
+def convert_shard(convert_fn: Callable[..., Dict], shard: List[Dict], shard_seed: str,
+                  split: str, start_index: int) -> List[Dict]:
+    # Seeded per shard rather than per worker so the output only depends on the seed and the shard size
+    random.seed(shard_seed)
+    return [convert_fn(data, index=start_index + offset, split=split) for offset, data in enumerate(shard)]
 
 
 class DataParser(metaclass=ForceBaseCallMeta):
@@ -46,13 +59,46 @@ class DataParser(metaclass=ForceBaseCallMeta):
                  target_config: Union[AdvanceQAExample, AdvanceInstructSample] = AdvanceInstructSample,
                  max_example_per_thread: int = 400,
                  large_chunks_threshold: int = 20000,
-                 no_translated_code: bool = False) -> None:
+                 no_translated_code: bool = False,
+                 streaming: bool = False,
+                 stream_buffer_size: int = 1000,
+                 num_proc: int = 1,
+                 convert_shard_size: int = 10000,
+                 seed: int = 42,
+                 write_batch_size: int = 2048,
+                 output_compression: str = None,
+                 output_format: str = "jsonl",
+                 filters: List[ExampleFilter] = None) -> None:
         self.data_read = None
         self.converted_data = None
         self.file_path = file_path
         self.output_dir = output_dir
         assert os.path.isdir(self.output_dir), "Please provide the correct output directory"
 
+        # In streaming mode read() and convert() may assign generators to self.data_read and
+        # self.converted_data, save then consumes them lazily in buffers of stream_buffer_size
+        self.streaming = streaming
+        self.stream_buffer_size = stream_buffer_size
+
+        # Parallel convert: records are split into shards of convert_shard_size and converted in a process pool
+        self.num_proc = num_proc
+        self.convert_shard_size = convert_shard_size
+        self.seed = seed
+
+        # Outputs are written in batches of write_batch_size rows, optionally compressed with a codec of the format
+        # (gzip or zstd for jsonl, see OUTPUT_FORMAT_COMPRESSIONS), checked here before anything is converted.
+        # output_format can be 'jsonl' (default), 'parquet' or 'arrow' (Arrow IPC, memory mapped by the dataloader)
+        assert output_format in OUTPUT_FORMAT_EXTENSIONS, f"Unsupported output format {output_format}, " \
+                                                          f"please choose one of {list(OUTPUT_FORMAT_EXTENSIONS.keys())}"
+        check_compression(output_format, output_compression)
+        self.write_batch_size = write_batch_size
+        self.output_compression = output_compression
+        self.output_format = output_format
+
+        # Optional filter stage between convert() and save, the filtered out examples are neither written nor
+        # translated (e.g. [DuplicateIdFilter(), EmptyAnswerFilter(), LengthFilter(max_length=15000), CodeFilter()])
+        self.filter_pipeline = FilterPipeline(filters) if filters else None
+
         self.parser_type = parser_type
         self.target_config = target_config
 
@@ -101,31 +147,102 @@ class DataParser(metaclass=ForceBaseCallMeta):
                                 f"  or fill in the missing field"
         return True
 
+    def filter_translatable(self, examples: Iterable[Dict], disable_progress: bool = False) -> List[Dict]:
+        examples = examples if isinstance(examples, list) else list(examples)
+        if not self.no_translated_code:
+            return examples
+
+        keep_mask = CodeFilter(self.target_fields).keep_mask(examples)
+        validated_translate_data = [example for example, keep in zip(examples, keep_mask) if keep]
+        if not disable_progress:
+            tqdm.write(f"Number of example with code: {len(examples) - len(validated_translate_data)}")
+
+        return validated_translate_data
+
     def post_translate_validate(self) -> None:
-        validated_translate_data = []
         # Note: This validates will override the original self.converted_data
-        for idx, example in enumerate(tqdm(self.converted_data, desc="Validating data for translation:")):
-            for key in self.target_fields:
-                if self.no_translated_code:
-                    example_filters = 0
-                    contain_code, score, found_elements = have_code(example[key])
-                    if contain_code:
-                        example_filters += 1
-                        if len(self.converted_data) - 1 == idx:
-                            tqdm.write(f"Number of example with code: {example_filters}")
-                        break
-                    elif key == self.target_fields[-1]:
-                        validated_translate_data.append(example)
-                else:
-                    if key == self.target_fields[-1]: validated_translate_data.append(example)
+        validated_translate_data = self.filter_translatable(self.converted_data)
 
         print(f"\nTotal data left after filtering for translation: {len(validated_translate_data)}\n")
         self.converted_data = validated_translate_data
 
+    @staticmethod
+    def iter_buffers(iterable: Iterable, buffer_size: int) -> Iterator[List]:
+        """Lazily split any iterable (list, generator, streamed dataset) into lists of at most buffer_size items"""
+        iterator = iter(iterable)
+        while True:
+            buffer = list(islice(iterator, buffer_size))
+            if not buffer:
+                return
+            yield buffer
+
+    def map_convert(self, records: Iterable[Dict], convert_fn: Callable[..., Dict],
+                    split: str = "train", desc: str = None) -> Union[List[Dict], Iterator[Dict]]:
+        """
+        Convert every record with convert_fn(data, index=..., split=...), shard by shard, in a process pool
+        of num_proc workers. The index is the record position in the split, meant for stable_id.
+        convert_fn must be picklable (a module level function), each shard reseeds `random` from
+        (seed, split, shard index) so the converted data is reproducible for any num_proc.
+        Returns a generator in streaming mode, a list otherwise.
+        """
+        def convert_stream():
+            shards = self.iter_buffers(records, self.convert_shard_size)
+            progress_bar = tqdm(desc=desc if desc else f"Converting {split} data", unit=" examples")
+            if self.num_proc <= 1:
+                for shard_idx, shard in enumerate(shards):
+                    converted_shard = convert_shard(convert_fn, shard, f"{self.seed}_{split}_{shard_idx}",
+                                                    split, shard_idx * self.convert_shard_size)
+                    progress_bar.update(len(converted_shard))
+                    yield from converted_shard
+            else:
+                with ProcessPoolExecutor(max_workers=self.num_proc) as executor:
+                    pending = deque()
+                    for shard_idx, shard in enumerate(shards):
+                        pending.append(executor.submit(convert_shard, convert_fn, shard,
+                                                       f"{self.seed}_{split}_{shard_idx}",
+                                                       split, shard_idx * self.convert_shard_size))
+                        # Bound the in-flight shards so streamed records are not all pulled into memory
+                        if len(pending) >= 2 * self.num_proc:
+                            converted_shard = pending.popleft().result()
+                            progress_bar.update(len(converted_shard))
+                            yield from converted_shard
+                    while pending:
+                        converted_shard = pending.popleft().result()
+                        progress_bar.update(len(converted_shard))
+                        yield from converted_shard
+            progress_bar.close()
+
+        return convert_stream() if self.streaming else list(convert_stream())
+
     @staticmethod
     def id_generator(size=6, chars=string.ascii_uppercase + string.digits) -> str:
+        # Random ids collide at scale and change between runs, prefer stable_id for new parsers
         return ''.join(random.choice(chars) for _ in range(size))
 
+    @staticmethod
+    def stable_id(source: str, split: str, index: int, content: str = "") -> str:
+        """
+        Deterministic qas_id hashed (xxh3 128 bits) from the source dataset, the split, the index of the
+        example in that split and its content. Re-running a parser gives the same ids, so caches, dedup and
+        resumed runs can key on qas_id.
+        """
+        return xxhash.xxh3_128_hexdigest(f"{source}\x1f{split}\x1f{index}\x1f{content}".encode('utf-8'))
+
+    @staticmethod
+    def generate_ids(source: str, split: str, contents: Iterable[str], start_index: int = 0) -> List[str]:
+        """
+        Bulk version of stable_id for the contents of one split (indices from start_index), the same ids as
+        stable_id row by row with the source and split prefix hashed once.
+        """
+        prefix_hasher = xxhash.xxh3_128()
+        prefix_hasher.update(f"{source}\x1f{split}\x1f".encode('utf-8'))
+        ids = []
+        for index, content in enumerate(contents, start=start_index):
+            hasher = prefix_hasher.copy()
+            hasher.update(f"{index}\x1f{content}".encode('utf-8'))
+            ids.append(hasher.hexdigest())
+        return ids
+
     def inject_random_ctx(self, docs: List[str], max_docs: int = 9, random_range: int = 20) -> List[str]:
         assert self.do_ctx_augmentation, "Please enable context augmentation via self.do_ctx_augmentation"
         assert not self.do_translate, "Please inject random ctx after translation as the dataset for random ctxs " \
@@ -134,9 +251,6 @@ class DataParser(metaclass=ForceBaseCallMeta):
         if len(docs) == max_docs:
             return docs
 
-        def rm_underscore(data: str) -> str:
-            return re.sub('_', " ", data)
-
         max_dataset_len = len(self.ctx_wiki_dataset)
         idx = random.randint(0, abs(max_dataset_len - random_range))
         random_docs_num = random.randint(1, abs(max_docs - len(docs)))
@@ -150,7 +264,7 @@ class DataParser(metaclass=ForceBaseCallMeta):
         )
         texts = text_splitter.create_documents(self.ctx_wiki_dataset['segmented_text'][idx:idx + random_range])
         texts = random.choices(texts, k=random_docs_num)
-        random_docs = [rm_underscore(text.page_content) for text in texts]
+        random_docs = normalize_texts([text.page_content for text in texts])
 
         random_pos = random.randint(0, len(random_docs))
         final_random_docs_ctx = random_docs[:random_pos] + docs + random_docs[random_pos:]
@@ -332,40 +446,110 @@ class DataParser(metaclass=ForceBaseCallMeta):
         assert os.path.isfile(self.file_path), f"Invalid path file for {self.file_path}"
         pass
 
+    def get_writer(self, output_path: str, schema_keys: List[str] = None) -> DataWriter:
+        if self.output_format == "jsonl":
+            return JsonlWriter(output_path,
+                               schema_keys=schema_keys,
+                               batch_size=self.write_batch_size,
+                               compression=self.output_compression)
+        # The columnar schema is derived from the target config, so every schema key is required
+        return ArrowWriter(output_path,
+                           self.target_config,
+                           output_format=self.output_format,
+                           batch_size=self.write_batch_size,
+                           compression=self.output_compression)
+
+    def apply_filters(self) -> None:
+        """Run the filter pipeline over self.converted_data, lazily in streaming mode"""
+        if self.streaming:
+            self.converted_data = self.filter_pipeline.filter_stream(self.iter_buffers(self.converted_data,
+                                                                                       self.stream_buffer_size))
+        else:
+            self.converted_data = self.filter_pipeline.filter(self.converted_data)
+            self.filter_pipeline.report()
+
+    def save_stream(self, output_path: str) -> None:
+        """Consume self.converted_data lazily, only stream_buffer_size examples are held in memory at a time.
+        Each buffer is written, filtered for translation, translated and written to the translated file
+        before the next one is pulled from the generator"""
+        assert self.converted_data is not None, "Please implement the convert function for DataParser " \
+                                                "and assign converted_data to self.converted_data"
+        output_translated_path = os.path.join(self.output_dir, f"{self.parser_type}_translated.json")
+        schema_keys = self.target_config.get_keys()
+        with self.get_writer(output_path, schema_keys) as writer, \
+                self.get_writer(output_translated_path, schema_keys) if self.do_translate else nullcontext() as translated_writer:
+            print(f"\n Streaming {self.parser_type} to {writer.output_path}"
+                  f" in buffers of {self.stream_buffer_size} examples... ")
+            progress_bar = tqdm(desc="Writing streamed data to file", unit=" examples")
+            for buffer in self.iter_buffers(self.converted_data, self.stream_buffer_size):
+                writer.write_batch(buffer)
+                progress_bar.update(len(buffer))
+
+                if self.do_translate:
+                    translate_buffer = self.filter_translatable(buffer, disable_progress=True)
+                    if not translate_buffer:
+                        continue
+                    self.converted_data_translated = None
+                    self.translate_converted(large_chunk=translate_buffer)
+                    assert self.converted_data_translated is not None, "Converted data haven't been translated yet!"
+                    translated_writer.write_batch(self.converted_data_translated)
+                    self.converted_data_translated = None
+            progress_bar.close()
+
+        print(f"\n Total line printed: {writer.total_rows}")
+        if self.do_translate:
+            print(f"\n Total translated line printed: {translated_writer.total_rows} to {translated_writer.output_path}")
+
+        if IN_COLAB:
+            print(f"\n Downloading converted data to local machine...")
+            files.download(writer.output_path)
+            if self.do_translate:
+                files.download(translated_writer.output_path)
+
     @property
     @force_super_call
     @timeit
     def save(self) -> None:
         output_path = os.path.join(self.output_dir, f"{self.parser_type}.json")
-        with open(output_path, 'w', encoding='utf-8') as jfile:
-            print(f"\n Saving {self.parser_type} to {output_path}... ")
-            validated_data = []
-            for idx, data in enumerate(tqdm(self.converted_data, desc="Writing data to file")):
-                if self.validate(self.converted_data[idx].keys(), self.target_config):
-                    # validated_data.append(data)
-                    jfile.write(json.dumps(data, ensure_ascii=False) + "\n")
-            # json.dump(validated_data, jfile, ensure_ascii=False, indent=4)
-            print(f"\n Total line printed: {idx + 1}")
+        if self.filter_pipeline is not None:
+            self.apply_filters()
+        if self.streaming:
+            self.save_stream(output_path)
+            if self.filter_pipeline is not None:
+                self.filter_pipeline.report()
+            return None
+
+        schema_keys = self.target_config.get_keys()
+        with self.get_writer(output_path, schema_keys) as writer:
+            print(f"\n Saving {self.parser_type} to {writer.output_path}... ")
+            writer.write(self.converted_data, desc="Writing data to file")
+            print(f"\n Total line printed: {writer.total_rows}")
 
         if IN_COLAB:
             print(f"\n Downloading converted data to local machine...")
-            files.download(output_path)
+            files.download(writer.output_path)
 
         if self.do_translate:
             self.post_translate_validate()
             self.translate_converted()
             assert self.converted_data_translated is not None, "Converted data haven't been translated yet!"
             output_translated_path = os.path.join(self.output_dir, f"{self.parser_type}_translated.json")
-            with open(output_translated_path, 'w', encoding='utf-8') as jfile:
-                print(f"\n Saving {self.parser_type} translated to {output_translated_path}... ")
-                translated_data = []
-                for idx, data in enumerate(tqdm(self.converted_data_translated, desc="Writing translated data to file")):
-                    # translated_data.append(data)
-                    jfile.write(json.dumps(data, ensure_ascii=False) + "\n")
-                # json.dump(translated_data, jfile, ensure_ascii=False, indent=4)
-                print(f"\n Total line printed: {idx + 1}")
+            with self.get_writer(output_translated_path, schema_keys) as writer:
+                print(f"\n Saving {self.parser_type} translated to {writer.output_path}... ")
+                writer.write(self.converted_data_translated, desc="Writing translated data to file")
+                print(f"\n Total line printed: {writer.total_rows}")
 
             if IN_COLAB:
                 print(f"\n Downloading converted translated data to local machine...")
-                files.download(output_translated_path)
-
+                files.download(writer.output_path)
+
+
+if __name__ == "__main__":
+    # The bulk ids are the per row ids, unique over a large split
+    contents = [f"question {idx % 1000}" for idx in range(200000)]
+    ids = DataParser.generate_ids("ELI5", "train", contents, start_index=5)
+    assert ids == [DataParser.stable_id("ELI5", "train", index, content)
+                   for index, content in enumerate(contents, start=5)]
+    assert len(set(ids)) == len(ids), "Duplicated ids in the split"
+    assert DataParser.generate_ids("ELI5", "validation", contents[:10], start_index=5) != ids[:10]
+    print(f"generate_ids matches stable_id on {len(ids)} unique ids")
@@ -57,11 +57,11 @@ class DataBricksDolly15k(DataParser):
             "For a Deeper Understanding:"
         ]
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 # Randomly assign generic system prompt to data
                 data_dict['system_prompt'] = QA_TEMPLATE().get_generic_system_prompt(random.randint(1, 20)) if bool(random.getrandbits(1)) else ""
-                data_dict['qas_id'] = self.id_generator(size=4) + f"_{data['category']}"
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['instruction']) + f"_{data['category']}"
 
                 if len(data['context']) != 0:
                     doc_prefix = random.choice(docs_prefix)
@@ -80,11 +80,11 @@ class MathQA(DataParser):
 
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 data_dict['system_prompt'] = random.choice(math_qa_system_prompts)
 
-                data_dict['qas_id'] = self.id_generator()
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['Problem'])
                 data_dict['question_text'] = data['Problem']
 
                 data_dict['question_text'] += f"\n Here are the options, please choose one answer only:\n"
@@ -7,6 +7,7 @@ from tqdm.auto import tqdm
 
 from typing import List, Dict, Union
 from functools import partialmethod
+from itertools import chain
 
 from datasets import load_dataset
 
@@ -16,12 +17,96 @@ from src.data.configs import AdvanceInstructSample
 
 PARSER_TYPE = "MTEngVietnamese"
 
+TRANSLATION_EN2VI_PREFIX = [
+    "Translate this sentence to Vietnamese for me:\n",
+    "Can you translate this English sentence to Vietnamese?",
+    "Translate this message to Vietnamese:",
+    "What does this say in Vietnamese?\n",
+    "Please help me with this translation to vietnamese:",
+    "I need a Vietnamese translation for the following:",
+    "In Vietnamese, how would you say:\n",
+    "Could you provide a Vietnamese translation for:",
+    "I'm looking for the Vietnamese version of:",
+    "Translate this English text to Vietnamese:",
+    "I'd like to get this sentence translated into Vietnamese:\n",
+    "How do you say this in Vietnamese?\n",
+    "Convert this to Vietnamese, please:",
+    "Translate the following to Vietnamese:",
+    "In Vietnamese, the phrase should be:",
+    "Could you do a Vietnamese translation for:",
+    "I need a Vietnamese version of this:\n",
+]
+TRANSLATION_VI2EN_PREFIX = [
+    "Dịch câu này sang tiếng Anh giúp tôi:\n",
+    "Bạn có thể dịch câu tiếng Việt này sang tiếng Anh được không?\n",
+    "Dịch tin nhắn này sang tiếng Anh:",
+    "Cái này nói tiếng Anh là gì?",
+    "Hãy giúp tôi dịch câu nói này sang tiếng anh:",
+    "Tôi cần một bản dịch tiếng Anh cho cái này:\n",
+    "Bằng tiếng Anh, câu này sẽ như thế nào:\n",
+    "Bạn có thể cung cấp bản dịch tiếng Anh cho:",
+    "Tôi đang tìm phiên bản tiếng Anh của:",
+    "Dịch đoạn văn tiếng Việt này sang tiếng Anh giúp tôi:",
+    "Có thể dịch đoạn tiếng Việt này sang tiếng Anh giúp tôi được không?",
+    "Dịch thư này sang tiếng Anh:\n",
+    "Cái này nói tiếng Anh làm sao?\n",
+    "Xin bạn giúp tôi dịch đoạn này sang tiếng Anh:",
+    "Tôi cần một bản dịch tiếng Anh cho đoạn sau:\n",
+    "Bằng tiếng Anh, đoạn văn này sẽ như thế nào:",
+    "Bạn có thể cung cấp bản dịch tiếng Anh cho:",
+    "Tôi đang tìm phiên bản tiếng Anh của đoạn văn này:\n",
+]
+TRANSLATION_SYSTEM_PROMPT = [
+    "You're an AI assistant with expertise in translation.",
+    "As a translation specialist AI, you can help with language conversions.",
+    "Your area of expertise lies in translation services.",
+    "Specializing in translation, you're here to assist with language conversions.",
+    "You excel in the field of translation and language conversion.",
+    "You are a language translation expert AI.",
+    "Your specialization is in translation across different languages.",
+    "Your primary skill is in translating text from one language to another.",
+    "As an AI language translation expert, you can help with translation requests.",
+    "Your primary focus is on facilitating language translation tasks.",
+    "You're here to make language translation easy and efficient.",
+    "As a translation expert AI, you're dedicated to helping with language conversions.",
+    "You specialize in breaking language barriers through translation.",
+    "You excel at bridging communication gaps by providing translation services.",
+    "Your expertise is in transforming text from one language to another.",
+    "You're equipped to handle a wide range of translation needs.",
+    "Language translation is your forte, and you're here to assist.",
+    "You're well-versed in the art of translating languages.",
+    "You have a deep understanding of language translation and can assist with various requests.",
+]
+
+
+def convert_example(data: Dict, index: int, split: str) -> Dict:
+    translate_task = "en2vi" if bool(random.getrandbits(1)) else "vi2en"
+    data_dict = {}
+    # Randomly assign generic system prompt to data
+    data_dict['system_prompt'] = random.choice(TRANSLATION_SYSTEM_PROMPT)
+    data_dict['qas_id'] = DataParser.stable_id(PARSER_TYPE, split, index,
+                                               data['translation']["en"]) + "_" + translate_task
+
+    if translate_task == "en2vi":
+        en2vi_prefix = random.choice(TRANSLATION_EN2VI_PREFIX)
+        data_dict['question_text'] = en2vi_prefix + " " + data['translation']["en"]
+        data_dict['orig_answer_texts'] = data['translation']["vi"]
+
+    if translate_task == "vi2en":
+        vi2en_prefix = random.choice(TRANSLATION_VI2EN_PREFIX)
+        data_dict['question_text'] = vi2en_prefix + " " + data['translation']["vi"]
+        data_dict['orig_answer_texts'] = data['translation']["en"]
+
+    data_dict['answer_lengths'] = None
+    return data_dict
+
 
 class MTEngVietnamese(DataParser):
-    def __init__(self, file_path: str, output_path: str):
+    def __init__(self, file_path: str, output_path: str, num_proc: int = 1):
         super().__init__(file_path, output_path,
                          parser_type=PARSER_TYPE,
-                         do_translate=False)
+                         do_translate=False,
+                         num_proc=num_proc)
         self.target_config = AdvanceInstructSample
 
     def read(self):
@@ -33,89 +118,10 @@ class MTEngVietnamese(DataParser):
     def convert(self):
         super(MTEngVietnamese, self).convert()
 
-        data_converted = []
-        translation_en2vi_prefix = [
-            "Translate this sentence to Vietnamese for me:\n",
-            "Can you translate this English sentence to Vietnamese?",
-            "Translate this message to Vietnamese:",
-            "What does this say in Vietnamese?\n",
-            "Please help me with this translation to vietnamese:",
-            "I need a Vietnamese translation for the following:",
-            "In Vietnamese, how would you say:\n",
-            "Could you provide a Vietnamese translation for:",
-            "I'm looking for the Vietnamese version of:",
-            "Translate this English text to Vietnamese:",
-            "I'd like to get this sentence translated into Vietnamese:\n",
-            "How do you say this in Vietnamese?\n",
-            "Convert this to Vietnamese, please:",
-            "Translate the following to Vietnamese:",
-            "In Vietnamese, the phrase should be:",
-            "Could you do a Vietnamese translation for:",
-            "I need a Vietnamese version of this:\n",
-        ]
-        translation_vi2en_prefix = [
-            "Dịch câu này sang tiếng Anh giúp tôi:\n",
-            "Bạn có thể dịch câu tiếng Việt này sang tiếng Anh được không?\n",
-            "Dịch tin nhắn này sang tiếng Anh:",
-            "Cái này nói tiếng Anh là gì?",
-            "Hãy giúp tôi dịch câu nói này sang tiếng anh:",
-            "Tôi cần một bản dịch tiếng Anh cho cái này:\n",
-            "Bằng tiếng Anh, câu này sẽ như thế nào:\n",
-            "Bạn có thể cung cấp bản dịch tiếng Anh cho:",
-            "Tôi đang tìm phiên bản tiếng Anh của:",
-            "Dịch đoạn văn tiếng Việt này sang tiếng Anh giúp tôi:",
-            "Có thể dịch đoạn tiếng Việt này sang tiếng Anh giúp tôi được không?",
-            "Dịch thư này sang tiếng Anh:\n",
-            "Cái này nói tiếng Anh làm sao?\n",
-            "Xin bạn giúp tôi dịch đoạn này sang tiếng Anh:",
-            "Tôi cần một bản dịch tiếng Anh cho đoạn sau:\n",
-            "Bằng tiếng Anh, đoạn văn này sẽ như thế nào:",
-            "Bạn có thể cung cấp bản dịch tiếng Anh cho:",
-            "Tôi đang tìm phiên bản tiếng Anh của đoạn văn này:\n",
-        ]
-        translation_system_prompt = [
-            "You're an AI assistant with expertise in translation.",
-            "As a translation specialist AI, you can help with language conversions.",
-            "Your area of expertise lies in translation services.",
-            "Specializing in translation, you're here to assist with language conversions.",
-            "You excel in the field of translation and language conversion.",
-            "You are a language translation expert AI.",
-            "Your specialization is in translation across different languages.",
-            "Your primary skill is in translating text from one language to another.",
-            "As an AI language translation expert, you can help with translation requests.",
-            "Your primary focus is on facilitating language translation tasks.",
-            "You're here to make language translation easy and efficient.",
-            "As a translation expert AI, you're dedicated to helping with language conversions.",
-            "You specialize in breaking language barriers through translation.",
-            "You excel at bridging communication gaps by providing translation services.",
-            "Your expertise is in transforming text from one language to another.",
-            "You're equipped to handle a wide range of translation needs.",
-            "Language translation is your forte, and you're here to assist.",
-            "You're well-versed in the art of translating languages.",
-            "You have a deep understanding of language translation and can assist with various requests.",
-        ]
-        for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
-                translate_task = "en2vi" if bool(random.getrandbits(1)) else "vi2en"
-                data_dict = {}
-                # Randomly assign generic system prompt to data
-                data_dict['system_prompt'] = random.choice(translation_system_prompt)
-                data_dict['qas_id'] = self.id_generator(size=4) +"_"+ translate_task
-
-                if translate_task == "en2vi":
-                    en2vi_prefix = random.choice(translation_en2vi_prefix)
-                    data_dict['question_text'] = en2vi_prefix + " " + data['translation']["en"]
-                    data_dict['orig_answer_texts'] = data['translation']["vi"]
-
-                if translate_task == "vi2en":
-                    vi2en_prefix = random.choice(translation_vi2en_prefix)
-                    data_dict['question_text'] = vi2en_prefix + " " + data['translation']["vi"]
-                    data_dict['orig_answer_texts'] = data['translation']["en"]
-
-                data_dict['answer_lengths'] = None
-                data_converted.append(data_dict)
-
-        self.converted_data = data_converted
+        converted_splits = [self.map_convert(self.data_read[split], convert_example, split=split)
+                            for split in self.data_read]
+        self.converted_data = chain.from_iterable(converted_splits) if self.streaming \
+            else list(chain.from_iterable(converted_splits))
 
         pass
 
@@ -33,11 +33,11 @@ class VilmLimaVi(DataParser):
         super(VilmLimaVi, self).convert()
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 # Randomly assign generic system prompt to data
                 data_dict['system_prompt'] = QA_TEMPLATE().get_generic_system_prompt(random.randint(1, 20)) if bool(random.getrandbits(1)) else ""
-                data_dict['qas_id'] = self.id_generator(size=6)
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['question'])
                 data_dict['question_text'] = data['question']
                 data_dict['orig_answer_texts'] = data['answer']
                 data_dict['answer_lengths'] = None
@@ -31,11 +31,11 @@ class AlpacaCleaned(DataParser):
         super(AlpacaCleaned, self).convert()
         data_converted = []
         for split in self.data_read:
-            for data in tqdm(self.data_read[split], desc=f"Converting {split} data"):
+            for idx, data in enumerate(tqdm(self.data_read[split], desc=f"Converting {split} data")):
                 data_dict = {}
                 # Randomly assign generic system prompt to data
                 data_dict['system_prompt'] = QA_TEMPLATE().get_generic_system_prompt(random.randint(1, 20)) if bool(random.getrandbits(1)) else ""
-                data_dict['qas_id'] = self.id_generator()
+                data_dict['qas_id'] = self.stable_id(self.parser_type, split, idx, data['instruction'] + data['input'])
                 data_dict['question_text'] = data['instruction'] + "\n" + data['input']
 
                 data_dict['orig_answer_texts'] = data['output']
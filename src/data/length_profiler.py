@@ -0,0 +1,274 @@
+import os
+import sys
+import glob
+import json
+import math
+import inspect
+import argparse
+import dataclasses
+from itertools import islice
+from functools import partial
+from typing import List, Dict, Tuple, Iterator, Sequence, Union
+sys.path.insert(0, r'./')
+
+import numpy as np
+from tqdm.auto import tqdm
+from transformers import AutoTokenizer
+
+from src.data.configs import AdvanceQAExample, AdvanceInstructSample
+from src.data.packing import first_fit_decreasing
+from src.data.samplers import LengthGroupedBatchSampler
+from src.data.streaming import iter_records
+from src.data.tokenized_dataset import map_tokenizer_chunks
+
+
+DEFAULT_DATA_FILES = "src/data/features/final_storge_converted/*/*.json"
+RECORD_FIELDS = ("system_prompt", "question_text", "orig_answer_texts")
+QA_RECORD_FIELDS = ("question_text", "doc_tokens", "orig_answer_texts")
+# The record configs of the dataloader (--config_type) with the record fields profiled by default
+CONFIG_TYPES = {"AdvanceInstructSample": (AdvanceInstructSample, RECORD_FIELDS),
+                "AdvanceQAExample": (AdvanceQAExample, QA_RECORD_FIELDS)}
+
+
+def get_text(value: Union[str, List[str], None]) -> str:
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else "\n".join(value)
+
+
+def count_tokens(texts: List[str], tokenizer, add_special_tokens: bool = True) -> np.ndarray:
+    input_ids = tokenizer(texts, add_special_tokens=add_special_tokens, return_attention_mask=False)["input_ids"]
+    return np.fromiter((len(token_ids) for token_ids in input_ids), dtype=np.int32, count=len(input_ids))
+
+
+def build_train_inputs(records: List[Dict], config_type, task_type: str) -> List[Dict]:
+    """
+    The train inputs of the records built by config_type, from the record keys that are fields of the config
+    (AdvanceQAExample records may carry keys of other configs, its get_example takes no task_type)
+    """
+    config_fields = dataclasses.fields(config_type)
+    field_names = {config_field.name for config_field in config_fields}
+    required_fields = {config_field.name for config_field in config_fields
+                       if config_field.default is dataclasses.MISSING and config_field.default_factory is dataclasses.MISSING}
+    example_kwargs = {"is_training": True}
+    if "task_type" in inspect.signature(config_type.get_example).parameters:
+        example_kwargs["task_type"] = task_type
+    inputs = []
+    for record in records:
+        missing_fields = required_fields - record.keys()
+        assert not missing_fields, f"Record {record.get('qas_id')} misses the {sorted(missing_fields)} fields of " \
+                                   f"{config_type.__name__}, please pass the --config_type of the data files"
+        config_data = config_type(**{key: value for key, value in record.items() if key in field_names})
+        inputs.append(config_data.get_example(**example_kwargs))
+    return inputs
+
+
+def profile_chunk(chunk: Tuple[int, List[Dict]], task_type: str, record_fields: Sequence[str],
+                  config_type=AdvanceInstructSample, tokenizer=None) -> Tuple[int, Dict[str, np.ndarray]]:
+    """
+    Token lengths of a chunk of records of one source: the record fields on their own (without special tokens)
+    and the model inputs built by config_type like AdvanceQa does for the train split (prompt + eos for CAUSAL_LM,
+    prompt and target for SEQ_2_SEQ_LM)
+    """
+    source_idx, records = chunk
+    lengths = {field: count_tokens([get_text(record.get(field)) for record in records], tokenizer,
+                                   add_special_tokens=False)
+               for field in record_fields}
+    inputs = build_train_inputs(records, config_type, task_type)
+    eos_suffix = f" {tokenizer.eos_token}" if task_type == "CAUSAL_LM" else ""
+    for column in inputs[0]:
+        lengths[column] = count_tokens([config_data[column] + eos_suffix * (column == "prompt")
+                                        for config_data in inputs], tokenizer)
+    return source_idx, lengths
+
+
+def iter_record_chunks(data_files: List[str], chunk_size: int,
+                       max_examples: int = None) -> Iterator[Tuple[int, List[Dict]]]:
+    for source_idx, data_file in enumerate(data_files):
+        records = islice(iter_records(data_file), max_examples)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            yield source_idx, chunk
+
+
+def length_histogram(lengths: np.ndarray) -> Dict[str, int]:
+    """Number of lengths in each power of two bucket, [0, 16) then [16, 32), [32, 64)..."""
+    max_length = int(lengths.max()) if len(lengths) else 0
+    edges = [0, 16]
+    while edges[-1] <= max_length:
+        edges.append(2 * edges[-1])
+    counts, _ = np.histogram(lengths, bins=edges)
+    return {f"[{start}, {end})": int(count) for start, end, count in zip(edges[:-1], edges[1:], counts)}
+
+
+def length_stats(lengths: np.ndarray, model_max_length: int) -> Dict:
+    if not len(lengths):
+        return {"examples": 0}
+    percentiles = np.percentile(lengths, [50, 90, 95, 99])
+    return {"examples": len(lengths),
+            "tokens": int(lengths.sum()),
+            "mean": float(lengths.mean()),
+            "p50": float(percentiles[0]), "p90": float(percentiles[1]),
+            "p95": float(percentiles[2]), "p99": float(percentiles[3]),
+            "max": int(lengths.max()),
+            "over_max_length": float((lengths > model_max_length).mean()),
+            "histogram": length_histogram(lengths)}
+
+
+def padding_stats(lengths: np.ndarray, batch_sizes: Sequence[int], seed: int = 42) -> Dict[int, Dict[str, float]]:
+    """
+    Pad token ratio of batches padded to their longest example, drawn at random or grouped by length
+    (--group_by_length), with the padded tokens of a batch to size the batch size to the memory
+    """
+    stats = {}
+    for batch_size in batch_sizes:
+        report = LengthGroupedBatchSampler(lengths, batch_size=batch_size, seed=seed).padding_report()
+        real_tokens_per_batch = float(lengths.mean()) * batch_size
+        for key in ("random", "grouped"):
+            report[f"{key}_padded_tokens_per_batch"] = real_tokens_per_batch / (1 - report[f"{key}_padding_ratio"])
+        stats[batch_size] = report
+    return stats
+
+
+def packing_stats(lengths: np.ndarray, block_sizes: Sequence[int]) -> Dict[int, Dict[str, float]]:
+    """Rows of --do_packing for each block size, with the fraction of the row tokens that are example tokens"""
+    stats = {}
+    for block_size in block_sizes:
+        _, bin_offsets = first_fit_decreasing(lengths, block_size)
+        num_rows = len(bin_offsets) - 1
+        stats[block_size] = {"rows": num_rows,
+                             "examples_per_row": len(lengths) / max(num_rows, 1),
+                             "packing_efficiency": float(np.minimum(lengths, block_size).sum()) / max(num_rows * block_size, 1),
+                             "oversized": int((lengths > block_size).sum())}
+    return stats
+
+
+def suggest_max_length(lengths: np.ndarray, coverage: float, multiple_of: int = 64) -> int:
+    """The shortest multiple of multiple_of keeping coverage of the examples"""
+    return int(math.ceil(np.quantile(lengths, coverage) / multiple_of) * multiple_of) if len(lengths) else 0
+
+
+def profile_corpus(data_files: List[str], tokenizer, task_type: str = "CAUSAL_LM", model_max_length: int = 1024,
+                   batch_sizes: Sequence[int] = (4,), block_sizes: Sequence[int] = None,
+                   config_type: str = "AdvanceInstructSample", record_fields: Sequence[str] = None, max_examples: int = None,
+                   chunk_size: int = 1000, num_proc: int = 1, coverage: float = 0.99, seed: int = 42) -> Dict:
+    """
+    Token length statistics of the parser outputs for every source and for the whole mix (all the records of the
+    files, or the first max_examples of each): length percentiles, histogram and fraction over model_max_length of
+    every field, then on the train input the padding waste for each batch size and, for CAUSAL_LM, the packing
+    efficiency for each block size. Like the dataloader, the padding and the packing only count the CAUSAL_LM
+    examples that fit in model_max_length (the others are skipped) and the SEQ_2_SEQ_LM inputs truncated to it.
+    The records are read in chunks of chunk_size and tokenized over num_proc processes, the inputs are built by
+    config_type (a name of CONFIG_TYPES, whose record fields are profiled when record_fields is None).
+    """
+    for data_file in data_files:
+        assert os.path.isfile(data_file), f"Invalid data path for {data_file}"
+    assert config_type in CONFIG_TYPES, f"Unsupported config type {config_type}, please choose one of {list(CONFIG_TYPES)}"
+    config_type, default_record_fields = CONFIG_TYPES[config_type]
+    record_fields = record_fields or default_record_fields
+    block_sizes = block_sizes or [model_max_length]
+    source_names = [os.path.basename(data_file) for data_file in data_files]
+    source_lengths: List[Dict[str, List[np.ndarray]]] = [{} for _ in data_files]
+    chunks = iter_record_chunks(data_files, chunk_size, max_examples)
+    profile_function = partial(profile_chunk, task_type=task_type, record_fields=tuple(record_fields),
+                               config_type=config_type)
+    for source_idx, chunk_lengths in tqdm(map_tokenizer_chunks(profile_function, chunks, tokenizer, num_proc),
+                                          desc="Profiling token lengths", unit="chunk"):
+        for field, lengths in chunk_lengths.items():
+            source_lengths[source_idx].setdefault(field, []).append(lengths)
+
+    source_lengths = [{field: np.concatenate(lengths) for field, lengths in field_lengths.items()}
+                      for field_lengths in source_lengths]
+    fields = list(next((field_lengths for field_lengths in source_lengths if field_lengths), {}))
+    all_lengths = {field: np.concatenate([field_lengths[field] for field_lengths in source_lengths
+                                          if field in field_lengths]) for field in fields}
+
+    profiles = {}
+    for name, field_lengths in list(zip(source_names, source_lengths)) + [("all", all_lengths)]:
+        profile = {"fields": {field: length_stats(lengths, model_max_length) for field, lengths in field_lengths.items()}}
+        if "prompt" in field_lengths and len(field_lengths["prompt"]):
+            input_lengths = field_lengths["prompt"].astype(np.int64)
+            input_lengths = input_lengths[input_lengths <= model_max_length] if task_type == "CAUSAL_LM" \
+                else np.minimum(input_lengths, model_max_length)
+            if len(input_lengths):
+                profile["padding"] = padding_stats(input_lengths, batch_sizes, seed=seed)
+                if task_type == "CAUSAL_LM":
+                    profile["packing"] = packing_stats(input_lengths, block_sizes)
+        profiles[name] = profile
+
+    if len(all_lengths.get("prompt", [])):
+        profiles["all"]["suggested_model_max_length"] = suggest_max_length(all_lengths["prompt"], coverage)
+        profiles["all"]["coverage"] = coverage
+    return profiles
+
+
+def format_profile(name: str, profile: Dict, model_max_length: int) -> str:
+    lines = [f"===== {name} ====="]
+    for field, stats in profile["fields"].items():
+        if not stats["examples"]:
+            lines.append(f"  {field}: no examples")
+            continue
+        lines.append(f"  {field}: {stats['examples']} examples, {stats['tokens']} tokens, mean {stats['mean']:.1f}, "
+                     f"p50 {stats['p50']:.0f}, p90 {stats['p90']:.0f}, p95 {stats['p95']:.0f}, p99 {stats['p99']:.0f}, "
+                     f"max {stats['max']}, {stats['over_max_length']:.2%} over {model_max_length}")
+        largest_count = max(stats["histogram"].values())
+        for bucket, count in stats["histogram"].items():
+            lines.append(f"    {bucket:>14} {count:>9} {count / stats['examples']:>7.2%} "
+                         f"{'#' * math.ceil(40 * count / largest_count) if count else ''}")
+    for batch_size, stats in profile.get("padding", {}).items():
+        lines.append(f"  batch size {batch_size}: padding {stats['random_padding_ratio']:.2%} random "
+                     f"({stats['random_padded_tokens_per_batch']:.0f} tokens per batch), "
+                     f"{stats['grouped_padding_ratio']:.2%} grouped by length "
+                     f"({stats['grouped_padded_tokens_per_batch']:.0f} tokens per batch)")
+    for block_size, stats in profile.get("packing", {}).items():
+        lines.append(f"  block size {block_size}: {stats['rows']} packed rows, {stats['examples_per_row']:.2f} examples "
+                     f"per row, packing efficiency {stats['packing_efficiency']:.2%}, "
+                     f"{stats['oversized']} examples longer than the block")
+    if "suggested_model_max_length" in profile:
+        lines.append(f"  model_max_length {profile['suggested_model_max_length']} keeps "
+                     f"{profile['coverage']:.1%} of the train inputs")
+    return "\n".join(lines)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Token length statistics of the parser outputs, "
+                                                 "to size model_max_length, block_size and the batch sizes")
+    parser.add_argument("--data_files", nargs='+', type=str, default=[DEFAULT_DATA_FILES],
+                        help="Parser outputs to profile, glob patterns are expanded")
+    parser.add_argument("--model_name_or_path", type=str, default="EleutherAI/gpt-neo-125m", help="Tokenizer to count the tokens with")
+    parser.add_argument("--model_type", type=str, default="CAUSAL_LM", help="Type of model to train")
+    parser.add_argument("--model_max_length", type=int, default=1024, help="The model maximum length")
+    parser.add_argument("--batch_sizes", nargs='+', type=int, default=[1, 4, 8, 16], help="Batch sizes to compute the padding waste for")
+    parser.add_argument("--block_sizes", nargs='+', type=int, default=None,
+                        help="Block sizes to compute the packing efficiency for, model_max_length by default")
+    parser.add_argument("--config_type", type=str, default="AdvanceInstructSample", choices=list(CONFIG_TYPES),
+                        help="Record config building the model inputs, as the dataloader's config_type")
+    parser.add_argument("--fields", nargs='+', type=str, default=None,
+                        help="Record fields to profile, the fields of the config type by default")
+    parser.add_argument("--max_examples", type=int, default=None, help="Only profile the first examples of each file")
+    parser.add_argument("--tokenize_batch_size", type=int, default=1000, help="Number of records tokenized per call")
+    parser.add_argument("--num_proc", type=int, default=os.cpu_count(), help="Number of tokenization processes")
+    parser.add_argument("--coverage", type=float, default=0.99,
+                        help="Fraction of the train inputs the suggested model_max_length should keep")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random batches")
+    parser.add_argument("--output_json", type=str, default=None, help="Also write the statistics to this json file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    data_files = sorted({data_file for pattern in args.data_files for data_file in glob.glob(pattern)})
+    assert data_files, f"No data files matching {args.data_files}"
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    profiles = profile_corpus(data_files, tokenizer, task_type=args.model_type,
+                              model_max_length=args.model_max_length, batch_sizes=args.batch_sizes,
+                              block_sizes=args.block_sizes, config_type=args.config_type, record_fields=args.fields,
+                              max_examples=args.max_examples, chunk_size=args.tokenize_batch_size,
+                              num_proc=args.num_proc, coverage=args.coverage, seed=args.seed)
+    for name, profile in profiles.items():
+        print(format_profile(name, profile, args.model_max_length))
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as output_file:
+            json.dump(profiles, output_file, ensure_ascii=False, indent=2)
@@ -0,0 +1,192 @@
+import sys
+import heapq
+from typing import List, Dict, Tuple, Optional, Sequence
+sys.path.insert(0, r'./')
+
+import numpy as np
+import torch
+
+from src.data.samplers import ResumableBatchSampler
+
+
+class TokenMixture:
+    """
+    Online token-share scheduler over data sources. The target share of each source is its weight ** (1 / temperature)
+    normalized, a temperature above 1 flattens the mix toward uniform and below 1 sharpens it toward the heaviest
+    sources. next_source is always the source furthest behind its target (fewest consumed tokens for its share),
+    so the realized token mix follows the target all along the epoch whatever the example lengths of the sources.
+    Consume the source returned by next_source with update, drop the sources that cannot provide examples anymore,
+    next_source raises a RuntimeError naming them once they are all dropped.
+    """
+    def __init__(self, weights: Sequence[float], temperature: float = 1.0, names: Sequence[str] = None) -> None:
+        weights = np.asarray(weights, dtype=np.float64)
+        assert len(weights) and (weights >= 0).all() and weights.sum() > 0, f"Invalid mixture weights {weights.tolist()}"
+        assert temperature > 0, "The mixture temperature must be positive"
+        shares = weights ** (1 / temperature)
+        self.target_shares = (shares / shares.sum()).tolist()
+        self.names = list(names) if names else [str(source_idx) for source_idx in range(len(weights))]
+        self.consumed_tokens = [0] * len(weights)
+        self.consumed_examples = [0] * len(weights)
+        # (consumed tokens / target share, source), every source starts at 0 so the list is already a heap
+        self.heap = [(0., source_idx) for source_idx, share in enumerate(self.target_shares) if share > 0]
+        self.dropped: List[str] = []
+
+    def next_source(self) -> int:
+        if not self.heap:
+            raise RuntimeError(f"All the sources of the mixture are exhausted, no examples left in "
+                               f"{', '.join(self.dropped) if self.dropped else 'any source'}"
+                               + (f" and {len(self.target_shares) - len(self.dropped)} source(s) have a zero weight"
+                                  if len(self.dropped) < len(self.target_shares) else ""))
+        return self.heap[0][1]
+
+    def update(self, source_idx: int, num_tokens: int) -> None:
+        self.consumed_tokens[source_idx] += num_tokens
+        self.consumed_examples[source_idx] += 1
+        heapq.heapreplace(self.heap, (self.consumed_tokens[source_idx] / self.target_shares[source_idx], source_idx))
+
+    def drop(self, source_idx: int) -> None:
+        if any(entry[1] == source_idx for entry in self.heap):
+            self.dropped.append(self.names[source_idx])
+        self.heap = [entry for entry in self.heap if entry[1] != source_idx]
+        heapq.heapify(self.heap)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Target and realized token share, tokens and examples consumed of every source"""
+        total_tokens = max(sum(self.consumed_tokens), 1)
+        return {name: {"target_share": self.target_shares[source_idx],
+                       "token_share": self.consumed_tokens[source_idx] / total_tokens,
+                       "tokens": self.consumed_tokens[source_idx],
+                       "examples": self.consumed_examples[source_idx]}
+                for source_idx, name in enumerate(self.names)}
+
+
+def format_mixture_report(report: Dict[str, Dict[str, float]]) -> str:
+    lines = []
+    for name, source_report in report.items():
+        line = f"  {name}: {source_report['token_share']:.2%} of the tokens (target {source_report['target_share']:.2%}), " \
+               f"{source_report['tokens']} tokens in {source_report['examples']} examples"
+        if "passes" in source_report:
+            line += f", {source_report['passes']:.2f} passes over the source"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class TokenMixtureBatchSampler(ResumableBatchSampler):
+    """
+    Resumable batch sampler mixing the examples of several sources (source_ids) by token share instead of by example
+    count: each epoch draws as many examples as the dataset has, source by source with TokenMixture and within a
+    source in a shuffled order (seed + epoch). A source running out starts another shuffled pass so it keeps its
+    share (upsampled), the longest sources are subsampled. The weights default to the token count of each source
+    (the natural mix), epoch_weights re-weights the sources per epoch (the last weights are kept for the next epochs).
+    """
+    def __init__(self, lengths: np.ndarray, source_ids: np.ndarray, batch_size: int,
+                 weights: Sequence[float] = None, temperature: float = 1.0,
+                 epoch_weights: List[Sequence[float]] = None, source_names: List[str] = None,
+                 seed: int = 42, drop_last: bool = False) -> None:
+        super().__init__(len(lengths), batch_size, shuffle=True, seed=seed, drop_last=drop_last)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.source_ids = np.asarray(source_ids, dtype=np.int64)
+        num_sources = len(source_names) if source_names else int(self.source_ids.max()) + 1
+        self.source_names = source_names
+        self.source_indices = [np.flatnonzero(self.source_ids == source_idx) for source_idx in range(num_sources)]
+        self.weights = weights if weights is not None else \
+            [int(self.lengths[source_indices].sum()) for source_indices in self.source_indices]
+        for source_weights in [self.weights] + list(epoch_weights or []):
+            assert len(source_weights) == num_sources, f"Expected {num_sources} mixture weights, got {source_weights}"
+        self.temperature = temperature
+        self.epoch_weights = epoch_weights
+        self.cached_mixture: Tuple[Optional[int], Optional[Tuple[List[np.ndarray], TokenMixture]]] = (None, None)
+
+    def mixture_weights(self, epoch: int) -> Sequence[float]:
+        return self.epoch_weights[min(epoch, len(self.epoch_weights) - 1)] if self.epoch_weights else self.weights
+
+    def epoch_mixture(self, epoch: int) -> Tuple[List[np.ndarray], TokenMixture]:
+        """The batches of an epoch with the mixture that drew them"""
+        if self.cached_mixture[0] == epoch:
+            return self.cached_mixture[1]
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        mixture = TokenMixture(self.mixture_weights(epoch), self.temperature, self.source_names)
+        for source_idx, source_indices in enumerate(self.source_indices):
+            if not len(source_indices):
+                mixture.drop(source_idx)
+
+        lengths = self.lengths.tolist()
+        source_orders: List[List[int]] = [[] for _ in self.source_indices]
+        positions = [0] * len(self.source_indices)
+        indices = np.empty(self.num_examples, dtype=np.int64)
+        for draw_idx in range(self.num_examples):
+            source_idx = mixture.next_source()
+            if positions[source_idx] == len(source_orders[source_idx]):
+                source_indices = self.source_indices[source_idx]
+                source_orders[source_idx] = source_indices[torch.randperm(len(source_indices),
+                                                                          generator=generator).numpy()].tolist()
+                positions[source_idx] = 0
+            example_idx = source_orders[source_idx][positions[source_idx]]
+            positions[source_idx] += 1
+            indices[draw_idx] = example_idx
+            mixture.update(source_idx, lengths[example_idx])
+
+        batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        self.cached_mixture = (epoch, (batches, mixture))
+        return batches, mixture
+
+    def epoch_batches(self, epoch: int) -> List[np.ndarray]:
+        return self.epoch_mixture(epoch)[0]
+
+    def mixture_report(self, epoch: int = None) -> Dict[str, Dict[str, float]]:
+        """The realized mixture of an epoch (the current one by default), with the passes made over each source"""
+        mixture = self.epoch_mixture(self.epoch if epoch is None else epoch)[1]
+        report = mixture.report()
+        for source_report, source_indices in zip(report.values(), self.source_indices):
+            source_report["passes"] = source_report["examples"] / max(len(source_indices), 1)
+        return report
+
+
+if __name__ == "__main__":
+    import time
+
+    # Short translation pairs against long context QA: 30% of the examples are 70% of the tokens
+    rng = np.random.default_rng(42)
+    lengths = np.concatenate([rng.integers(20, 80, size=70000), rng.integers(200, 600, size=30000)])
+    source_ids = np.concatenate([np.zeros(70000, dtype=np.int64), np.ones(30000, dtype=np.int64)])
+    names = ["translation.json", "context_qa.json"]
+    for weights, temperature in ((None, 1.0), ([50, 50], 1.0), ([90, 10], 2.0)):
+        sampler = TokenMixtureBatchSampler(lengths, source_ids, batch_size=8, weights=weights,
+                                           temperature=temperature, source_names=names)
+        start_time = time.perf_counter()
+        batches = list(sampler)
+        print(f"weights {weights} temperature {temperature}: {len(batches)} batches in "
+              f"{time.perf_counter() - start_time:.2f}s\n{format_mixture_report(sampler.mixture_report(0))}")
+        report = sampler.mixture_report(0)
+        for source_report in report.values():
+            assert abs(source_report["token_share"] - source_report["target_share"]) < 1e-3
+        # The share is also met within the first steps of the epoch
+        first_indices = np.concatenate(batches[:100])
+        first_share = lengths[first_indices[source_ids[first_indices] == 0]].sum() / lengths[first_indices].sum()
+        assert abs(first_share - report[names[0]]["target_share"]) < 0.02, first_share
+        assert len(batches) == len(sampler)
+
+    # Re-weighted epochs, resumed in the middle of the second one
+    sampler = TokenMixtureBatchSampler(lengths, source_ids, batch_size=8, epoch_weights=[[80, 20], [20, 80]],
+                                       source_names=names)
+    expected = list(sampler) + list(sampler)
+    assert abs(sampler.mixture_report(1)[names[1]]["token_share"] - 0.8) < 1e-3
+    restored = TokenMixtureBatchSampler(lengths, source_ids, batch_size=8, epoch_weights=[[80, 20], [20, 80]],
+                                        source_names=names)
+    restored.load_state_dict({"epoch": 1, "seed": 42, "cursor": 1000})
+    assert list(restored) == expected[len(batches) + 1000:]
+
+    # Every source dropped: the error names them
+    mixture = TokenMixture([1, 1, 0], names=names + ["empty.json"])
+    mixture.drop(1)
+    mixture.drop(0)
+    try:
+        mixture.next_source()
+        raise AssertionError("A mixture without sources should raise")
+    except RuntimeError as e:
+        assert "context_qa.json, translation.json" in str(e), str(e)
+        print(f"Exhausted mixture: {e}")
+    print("Token mixture checks passed")
@@ -0,0 +1,324 @@
+import sys
+from typing import List, Dict, Tuple, Optional
+sys.path.insert(0, r'./')
+
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import Dataset
+
+from src.data.tokenized_dataset import TokenizedDataset
+
+
+IGNORE_INDEX = -100
+
+
+def block_attention_mask_preparer(prepare_decoder_attention_mask):
+    """Wrap a decoder's _prepare_decoder_attention_mask so a 4D additive mask is used as is, in the model dtype"""
+    def prepare(attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        if attention_mask is not None and attention_mask.dim() == 4:
+            block_mask = torch.zeros(attention_mask.shape, dtype=inputs_embeds.dtype, device=inputs_embeds.device)
+            return block_mask.masked_fill_(attention_mask.to(inputs_embeds.device) < 0, torch.finfo(inputs_embeds.dtype).min)
+        return prepare_decoder_attention_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length)
+    return prepare
+
+
+def enable_block_attention(model) -> int:
+    """
+    Make the decoders of the model take the 4D block attention mask of PackedCollator. The causal LMs of recent
+    transformers (4.42+) take it as is, the decoders of the older ones (Llama, OPT... of the pinned 4.33.1) expand
+    a 2D padding mask in _prepare_decoder_attention_mask, which is wrapped to let a 4D mask through.
+    Returns the number of decoders patched, check_block_attention tells whether the model isolates the segments.
+    """
+    num_patched = 0
+    for module in model.modules():
+        if hasattr(module, "_prepare_decoder_attention_mask") and not getattr(module, "block_attention_enabled", False):
+            module._prepare_decoder_attention_mask = block_attention_mask_preparer(module._prepare_decoder_attention_mask)
+            module.block_attention_enabled = True
+            num_patched += 1
+    return num_patched
+
+
+def first_fit_decreasing(lengths: np.ndarray, capacity: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bin pack the examples by length (first-fit-decreasing): the examples are placed longest first into the
+    first bin that still has room, in O(n log n) with a max segment tree over the remaining room of the bins.
+    Examples longer than capacity get a bin of their own (they are not truncated).
+    Returns the example indices of all the bins concatenated and the bins offsets into it.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind='stable')
+    num_oversized = int((lengths > capacity).sum())
+
+    # Leaves are the bins in opening order, a bin not opened yet has the full capacity so the
+    # leftmost leaf with enough room is either the first opened bin that fits or the next new bin
+    num_leaves = 1 << max(len(lengths) - num_oversized - 1, 0).bit_length()
+    remaining = [capacity] * (2 * num_leaves)
+    bins: List[List[int]] = [[int(example_idx)] for example_idx in order[:num_oversized]]
+    num_opened = 0
+    packed_bins: List[List[int]] = []
+    for example_idx in order[num_oversized:].tolist():
+        length = int(lengths[example_idx])
+        node = 1
+        while node < num_leaves:
+            node = 2 * node if remaining[2 * node] >= length else 2 * node + 1
+        bin_idx = node - num_leaves
+        if bin_idx == num_opened:
+            packed_bins.append([])
+            num_opened += 1
+        packed_bins[bin_idx].append(example_idx)
+        remaining[node] -= length
+        node //= 2
+        while node:
+            remaining[node] = max(remaining[2 * node], remaining[2 * node + 1])
+            node //= 2
+    bins.extend(packed_bins)
+
+    bin_sizes = np.fromiter((len(example_indices) for example_indices in bins), dtype=np.int64, count=len(bins))
+    bin_offsets = np.zeros(len(bins) + 1, dtype=np.int64)
+    np.cumsum(bin_sizes, out=bin_offsets[1:])
+    example_indices = np.fromiter((example_idx for example_indices in bins for example_idx in example_indices),
+                                  dtype=np.int64, count=int(bin_offsets[-1]))
+    return example_indices, bin_offsets
+
+
+def find_last_subsequence(token_ids: List[int], pattern: List[int], start: int = 0, end: int = None) -> Optional[int]:
+    """Index of the last occurrence of pattern in token_ids[start:end], like DataCollatorForCompletionOnlyLM searches"""
+    end = len(token_ids) if end is None else end
+    for idx in range(end - len(pattern), start - 1, -1):
+        if token_ids[idx] == pattern[0] and token_ids[idx:idx + len(pattern)] == pattern:
+            return idx
+    return None
+
+
+class PackedDataset(Dataset):
+    """
+    Rows of block_size tokens made of several tokenized examples (segments) packed with first_fit_decreasing.
+    Each row carries position ids restarting at 0 for every segment, the segment lengths, and completion-only
+    labels computed per segment: everything up to the end of the segment's last response template is ignored
+    (the whole segment if it has none) as are the pad tokens, the same as DataCollatorForCompletionOnlyLM does for
+    a single example (the template starts precomputed in the tokenized dataset are used when present).
+    Without response_token_ids all the tokens are trained on.
+    """
+    def __init__(self, tokenized_dataset: TokenizedDataset, block_size: int,
+                 response_token_ids: List[int] = None, pad_token_id: int = None) -> None:
+        self.tokenized_dataset = tokenized_dataset
+        self.block_size = block_size
+        self.response_token_ids = list(response_token_ids) if response_token_ids else None
+        self.pad_token_id = pad_token_id
+        self.example_lengths = tokenized_dataset.lengths
+        self.example_indices, self.bin_offsets = first_fit_decreasing(self.example_lengths, block_size)
+
+    def __len__(self) -> int:
+        return len(self.bin_offsets) - 1
+
+    def segment_indices(self, idx: int) -> np.ndarray:
+        return self.example_indices[self.bin_offsets[idx]:self.bin_offsets[idx + 1]]
+
+    @property
+    def row_lengths(self) -> np.ndarray:
+        return np.add.reduceat(self.example_lengths[self.example_indices], self.bin_offsets[:-1]) \
+            if len(self) else np.zeros(0, dtype=np.int64)
+
+    def segment_labels(self, token_ids: List[int], response_start: Optional[int] = None) -> List[int]:
+        labels = [IGNORE_INDEX if token_id == self.pad_token_id else token_id for token_id in token_ids]
+        if self.response_token_ids is None:
+            return labels
+        if response_start is None:
+            response_start = find_last_subsequence(labels, self.response_token_ids)
+        elif response_start < 0:
+            response_start = None
+        if response_start is None:
+            return [IGNORE_INDEX] * len(labels)
+        response_end = response_start + len(self.response_token_ids)
+        return [IGNORE_INDEX] * response_end + labels[response_end:]
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        input_ids, labels, position_ids, segment_lengths = [], [], [], []
+        response_starts = self.tokenized_dataset.response_starts
+        for example_idx in self.segment_indices(idx).tolist():
+            token_ids = self.tokenized_dataset.input_ids[example_idx]
+            input_ids.extend(token_ids)
+            labels.extend(self.segment_labels(token_ids,
+                                              None if response_starts is None else int(response_starts[example_idx])))
+            position_ids.extend(range(len(token_ids)))
+            segment_lengths.append(len(token_ids))
+        return {"input_ids": input_ids,
+                "labels": labels,
+                "position_ids": position_ids,
+                "segment_lengths": segment_lengths}
+
+    def efficiency_report(self) -> Dict[str, float]:
+        """Token utilization of the packed rows against one example per row padded to block_size"""
+        num_tokens = int(self.example_lengths.sum())
+        num_rows = len(self)
+        return {"num_examples": len(self.example_lengths),
+                "num_rows": num_rows,
+                "examples_per_row": len(self.example_lengths) / max(num_rows, 1),
+                "packed_efficiency": num_tokens / max(num_rows * self.block_size, 1),
+                "unpacked_efficiency": num_tokens / max(len(self.example_lengths) * self.block_size, 1)}
+
+
+class PackedCollator:
+    """
+    Pad the packed rows of a batch: input ids with pad_token_id, labels with -100 and position ids with 0.
+    The attention mask is the 4D additive block diagonal causal mask (0 where a token may attend, the dtype min
+    elsewhere) so a segment only attends to itself: a 2D padding mask would let the segments of a row see the
+    previous ones. The model must accept custom 4D attention masks, see enable_block_attention and check_block_attention.
+    """
+    def __init__(self, pad_token_id: int, padding_side: str = "right", mask_dtype: torch.dtype = torch.float32) -> None:
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, rows: List[Dict[str, List[int]]]) -> Dict[str, torch.Tensor]:
+        max_length = max(len(row["input_ids"]) for row in rows)
+        input_ids = np.full((len(rows), max_length), self.pad_token_id, dtype=np.int64)
+        labels = np.full((len(rows), max_length), IGNORE_INDEX, dtype=np.int64)
+        position_ids = np.zeros((len(rows), max_length), dtype=np.int64)
+        # Segment number of every token, padding is -1
+        segment_ids = np.full((len(rows), max_length), -1, dtype=np.int64)
+        for row_idx, row in enumerate(rows):
+            row_length = len(row["input_ids"])
+            start = max_length - row_length if self.padding_side == "left" else 0
+            input_ids[row_idx, start:start + row_length] = row["input_ids"]
+            labels[row_idx, start:start + row_length] = row["labels"]
+            position_ids[row_idx, start:start + row_length] = row["position_ids"]
+            segment_ids[row_idx, start:start + row_length] = np.repeat(np.arange(len(row["segment_lengths"])),
+                                                                       row["segment_lengths"])
+
+        batch = {"input_ids": torch.from_numpy(input_ids),
+                 "labels": torch.from_numpy(labels),
+                 "position_ids": torch.from_numpy(position_ids)}
+        segment_ids = torch.from_numpy(segment_ids)
+        causal = torch.ones(max_length, max_length, dtype=torch.bool).tril()
+        same_segment = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] >= 0)
+        # Padding rows attend to themselves so no softmax row is fully masked
+        same_segment |= torch.eye(max_length, dtype=torch.bool)[None]
+        attention_mask = torch.zeros(same_segment.shape, dtype=self.mask_dtype)
+        attention_mask.masked_fill_(~(same_segment & causal[None]), torch.finfo(self.mask_dtype).min)
+        batch["attention_mask"] = attention_mask[:, None]
+        return batch
+
+
+@torch.no_grad()
+def check_block_attention(model, segment_length: int = 8, rtol: float = 5e-2) -> None:
+    """
+    Make sure the packed segments of a row do not see each other with this model (after enable_block_attention):
+    the logits of the second of two packed segments must match the logits of that segment run alone. Raises when
+    the model rejects the 4D mask or ignores it (flash attention 2, models only taking a 2D mask), instead of
+    silently training across segments.
+    """
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    device = model.get_input_embeddings().weight.device
+    token_ids = (torch.arange(2 * segment_length) * 7 + 3) % vocab_size
+    row = {"input_ids": token_ids.tolist(), "labels": token_ids.tolist(),
+           "position_ids": list(range(segment_length)) * 2, "segment_lengths": [segment_length, segment_length]}
+    batch = PackedCollator(pad_token_id=0, mask_dtype=model.dtype if model.dtype.is_floating_point else torch.float32)([row])
+
+    was_training = model.training
+    model.eval()
+    try:
+        packed_logits = model(input_ids=batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device),
+                              position_ids=batch["position_ids"].to(device)).logits[0, segment_length:].float()
+        alone_logits = model(input_ids=token_ids[None, segment_length:].to(device)).logits[0].float()
+    except Exception as e:
+        raise RuntimeError(f"{type(model).__name__} does not accept the 4D block attention mask of packing "
+                           f"(transformers {transformers.__version__}), please disable do_packing (error: {e})") from e
+    finally:
+        model.train(was_training)
+    max_diff = (packed_logits - alone_logits).abs().max().item()
+    assert max_diff <= rtol * max(alone_logits.abs().max().item(), 1.), \
+        f"{type(model).__name__} ignores the 4D block attention mask, packed examples would attend to each other " \
+        f"(max logits difference {max_diff:.4f}), please disable do_packing or flash attention 2"
+
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    # first_fit_decreasing against a plain quadratic first fit decreasing
+    def reference_ffd(lengths: List[int], capacity: int) -> List[List[int]]:
+        bins, room = [], []
+        for example_idx in sorted(range(len(lengths)), key=lambda idx: -lengths[idx]):
+            if lengths[example_idx] > capacity:
+                bins.append([example_idx])
+                room.append(-1)
+                continue
+            for bin_idx, bin_room in enumerate(room):
+                if bin_room >= lengths[example_idx]:
+                    bins[bin_idx].append(example_idx)
+                    room[bin_idx] -= lengths[example_idx]
+                    break
+            else:
+                bins.append([example_idx])
+                room.append(capacity - lengths[example_idx])
+        return bins
+
+    random.seed(42)
+    for _ in range(200):
+        lengths = [random.randint(1, 1100) for _ in range(random.randint(0, 300))]
+        example_indices, bin_offsets = first_fit_decreasing(np.array(lengths, dtype=np.int64), 1024)
+        bins = [example_indices[bin_offsets[idx]:bin_offsets[idx + 1]].tolist() for idx in range(len(bin_offsets) - 1)]
+        reference_bins = reference_ffd(lengths, 1024)
+        assert sorted(map(sorted, bins)) == sorted(map(sorted, reference_bins))
+    print("first_fit_decreasing matches the reference")
+
+    # Instruction mix like lengths: mostly short prompts, a long tail up to 1024
+    lengths = np.clip(np.random.default_rng(42).lognormal(mean=5.3, sigma=0.7, size=100000), 16, 1024).astype(np.int64)
+    start_time = time.perf_counter()
+    example_indices, bin_offsets = first_fit_decreasing(lengths, 1024)
+    print(f"Packed {len(lengths)} examples into {len(bin_offsets) - 1} rows in {time.perf_counter() - start_time:.2f}s, "
+          f"efficiency {lengths.sum() / ((len(bin_offsets) - 1) * 1024):.3f} "
+          f"(unpacked {lengths.sum() / (len(lengths) * 1024):.3f})")
+
+    # The block mask isolates the segments of a tiny Llama, a model dropping the 4D mask (full causal attention
+    # over the row, the segments leak into each other) is refused
+    from transformers import LlamaConfig, LlamaModel, LlamaForCausalLM
+
+    class DropMaskLlama(LlamaForCausalLM):
+        def forward(self, *args, attention_mask=None, **kwargs):
+            return super().forward(*args, **kwargs)
+
+    class LegacyMaskLlamaModel(LlamaModel):
+        """Builds its mask like the Llama decoder of transformers 4.33: causal mask plus an expanded 2D padding mask"""
+        def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+            batch_size, source_length = attention_mask.size()
+            min_value = torch.finfo(inputs_embeds.dtype).min
+            causal_mask = torch.full((input_shape[-1], source_length), min_value, dtype=inputs_embeds.dtype).triu(1)
+            padding_mask = (1 - attention_mask[:, None, None, :].to(inputs_embeds.dtype)) * min_value
+            return (causal_mask[None, None] + padding_mask).clamp(min=min_value)
+
+        def forward(self, input_ids=None, attention_mask=None, inputs_embeds=None, **kwargs):
+            inputs_embeds = self.embed_tokens(input_ids)
+            if attention_mask is None:
+                attention_mask = torch.ones(input_ids.shape, dtype=torch.long)
+            attention_mask = self._prepare_decoder_attention_mask(attention_mask, input_ids.shape, inputs_embeds, 0)
+            return super().forward(inputs_embeds=inputs_embeds, attention_mask=attention_mask, **kwargs)
+
+    class LegacyMaskLlama(LlamaForCausalLM):
+        def __init__(self, config):
+            super().__init__(config)
+            self.model = LegacyMaskLlamaModel(config)
+
+    llama_config = LlamaConfig(vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                               num_attention_heads=2, num_key_value_heads=2)
+    torch.manual_seed(42)
+    for dtype in (torch.float32, torch.bfloat16):
+        check_block_attention(LlamaForCausalLM(llama_config).to(dtype))
+    for model, error_type in ((DropMaskLlama(llama_config), AssertionError),
+                              (LegacyMaskLlama(llama_config), RuntimeError)):
+        try:
+            check_block_attention(model)
+        except error_type as e:
+            print(f"Refused: {e}")
+        else:
+            raise AssertionError(f"{type(model).__name__} should be refused")
+
+    # The decoders expanding a 2D mask (pinned transformers) take the block mask once enabled, only once
+    legacy_model = LegacyMaskLlama(llama_config)
+    assert enable_block_attention(legacy_model) == 1 and enable_block_attention(legacy_model) == 0
+    assert enable_block_attention(LlamaForCausalLM(llama_config)) == 0
+    for dtype in (torch.float32, torch.bfloat16):
+        check_block_attention(legacy_model.to(dtype))
+    print("check_block_attention passed")
@@ -0,0 +1,229 @@
+import sys
+from abc import ABC, abstractmethod
+from typing import List, Dict, Iterator, Optional
+sys.path.insert(0, r'./')
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def padding_ratio(lengths: np.ndarray, batches: List[np.ndarray]) -> float:
+    """Fraction of pad tokens when every batch is padded to its longest example"""
+    total_padded, total_tokens = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        total_padded += int(batch_lengths.max()) * len(batch)
+        total_tokens += int(batch_lengths.sum())
+    return 1 - total_tokens / total_padded if total_padded else 0.
+
+
+class ResumableBatchSampler(Sampler[List[int]], ABC):
+    """
+    Base of the batch samplers whose position can be checkpointed: the seed and the epoch fix the batches of an
+    epoch (epoch_batches) and the cursor is the number of batches of the epoch already consumed.
+    state_dict / load_state_dict make it a checkpointable object (accelerator.register_for_checkpointing),
+    a restored sampler starts the epoch at the cursor without going through the skipped batches.
+    The epoch is incremented after each full iteration, set_epoch overrides it (from the first batch
+    when it is another epoch).
+    """
+    def __init__(self, num_examples: int, batch_size: int, shuffle: bool = True, seed: int = 42,
+                 drop_last: bool = False) -> None:
+        assert batch_size > 0, "Please specify a positive batch size"
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.cursor = 0
+
+    @abstractmethod
+    def epoch_batches(self, epoch: int) -> List[np.ndarray]:
+        pass
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch, self.cursor = epoch, 0
+
+    def set_position(self, epoch: int, cursor: int) -> None:
+        self.epoch, self.cursor = epoch, cursor
+
+    def set_consumed(self, epoch: int, process_batches: int, num_processes: int = 1, split_batches: bool = False) -> None:
+        """
+        Position once every process loaded process_batches batches of its dataloader this epoch. accelerate gives each
+        process its own batch of the sampler per step, or a slice of the same batch with split_batches. The gradient
+        accumulation steps don't change it, each of them loads a batch.
+        """
+        consumed = process_batches if split_batches else process_batches * num_processes
+        # The last step of an epoch can be padded with batches from its start (even_batches)
+        self.set_position(epoch, min(consumed, len(self)))
+
+    def state_dict(self) -> Dict[str, int]:
+        return {"epoch": self.epoch, "seed": self.seed, "cursor": self.cursor}
+
+    def load_state_dict(self, state_dict: Dict[str, int]) -> None:
+        self.epoch, self.seed, self.cursor = state_dict["epoch"], state_dict["seed"], state_dict["cursor"]
+
+    def random_indices(self, epoch: int) -> np.ndarray:
+        if not self.shuffle:
+            return np.arange(self.num_examples)
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(self.num_examples, generator=generator).numpy()
+
+    def __iter__(self) -> Iterator[List[int]]:
+        epoch = self.epoch
+        for batch in self.epoch_batches(epoch)[self.cursor:]:
+            yield batch.tolist()
+        self.epoch, self.cursor = epoch + 1, 0
+
+    def __len__(self) -> int:
+        # Batches of a whole epoch, whatever the cursor
+        return self.num_examples // self.batch_size if self.drop_last else -(-self.num_examples // self.batch_size)
+
+
+class ShuffledBatchSampler(ResumableBatchSampler):
+    """Resumable counterpart of a BatchSampler over a RandomSampler, reshuffled every epoch with seed + epoch"""
+    def epoch_batches(self, epoch: int) -> List[np.ndarray]:
+        indices = self.random_indices(epoch)
+        batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+
+class LengthGroupedBatchSampler(ResumableBatchSampler):
+    """
+    Batch sampler grouping examples of similar token length so the collators pad less.
+    Every epoch the indices are shuffled (seed + epoch), cut into mega batches of
+    batch_size * num_replicas * mega_batch_mult examples, each mega batch is sorted by length and cut into
+    global batches (one batch per replica) and the order of the global batches is shuffled again,
+    with the longest one first so an out of memory shows up on the first step.
+
+    Distributed: the batches of a global batch are yielded back to back, so accelerate's batch sharding (batch i goes
+    to process i % num_replicas) gives every process a batch of similar length at each step. Set rank to yield only the
+    batches of that rank instead, when the dataloader is not sharded by accelerate.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, shuffle: bool = True, seed: int = 42,
+                 mega_batch_mult: int = 50, num_replicas: int = 1, rank: Optional[int] = None,
+                 drop_last: bool = False) -> None:
+        assert rank is None or 0 <= rank < num_replicas, f"Invalid rank {rank} for {num_replicas} replicas"
+        super().__init__(len(lengths), batch_size, shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.mega_batch_mult = mega_batch_mult
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def global_batches(self, epoch: int) -> List[List[np.ndarray]]:
+        """The batches of an epoch, grouped by step: one batch per replica"""
+        indices = self.random_indices(epoch)
+        global_batch_size = self.batch_size * self.num_replicas
+        mega_batch_size = global_batch_size * self.mega_batch_mult
+        global_batches = []
+        for mega_start in range(0, len(indices), mega_batch_size):
+            mega_batch = indices[mega_start:mega_start + mega_batch_size]
+            mega_batch = mega_batch[np.argsort(-self.lengths[mega_batch], kind='stable')]
+            for start in range(0, len(mega_batch), global_batch_size):
+                global_batch = mega_batch[start:start + global_batch_size]
+                global_batches.append([global_batch[replica_start:replica_start + self.batch_size]
+                                       for replica_start in range(0, len(global_batch), self.batch_size)])
+
+        if self.drop_last and global_batches and len(global_batches[-1][-1]) < self.batch_size:
+            global_batches[-1].pop()
+            if not global_batches[-1]:
+                global_batches.pop()
+        # An incomplete last step stays last so the batches keep their replica in the round robin
+        last_step = global_batches.pop() if global_batches and len(global_batches[-1]) < self.num_replicas else None
+        if self.shuffle and len(global_batches) > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + epoch)
+            order = torch.randperm(len(global_batches), generator=generator).tolist()
+            longest = max(range(len(global_batches)), key=lambda idx: self.lengths[global_batches[idx][0]].max())
+            order.remove(longest)
+            global_batches = [global_batches[longest]] + [global_batches[idx] for idx in order]
+        if last_step is not None and (self.rank is None or len(last_step) > self.rank):
+            global_batches.append(last_step)
+        return global_batches
+
+    def epoch_batches(self, epoch: int) -> List[np.ndarray]:
+        global_batches = self.global_batches(epoch)
+        if self.rank is not None:
+            return [global_batch[self.rank] for global_batch in global_batches]
+        return [batch for global_batch in global_batches for batch in global_batch]
+
+    def __len__(self) -> int:
+        if self.rank is None:
+            return super().__len__()
+        return len(self.epoch_batches(self.epoch))
+
+    def padding_report(self) -> Dict[str, float]:
+        """Pad token ratio of this epoch's batches against batches of the same size drawn without grouping"""
+        indices = self.random_indices(self.epoch)
+        random_batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        return {"random_padding_ratio": padding_ratio(self.lengths, random_batches),
+                "grouped_padding_ratio": padding_ratio(self.lengths, self.epoch_batches(self.epoch))}
+
+
+if __name__ == "__main__":
+    import time
+
+    # Mix of short translation pairs and long WebGLM/ELI5 like prompts
+    rng = np.random.default_rng(42)
+    lengths = np.concatenate([rng.integers(20, 120, size=60000), rng.integers(300, 1024, size=40000)])
+    start_time = time.perf_counter()
+    sampler = LengthGroupedBatchSampler(lengths, batch_size=8, seed=42)
+    report = sampler.padding_report()
+    batches = list(sampler)
+    print(f"{len(batches)} batches in {time.perf_counter() - start_time:.2f}s, padding ratio "
+          f"{report['random_padding_ratio']:.2%} random -> {report['grouped_padding_ratio']:.2%} grouped")
+
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(lengths)))
+    assert len(batches) == len(sampler)
+    assert list(LengthGroupedBatchSampler(lengths, batch_size=8, seed=42)) == batches
+    assert list(sampler) != batches, "A new epoch should be reshuffled"
+
+    # Rank sharded samplers cover the same examples as the accelerate style round robin of the unsharded one
+    num_replicas = 4
+    sampler = LengthGroupedBatchSampler(lengths[:1003], batch_size=8, num_replicas=num_replicas)
+    all_batches = list(sampler)
+    for rank in range(num_replicas):
+        rank_sampler = LengthGroupedBatchSampler(lengths[:1003], batch_size=8, num_replicas=num_replicas, rank=rank)
+        rank_batches = list(rank_sampler)
+        assert len(rank_batches) == len(rank_sampler)
+        assert rank_batches == all_batches[rank::num_replicas][:len(rank_batches)]
+
+    # A sampler restored from a mid epoch state yields the rest of the epoch then the next epochs as if never stopped
+    for sampler_class, sampler_args in ((ShuffledBatchSampler, (len(lengths),)), (LengthGroupedBatchSampler, (lengths,))):
+        sampler = sampler_class(*sampler_args, batch_size=8, seed=7)
+        expected = list(sampler) + list(sampler)
+        sampler.set_position(0, 5000)
+        restored = sampler_class(*sampler_args, batch_size=8)
+        restored.load_state_dict(sampler.state_dict())
+        start_time = time.perf_counter()
+        resumed = list(restored)
+        print(f"{sampler_class.__name__} resumed at batch 5000 in {time.perf_counter() - start_time:.3f}s")
+        assert resumed + list(restored) == expected[5000:] and restored.epoch == 2, sampler_class.__name__
+
+    # Training loop with gradient accumulation over accelerate's sharded batch samplers: the checkpoint asked at
+    # step k is saved at the next optimization step, the resumed processes then load the batches they would have.
+    # Without even_batches, which completes the last step with the first batches loaded, those of the resumed run
+    from accelerate.data_loader import BatchSamplerShard
+    gradient_accumulation_steps, checkpoint_step = 4, 10
+    for num_processes, split_batches in ((1, False), (3, False), (3, True)):
+        batch_size = 12 if split_batches else 4
+        make_sampler = lambda: LengthGroupedBatchSampler(lengths[:1003], batch_size=batch_size, seed=3,
+                                                         num_replicas=1 if split_batches else num_processes)
+        uninterrupted = [list(BatchSamplerShard(make_sampler(), num_processes, rank, split_batches=split_batches,
+                                                even_batches=False)) for rank in range(num_processes)]
+        saved_step = -(-checkpoint_step // gradient_accumulation_steps) * gradient_accumulation_steps
+        sampler = make_sampler()
+        sampler.set_consumed(0, saved_step, num_processes, split_batches=split_batches)
+        state_dict = sampler.state_dict()
+        for rank in range(num_processes):
+            restored = make_sampler()
+            restored.load_state_dict(state_dict)
+            resumed = list(BatchSamplerShard(restored, num_processes, rank, split_batches=split_batches, even_batches=False))
+            assert resumed[0] == uninterrupted[rank][saved_step], (num_processes, split_batches, rank)
+            assert resumed == uninterrupted[rank][saved_step:], (num_processes, split_batches, rank)
+    print("Sampler checks passed")
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import logging
+import math
+import random
+from typing import List, Dict, Union, Iterator, Optional
+sys.path.insert(0, r'./')
+
+import torch
+import pyarrow as pa
+import pyarrow.parquet as pq
+from torch.utils.data import IterableDataset, get_worker_info
+from datasets import load_dataset
+from transformers import AutoTokenizer
+
+from src.data.configs import AdvanceQAExample, AdvanceInstructSample
+from src.data.mixture import TokenMixture, format_mixture_report
+
+logger = logging.getLogger(__name__)
+
+
+def iter_columnar_records(file_path: str, batch_size: int = 1024) -> Iterator[Dict]:
+    """Iterate the rows of a parquet or Arrow IPC parser output, Arrow IPC files are memory mapped (zero-copy)"""
+    if file_path.endswith(".arrow"):
+        with pa.memory_map(file_path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for batch_idx in range(reader.num_record_batches):
+                yield from reader.get_batch(batch_idx).to_pylist()
+    else:
+        parquet_file = pq.ParquetFile(file_path, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+
+
+def is_json_lines(file_path: str) -> bool:
+    with open(file_path, 'r', encoding='utf-8-sig') as json_file:
+        for line in json_file:
+            if line.strip():
+                return line.lstrip().startswith("{")
+    return True
+
+
+def iter_records(file_path: str, shard_id: int = 0, num_shards: int = 1) -> Iterator[Dict]:
+    """
+    Iterate the records of a parser output (jsonl, json array, parquet, arrow, gz/zst compressed json),
+    keeping every num_shards-th record starting at shard_id. Plain jsonl lines of other shards are skipped
+    before being parsed.
+    """
+    extension = file_path.split(".")[-1]
+    if extension in ("parquet", "arrow"):
+        records = iter_columnar_records(file_path)
+    elif extension in ("json", "jsonl") and is_json_lines(file_path):
+        with open(file_path, 'r', encoding='utf-8-sig') as json_file:
+            record_idx = 0
+            for line in json_file:
+                if not line.strip():
+                    continue
+                if record_idx % num_shards == shard_id:
+                    yield json.loads(line)
+                record_idx += 1
+        return
+    else:
+        # Compressed parser outputs (eg: OpenOrca.json.gz) are loaded by the builder of the inner extension
+        if extension in ("gz", "zst"):
+            extension = file_path.split(".")[-2]
+        records = load_dataset(extension, data_files=file_path, streaming=True, keep_in_memory=False)['train']
+
+    for record_idx, record in enumerate(records):
+        if record_idx % num_shards == shard_id:
+            yield record
+
+
+class StreamingQa(IterableDataset):
+    """
+    Streaming counterpart of AdvanceQa for CAUSAL_LM training: nothing is loaded up front, each DataLoader worker
+    reads its shard of every file, interleaves the files on the fly, builds the prompts, tokenizes them
+    (dropping those longer than max_seq_length) and yields them through a shuffle buffer.
+
+    Each file contributes floor(num_examples * percentage_weight / 100) examples like in AdvanceQa, the next
+    source is drawn with a probability proportional to its remaining quota so the files stay mixed in these
+    proportions all along the epoch. The shuffle seed changes every epoch (the DataLoader's worker seed, or
+    seed without workers, plus the epoch: persistent workers keep their worker seed).
+    The epoch only comes from set_epoch, called by the training loop before each epoch. It is kept in shared
+    memory so the copies of the dataset in the DataLoader workers, persistent or not, all see the same epoch.
+
+    With token_mixture the files are mixed by token share instead (TokenMixture over the percentage weights,
+    mixture_epoch_weights per epoch): the sum of the quotas is drawn and a file running out is read again.
+    """
+    def __init__(self, json_file_paths: List[str], task_type: str, tokenizer: AutoTokenizer,
+                 config_type: Union[AdvanceQAExample, AdvanceInstructSample] = AdvanceQAExample,
+                 num_examples: int = 100000, percentage_weights: List[int] = None,
+                 max_seq_length: int = 1024, text_column: str = "prompt",
+                 shuffle_buffer_size: int = 10000, seed: int = 42, token_mixture: bool = False,
+                 mixture_temperature: float = 1.0, mixture_epoch_weights: List[List[float]] = None) -> None:
+        assert task_type == "CAUSAL_LM", "Streaming is only supported for CAUSAL_LM training"
+        for json_path in json_file_paths:
+            assert os.path.isfile(json_path), f"Invalid data path for {json_path}"
+        # Uniform weights for all files if percentage weights is None
+        if not percentage_weights:
+            percentage_weights = [math.floor(100/len(json_file_paths)) for _ in range(len(json_file_paths))]
+
+        self.json_file_paths = json_file_paths
+        self.task_type = task_type
+        self.tokenizer = tokenizer
+        self.config_type = config_type
+        self.percentage_weights = percentage_weights
+        self.file_quotas = [math.floor(num_examples * (percentage_weight/100)) for percentage_weight in percentage_weights]
+        self.max_seq_length = max_seq_length
+        self.text_column = text_column
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.token_mixture = token_mixture
+        self.mixture_temperature = mixture_temperature
+        self.mixture_epoch_weights = mixture_epoch_weights
+        self.shared_epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def __len__(self) -> int:
+        # Exact unless a file runs out of examples short of its quota
+        return sum(self.file_quotas)
+
+    @property
+    def epoch(self) -> int:
+        return int(self.shared_epoch[0])
+
+    def set_epoch(self, epoch: int) -> None:
+        self.shared_epoch[0] = epoch
+
+    def build_example(self, data: Dict) -> Optional[Dict]:
+        """Build and tokenize the training input of a record, None if it is longer than max_seq_length"""
+        config_data = self.config_type(**data).get_example(is_training=True, task_type=self.task_type)
+        tokenized_data = self.tokenizer(config_data[self.text_column] + f" {self.tokenizer.eos_token}",
+                                        return_special_tokens_mask=True)
+        if len(tokenized_data["input_ids"]) > self.max_seq_length:
+            return None
+        return dict(tokenized_data)
+
+    def __iter__(self) -> Iterator[Dict]:
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, seed = 0, 1, self.seed
+        else:
+            # Derived from the DataLoader generator, different for every worker
+            worker_id, num_workers, seed = worker_info.id, worker_info.num_workers, worker_info.seed
+        epoch = self.epoch
+        rng = random.Random(seed + epoch)
+
+        # This worker's share of every file quota
+        remaining = [quota // num_workers + (1 if worker_id < quota % num_workers else 0) for quota in self.file_quotas]
+        if self.token_mixture:
+            examples = self.iter_token_mixture(epoch, sum(remaining), worker_id, num_workers)
+        else:
+            examples = self.iter_quota_mixture(rng, remaining, worker_id, num_workers)
+        shuffle_buffer = []
+        for example in examples:
+            if len(shuffle_buffer) < self.shuffle_buffer_size:
+                shuffle_buffer.append(example)
+                continue
+            swap_idx = rng.randrange(len(shuffle_buffer))
+            yield shuffle_buffer[swap_idx]
+            shuffle_buffer[swap_idx] = example
+
+        rng.shuffle(shuffle_buffer)
+        yield from shuffle_buffer
+
+    def iter_quota_mixture(self, rng: random.Random, remaining: List[int],
+                           worker_id: int, num_workers: int) -> Iterator[Dict]:
+        sources = [iter_records(json_path, shard_id=worker_id, num_shards=num_workers)
+                   for json_path in self.json_file_paths]
+        while sum(remaining) > 0:
+            source_idx = rng.choices(range(len(sources)), weights=remaining)[0]
+            data = next(sources[source_idx], None)
+            if data is None:
+                # The file is exhausted before its quota
+                remaining[source_idx] = 0
+                continue
+            example = self.build_example(data)
+            if example is None:
+                continue
+            remaining[source_idx] -= 1
+            yield example
+
+    def iter_token_mixture(self, epoch: int, num_examples: int, worker_id: int, num_workers: int) -> Iterator[Dict]:
+        weights = self.mixture_epoch_weights[min(epoch, len(self.mixture_epoch_weights) - 1)] \
+            if self.mixture_epoch_weights else self.percentage_weights
+        mixture = TokenMixture(weights, self.mixture_temperature,
+                               names=[os.path.basename(json_path) for json_path in self.json_file_paths])
+        sources = [iter_records(json_path, shard_id=worker_id, num_shards=num_workers)
+                   for json_path in self.json_file_paths]
+        kept_in_pass = [0] * len(sources)
+        for _ in range(num_examples):
+            while True:
+                try:
+                    source_idx = mixture.next_source()
+                except RuntimeError as e:
+                    raise RuntimeError(f"Streaming worker {worker_id} of {num_workers} at epoch {epoch}: {e}, "
+                                       f"check that its shard of the train files has examples kept by the "
+                                       f"tokenization and the length filters") from e
+                data = next(sources[source_idx], None)
+                if data is None:
+                    if not kept_in_pass[source_idx]:
+                        # Nothing usable in a whole pass over the file
+                        mixture.drop(source_idx)
+                        continue
+                    # Read the file again to keep its token share
+                    sources[source_idx] = iter_records(self.json_file_paths[source_idx],
+                                                       shard_id=worker_id, num_shards=num_workers)
+                    kept_in_pass[source_idx] = 0
+                    continue
+                example = self.build_example(data)
+                if example is not None:
+                    break
+            kept_in_pass[source_idx] += 1
+            mixture.update(source_idx, len(example["input_ids"]))
+            yield example
+        logger.info(f"Token mixture of streaming worker {worker_id} for epoch {epoch}:\n{format_mixture_report(mixture.report())}")
+
+
+if __name__ == "__main__":
+    import tempfile
+    import numpy as np
+    from torch.utils.data import DataLoader
+
+    # The mixture weights of every epoch come from set_epoch, in the persistent workers or not
+    tokenizer = AutoTokenizer.from_pretrained(sys.argv[1] if len(sys.argv) > 1 else "EleutherAI/gpt-neo-125m")
+    random.seed(42)
+    json_file_paths = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, (min_words, max_words) in (("short", (3, 20)), ("long", (60, 120))):
+            json_file_paths.append(os.path.join(data_dir, f"{name}.json"))
+            with open(json_file_paths[-1], 'w', encoding='utf-8') as json_file:
+                for idx in range(400):
+                    question = " ".join(random.choices("a b c d e".split(), k=random.randint(min_words, max_words)))
+                    json_file.write(json.dumps({"qas_id": str(idx), "system_prompt": "", "question_text": question,
+                                                "orig_answer_texts": "x y", "answer_lengths": None}) + "\n")
+        for num_workers, persistent_workers in ((0, False), (2, False), (2, True)):
+            dataset = StreamingQa(json_file_paths, "CAUSAL_LM", tokenizer, config_type=AdvanceInstructSample,
+                                  num_examples=400, percentage_weights=[50, 50], token_mixture=True,
+                                  mixture_epoch_weights=[[90, 10], [10, 90]], shuffle_buffer_size=50)
+            dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                    persistent_workers=persistent_workers)
+            # A resumed or repeated epoch gets the weights of the epoch set, not of the number of passes
+            for epoch in (1, 1, 0, 2):
+                dataset.set_epoch(epoch)
+                lengths = np.array([len(example["input_ids"]) for example in dataloader])
+                # The prompts of the long file are about twice as long as the longest of the short file
+                long_share = lengths[lengths > 125].sum() / lengths.sum()
+                expected_share = 0.1 if epoch == 0 else 0.9
+                assert abs(long_share - expected_share) < 0.05, (num_workers, persistent_workers, epoch, long_share)
+            print(f"{num_workers} workers (persistent {persistent_workers}): long file token share {long_share:.3f} "
+                  f"at epoch {epoch}")
+    print("StreamingQa epoch checks passed")
@@ -0,0 +1,107 @@
+import os
+import sys
+import glob
+import time
+import json
+import shutil
+from typing import List, Dict, Tuple, Optional
+sys.path.insert(0, r'./')
+
+import xxhash
+
+from src.data.example_arena import ExampleArena
+from src.data.tokenized_dataset import TokenizedDataset
+
+
+# Bump when the layout of the cached files or the tokenization itself changes
+CACHE_VERSION = 3
+CONFIGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+
+def fingerprint_file(file_path: str, sample_bytes: int = 1024 * 1024) -> Dict:
+    """
+    Size, modification time and a hash of the first and last sample_bytes of a data file,
+    hashing whole multi GB parser outputs on every launch would cost as much as loading them
+    """
+    file_stat = os.stat(file_path)
+    hasher = xxhash.xxh3_128()
+    with open(file_path, 'rb') as data_file:
+        hasher.update(data_file.read(sample_bytes))
+        if file_stat.st_size > sample_bytes:
+            data_file.seek(max(file_stat.st_size - sample_bytes, sample_bytes))
+            hasher.update(data_file.read(sample_bytes))
+    return {"path": os.path.abspath(file_path),
+            "size": file_stat.st_size,
+            "mtime_ns": file_stat.st_mtime_ns,
+            "hash": hasher.hexdigest()}
+
+
+def fingerprint_tokenizer(tokenizer, model_name: str) -> Dict:
+    tokenizer_fingerprint = {"model_name": model_name,
+                             "class": type(tokenizer).__name__,
+                             "vocab_size": len(tokenizer),
+                             "added_tokens": sorted(tokenizer.get_added_vocab().items()),
+                             "special_tokens": tokenizer.special_tokens_map}
+    if getattr(tokenizer, "is_fast", False):
+        # Catches a changed tokenizer behind the same model name (new revision, local edits)
+        tokenizer_fingerprint["backend"] = xxhash.xxh3_128_hexdigest(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    return tokenizer_fingerprint
+
+
+def fingerprint_templates(configs_dir: str = CONFIGS_DIR) -> str:
+    """Hash of the prompt config sources (templates, get_example), any edit invalidates the cached prompts"""
+    hasher = xxhash.xxh3_128()
+    for config_path in sorted(glob.glob(os.path.join(configs_dir, "*.py"))):
+        with open(config_path, 'rb') as config_file:
+            hasher.update(config_file.read())
+    return hasher.hexdigest()
+
+
+class TokenizedCache:
+    """
+    On-disk cache of the tokenized dataloader inputs of one split, stored under cache_dir/<key> where the key
+    hashes the fingerprint (data files, sample counts, tokenizer, lengths, template config...).
+    The TokenizedDatasets (and the examples, needed to print the eval questions and labels) are memory mapped back.
+    """
+    def __init__(self, cache_dir: str, fingerprint: Dict) -> None:
+        self.fingerprint = dict(fingerprint, cache_version=CACHE_VERSION)
+        self.key = xxhash.xxh3_128_hexdigest(json.dumps(self.fingerprint, sort_keys=True, default=str).encode("utf-8"))
+        self.path = os.path.join(cache_dir, self.key)
+
+    def exists(self) -> bool:
+        return os.path.isfile(os.path.join(self.path, "cache.json"))
+
+    def wait(self, timeout: float = 4 * 3600, poll_interval: float = 5.) -> None:
+        """Wait for another process to write this cache entry"""
+        start_time = time.monotonic()
+        while not self.exists():
+            if time.monotonic() - start_time > timeout:
+                raise TimeoutError(f"The tokenized cache {self.path} was not written after {timeout} seconds")
+            time.sleep(poll_interval)
+
+    def load(self) -> Tuple[Dict[str, TokenizedDataset], Optional[ExampleArena]]:
+        with open(os.path.join(self.path, "cache.json"), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        tokenized_datasets = {name: TokenizedDataset.load(os.path.join(self.path, name))
+                              for name in meta["tokenized_datasets"]}
+        examples = ExampleArena.load(os.path.join(self.path, "examples")) if meta["has_examples"] else None
+        return tokenized_datasets, examples
+
+    def save(self, tokenized_datasets: Dict[str, TokenizedDataset], examples: ExampleArena = None) -> None:
+        """Write into a temporary directory first and rename it, a crashed or concurrent save never leaves a partial cache"""
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, tokenized_dataset in tokenized_datasets.items():
+            tokenized_dataset.save(os.path.join(tmp_path, name))
+        if examples is not None:
+            examples.save(os.path.join(tmp_path, "examples"))
+        with open(os.path.join(tmp_path, "cache.json"), 'w', encoding='utf-8') as meta_file:
+            json.dump({"tokenized_datasets": list(tokenized_datasets.keys()),
+                       "has_examples": examples is not None,
+                       "fingerprint": self.fingerprint}, meta_file, ensure_ascii=False, indent=2, default=str)
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # Another process already wrote the same cache
+            shutil.rmtree(tmp_path, ignore_errors=True)
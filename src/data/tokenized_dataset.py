@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional, Callable, Any
+sys.path.insert(0, r'./')
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from src.data.example_arena import TokenArena
+
+
+# Tokenizer of a process pool worker, set once by init_tokenize_worker instead of being pickled with every chunk
+_worker_tokenizer = None
+
+
+def init_tokenize_worker(tokenizer) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def tokenize_texts(texts: List[str], max_length: int, tokenizer=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tokenize a chunk of texts in one batched tokenizer call (truncated to max_length, no padding)
+    and return the concatenated int32 ids with the length of each text
+    """
+    tokenizer = tokenizer if tokenizer is not None else _worker_tokenizer
+    input_ids = tokenizer(texts,
+                          truncation="longest_first",
+                          max_length=max_length,
+                          return_attention_mask=False)["input_ids"]
+    lengths = np.fromiter((len(token_ids) for token_ids in input_ids), dtype=np.int64, count=len(input_ids))
+    flat_token_ids = np.fromiter((token_id for token_ids in input_ids for token_id in token_ids),
+                                 dtype=np.int32, count=int(lengths.sum()))
+    return flat_token_ids, lengths
+
+
+def call_with_worker_tokenizer(function: Callable, chunk: Any) -> Any:
+    return function(chunk, tokenizer=_worker_tokenizer)
+
+
+def map_tokenizer_chunks(function: Callable, chunks: Iterable[Any], tokenizer, num_proc: int = 1) -> Iterator[Any]:
+    """
+    Apply function(chunk, tokenizer=tokenizer) to the chunks in order, in this process or fanned out to num_proc
+    workers (function must be picklable, a module level function or a partial of one).
+    At most 2 * num_proc chunks are in flight so the chunks are never all materialized at once.
+    """
+    if num_proc <= 1:
+        for chunk in chunks:
+            yield function(chunk, tokenizer=tokenizer)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_proc,
+                             initializer=init_tokenize_worker,
+                             initargs=(tokenizer,)) as executor:
+        pending_results = deque()
+        for chunk in chunks:
+            pending_results.append(executor.submit(call_with_worker_tokenizer, function, chunk))
+            if len(pending_results) >= 2 * num_proc:
+                yield pending_results.popleft().result()
+        while pending_results:
+            yield pending_results.popleft().result()
+
+
+def tokenize_chunks(text_chunks: Iterable[List[str]], max_length: int, tokenizer,
+                    num_proc: int = 1) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Tokenize the chunks of texts in order with tokenize_texts, see map_tokenizer_chunks"""
+    return map_tokenizer_chunks(partial(tokenize_texts, max_length=max_length), text_chunks, tokenizer, num_proc)
+
+
+class TokenizedDataset(Dataset):
+    """
+    The tokenized examples of a split, each field (input_ids, and labels for SEQ_2_SEQ_LM) is a TokenArena
+    of flat int32 ids instead of one BatchEncoding per example.
+    Nothing is padded at this point, so attention_mask is all ones and special_tokens_mask only flags the
+    num_prefix_special / num_suffix_special tokens the tokenizer adds around the text, both are rebuilt on access
+    (special_tokens_mask only if return_special_tokens_mask).
+    response_starts optionally holds the start of the response template of every example (-1 if none),
+    returned as response_start for CompletionOnlyCollator, and source_ids the train file of every example.
+    """
+    def __init__(self, fields: Tuple[str, ...] = ("input_ids",),
+                 num_prefix_special: int = 0, num_suffix_special: int = 0,
+                 return_special_tokens_mask: bool = True) -> None:
+        self.columns: Dict[str, TokenArena] = {field: TokenArena() for field in fields}
+        self.num_prefix_special = num_prefix_special
+        self.num_suffix_special = num_suffix_special
+        self.return_special_tokens_mask = return_special_tokens_mask
+        self.response_starts: Optional[np.ndarray] = None
+        self.source_ids: Optional[np.ndarray] = None
+
+    @property
+    def input_ids(self) -> TokenArena:
+        return self.columns["input_ids"]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.input_ids.lengths
+
+    def __len__(self) -> int:
+        return len(self.input_ids)
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        example = {field: token_arena[idx] for field, token_arena in self.columns.items()}
+        num_tokens = len(example["input_ids"])
+        example["attention_mask"] = [1] * num_tokens
+        if self.response_starts is not None:
+            example["response_start"] = int(self.response_starts[idx])
+        if not self.return_special_tokens_mask:
+            return example
+        num_special = min(self.num_prefix_special + self.num_suffix_special, num_tokens)
+        example["special_tokens_mask"] = [1] * min(self.num_prefix_special, num_tokens) + \
+                                         [0] * (num_tokens - num_special) + \
+                                         [1] * (num_special - min(self.num_prefix_special, num_tokens))
+        return example
+
+    @property
+    def nbytes(self) -> int:
+        return sum(token_arena.nbytes for token_arena in self.columns.values())
+
+    def save(self, output_dir: str) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        for field, token_arena in self.columns.items():
+            token_arena.save(os.path.join(output_dir, field))
+        if self.response_starts is not None:
+            np.save(os.path.join(output_dir, "response_starts.npy"), self.response_starts)
+        if self.source_ids is not None:
+            np.save(os.path.join(output_dir, "source_ids.npy"), self.source_ids)
+        with open(os.path.join(output_dir, "tokenized.json"), 'w', encoding='utf-8') as meta_file:
+            json.dump({"fields": list(self.columns.keys()),
+                       "num_prefix_special": self.num_prefix_special,
+                       "num_suffix_special": self.num_suffix_special,
+                       "return_special_tokens_mask": self.return_special_tokens_mask,
+                       "has_response_starts": self.response_starts is not None,
+                       "has_source_ids": self.source_ids is not None}, meta_file)
+
+    @classmethod
+    def load(cls, input_dir: str) -> "TokenizedDataset":
+        """Memory map a TokenizedDataset written by save"""
+        with open(os.path.join(input_dir, "tokenized.json"), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        tokenized_dataset = cls(tuple(meta["fields"]),
+                                num_prefix_special=meta["num_prefix_special"],
+                                num_suffix_special=meta["num_suffix_special"],
+                                return_special_tokens_mask=meta["return_special_tokens_mask"])
+        tokenized_dataset.columns = {field: TokenArena.load(os.path.join(input_dir, field)) for field in meta["fields"]}
+        if meta["has_response_starts"]:
+            tokenized_dataset.response_starts = np.load(os.path.join(input_dir, "response_starts.npy"), mmap_mode='r')
+        if meta["has_source_ids"]:
+            tokenized_dataset.source_ids = np.load(os.path.join(input_dir, "source_ids.npy"), mmap_mode='r')
+        return tokenized_dataset
@@ -62,6 +62,9 @@ from peft import LoraConfig, TaskType, get_peft_model, PeftConfig, PeftModel, pr
 from peft.utils.other import fsdp_auto_wrap_policy
 
 from src.models.model_utils import poor_man_llm_load
+from src.data.samplers import ResumableBatchSampler
+from src.data.packing import enable_block_attention, check_block_attention
+from src.data.mixture import TokenMixtureBatchSampler, format_mixture_report
 from src.utils import in_notebook
 
 if in_notebook():
@@ -598,6 +601,17 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
 
     base_model.config.use_cache = False
 
+    if qa_dataloader.do_packing:
+        # The decoders of the pinned transformers only take a 2D padding mask otherwise
+        enable_block_attention(base_model)
+        deepspeed_plugin = accelerator.state.deepspeed_plugin
+        if deepspeed_plugin is not None and deepspeed_plugin.zero_stage == 3:
+            warnings.warn("The ZeRO-3 partitioned model can't be probed before prepare, make sure it accepts custom 4D "
+                          "attention masks or the packed examples will attend to each other")
+        else:
+            # Refuse to train when the model rejects or ignores the block attention mask of the packed rows
+            check_block_attention(base_model)
+
     if print_model_key:
         accelerator.print(base_model)
 
@@ -646,6 +660,10 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
                                                                 accelerator.distributed_type,
                                                                 accelerator)
     train_dataloader = dataloaders['train_dataloader']
+    # The position of a resumable train sampler is checkpointed, a resumed epoch starts right at the saved batch
+    train_sampler = getattr(qa_dataloader_instance['train'], "batch_sampler", None)
+    if not isinstance(train_sampler, ResumableBatchSampler):
+        train_sampler = None
     if do_eval:
         if "perplexity_eval_dataloader" in dataloaders:
             perplexity_eval_dataloader = dataloaders["perplexity_eval_dataloader"]
@@ -667,6 +685,8 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
 
     if checkpointing_steps or checkpoint_at_max_time or resume_from_checkpoint:
         accelerator.register_for_checkpointing(lr_scheduler)
+        if train_sampler is not None:
+            accelerator.register_for_checkpointing(train_sampler)
         # Parse out whether we are saving every epoch or after a certain number of batches
         if hasattr(checkpointing_steps, "isdigit"):
             if checkpointing_steps == "epoch":
@@ -709,6 +729,8 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
                 resume_step = int(training_difference.replace("step_", ""))
                 starting_epoch = resume_step // len(train_dataloader)
                 resume_step -= starting_epoch * len(train_dataloader)
+            # The step checkpoints are named after the steps of all the epochs
+            overall_step = starting_epoch * len(train_dataloader)
         else:
             resume_step = None
 
@@ -753,11 +775,15 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
             accelerator.end_training()
 
     def save_state():
-        nonlocal checkpoint_at_max_time
+        if train_sampler is not None:
+            # overall_step counts the batches loaded by each process, a gradient accumulation step included,
+            # the sampler batches they come from depend on the sharding. The workers may have prefetched further
+            train_sampler.set_consumed(epoch, overall_step - epoch * len(train_dataloader),
+                                       num_processes=accelerator.num_processes,
+                                       split_batches=accelerator.split_batches)
         output_cpkt_dir = f"step_{overall_step}"
         output_dir = os.path.join("src/models/runs/checkpoints", output_cpkt_dir)
         accelerator.save_state(output_dir)
-        checkpoint_at_max_time += training_args.checkpoint_at_max_time
         if accelerator.is_main_process and training_args.log_weights_cpkt:
             if training_args.with_tracking and training_args.log_weights_cpkt:
                 if training_args.report_to == "wandb":
@@ -781,18 +807,37 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
         with TorchTracemalloc() as tracemalloc:
             adapter.train()
             total_loss = 0
-            if resume_from_checkpoint and epoch == starting_epoch and resume_step is not None:
+            resumed_epoch = resume_from_checkpoint and epoch == starting_epoch and resume_step is not None
+            if train_sampler is not None and not resumed_epoch:
+                train_sampler.set_position(epoch, 0)
+            if hasattr(train_dataloader, "set_epoch"):
+                # Keeps accelerate from setting its own iteration count as the sampler epoch
+                train_dataloader.set_epoch(epoch)
+            num_epoch_steps = len(train_dataloader)
+            if resumed_epoch and train_sampler is not None:
+                # The restored sampler already starts at the resumed step, no batch is loaded to skip it
+                active_dataloader = train_dataloader
+                num_epoch_steps -= resume_step
+                overall_step += resume_step
+            elif resumed_epoch:
                 # We need to skip steps until we reach the resumed step
                 active_dataloader = accelerator.skip_first_batches(train_dataloader, resume_step)
+                num_epoch_steps = len(active_dataloader)
                 overall_step += resume_step
             else:
                 # After the first iteration though, we need to go back to the original dataloader
                 active_dataloader = train_dataloader
-            progress_bar_step = tqdm(total=len(active_dataloader),
+            progress_bar_step = tqdm(total=num_epoch_steps,
                                      desc=f"Training progress epoch {epoch} on process {accelerator.process_index}",
                                      position=accelerator.process_index,
                                      colour="blue")
+            # Time spent waiting on the dataloader for the batches of the current optimization step
+            data_wait_time, step_start_time = 0., time.perf_counter()
+            step_end_time = step_start_time
+            # A checkpoint waits for the end of the gradient accumulation, the gradients accumulated so far are not saved
+            checkpoint_due = False
             for step, batch in enumerate(active_dataloader):
+                data_wait_time += time.perf_counter() - step_end_time
                 # Print out the actual words of each batch
                 # input_ids = batch['input_ids'][0]
                 # decoded_inputs = tokenizer.decode(input_ids, skip_special_tokens=False)
@@ -816,11 +861,15 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
                     rate = progress_bar_step.format_dict["rate"]
                     remaining = (progress_bar_step.total - progress_bar_step.n) / rate if rate and progress_bar_step.total else 0
                     current_loss = (total_loss / step).item()
+                    step_time = time.perf_counter() - step_start_time
                     if with_tracking:
                         accelerator.log(
                             {
                                 "current_loss_batch": current_loss,
                                 "overall_steps": overall_step,
+                                "step_time(s)": step_time,
+                                "data_wait_time(s)": data_wait_time,
+                                "data_wait_ratio": data_wait_time / step_time if step_time else 0.,
                                 "Elapsed(hours)": progress_bar_step.format_dict['elapsed'] / 60 / 60,
                                 "Time_left(hours)": round(remaining / 60 / 60, 3),
                                 "learning_rate": lr_scheduler.get_last_lr()[0]
@@ -828,19 +877,27 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
                             step=completed_steps
                         )
                     completed_steps += 1
-                    tqdm.write(f"\n Current loss: {current_loss}, step: {completed_steps}")
+                    tqdm.write(f"\n Current loss: {current_loss}, step: {completed_steps}, "
+                               f"step time: {step_time:.3f}s (data wait {data_wait_time:.3f}s)")
+                    data_wait_time, step_start_time = 0., time.perf_counter()
                     progress_bar_step.desc = f"Training progress E:{epoch}|P:{accelerator.process_index}|L:{round(current_loss, 4)}|S:{completed_steps}|T:{round(remaining/60/60, 3)}h|Elapsed:{round(elapsed_time, 2)}"
                     del loss, outputs, batch
 
                 if isinstance(checkpointing_steps, int):
                     if overall_step % checkpointing_steps == 0:
-                        save_state()
+                        checkpoint_due = True
 
                 if isinstance(checkpoint_at_max_time, float):
                     if elapsed_time >= checkpoint_at_max_time:
-                        save_state()
+                        checkpoint_due = True
                         checkpoint_at_max_time += training_args.checkpoint_at_max_time
 
+                if checkpoint_due and accelerator.sync_gradients:
+                    save_state()
+                    checkpoint_due = False
+
+                step_end_time = time.perf_counter()
+
         progress_bar_epoch.update(1)
 
         # Printing the GPU memory usage details such as allocated memory, peak memory, and total memory usage
@@ -865,7 +922,17 @@ def train(training_args, qa_dataloader, qa_dataloader_instance):
         train_ppl = torch.exp(train_epoch_loss)
         accelerator.print(f"{epoch=}: {train_ppl=} {train_epoch_loss=}")
 
+        if isinstance(train_sampler, TokenMixtureBatchSampler):
+            mixture_report = train_sampler.mixture_report(epoch)
+            accelerator.print(f"Realized token mixture of epoch {epoch}:\n{format_mixture_report(mixture_report)}")
+            if with_tracking:
+                accelerator.log({f"token_share/{name}": source_report["token_share"]
+                                 for name, source_report in mixture_report.items()},
+                                step=completed_steps)
+
         if checkpointing_steps == "epoch":
+            if train_sampler is not None:
+                train_sampler.set_position(epoch + 1, 0)
             output_dir = f"epoch_{epoch}"
             output_dir = os.path.join("src/models/runs/checkpoints", output_dir)
             accelerator.save_state(output_dir)
@@ -99,15 +99,39 @@ def parse_arguments():
     dataloader_group.add_argument("--generative_eval_batch_size", type=int, default=8, help="Generative evaluation batch size")
     dataloader_group.add_argument("--text_column", type=str, default="prompt", help="Text column")
     dataloader_group.add_argument("--label_column", type=str, default="target", help="Label column")
-    dataloader_group.add_argument("--response_template", type=str, default=" %%%%%%% Response:", help="Response template prefix for DataCollatorForCompletionOnlyLM")
+    dataloader_group.add_argument("--response_template", type=str, default=" %%%%%%% Response:", help="Response template prefix, only the tokens after it are trained on")
     dataloader_group.add_argument("--add_tokens_list", nargs='+', type=str, default=None, help="List of special tokens to add to the tokenizer")
     dataloader_group.add_argument("--block_size", type=int, default=768, help="Block size for group text function")
     dataloader_group.add_argument("--do_group_texts", action="store_true", help="Do group text, great for pretraining phase")
+    dataloader_group.add_argument("--group_by_length", action="store_true", help="Batch training and perplexity eval examples of similar "
+                                                                                 "token length together to reduce padding")
+    dataloader_group.add_argument("--length_grouping_mega_batch_mult", type=int, default=50, help="Number of batches sorted by length together, "
+                                                                                                 "larger groups pad less but are less random")
+    dataloader_group.add_argument("--streaming", action="store_true", help="Stream and interleave the training files according to "
+                                                                           "each_train_file_percentage instead of loading them up front")
+    dataloader_group.add_argument("--num_worker", type=int, default=0, help="DataLoader worker processes collating the batches, "
+                                                                             "0 (default) to collate in the training process")
+    dataloader_group.add_argument("--tokenize_num_proc", type=int, default=1, help="Processes tokenizing the loaded splits")
+    dataloader_group.add_argument("--prefetch_factor", type=int, default=2, help="Batches prefetched by each DataLoader worker")
+    dataloader_group.add_argument("--no_persistent_workers", action="store_true", help="Restart the DataLoader workers every epoch")
+    dataloader_group.add_argument("--shuffle_buffer_size", type=int, default=10000, help="Shuffle buffer size of each streaming worker")
+    dataloader_group.add_argument("--do_packing", action="store_true", help="Bin pack the training examples into block_size rows, "
+                                                                            "each example keeps its own position ids and completion-only labels "
+                                                                            "and only attends to itself (block diagonal 4D attention mask), "
+                                                                            "checked on the model before training (no flash attention 2)")
     dataloader_group.add_argument("--model_max_length", type=int, default=1024, help="The model maximum length")
     dataloader_group.add_argument("--context_length", type=int, default=768, help="The model maximum context length")
     dataloader_group.add_argument("--train_file", nargs='+', type=str, default=None, help="List of training files")
     dataloader_group.add_argument("--each_train_file_percentage", nargs='+', type=int, default=None,
                                   help="The percentage weight of each train files")
+    dataloader_group.add_argument("--token_mixture", action="store_true", help="Mix the train files by token share instead of by example count, "
+                                                                               "each_train_file_percentage (the token count of each file by default) "
+                                                                               "gives the shares")
+    dataloader_group.add_argument("--mixture_temperature", type=float, default=1.0, help="Token mixture temperature, above 1 flattens the "
+                                                                                         "shares toward uniform, below 1 sharpens them")
+    dataloader_group.add_argument("--mixture_epoch_weights", nargs='+', type=str, default=None,
+                                  help="Token mixture weights of each epoch, one comma separated list per epoch (eg: 50,30,20 30,30,40), "
+                                       "the last one is kept for the next epochs")
 
     dataloader_group.add_argument("--val_file", nargs='+', type=str, default=None, help="List of validation files")
 
@@ -126,6 +150,10 @@ def parse_arguments():
     dataloader_group.add_argument("--max_eval_generative_samples", type=int, default=50, help="Max generative examplew for manual evaluation")
     dataloader_group.add_argument("--do_generative_eval", action="store_true", help="Flag to enable model.generate eval")
     dataloader_group.add_argument("--max_eval_perplexity_samples", type=int, default=50, help="Max evaluation examples for perplexity evaluation")
+    dataloader_group.add_argument("--tokenized_cache_dir", type=str, default=None, help="Directory to cache the tokenized splits in, "
+                                                                                     "a restart with the same data and settings skips loading and tokenization")
+    dataloader_group.add_argument("--cache_wait_timeout", type=int, default=4 * 3600, help="Seconds the other processes of a node wait for "
+                                                                                     "the local main process to load and cache the tokenized splits")
 
     generation_group = parser.add_argument_group("Generation Arguments")
     generation_group.add_argument("--top_k", type=int, default=50, help="Top-k value ")
@@ -159,6 +187,16 @@ def parse_arguments():
                                                                              "equal to the numbers of files in the train_file"
         assert sum(args.each_train_file_percentage) == 100, "The each_train_file_percentage arguments must be a list of int" \
                                                             "that add up to 100%"
+    if args.mixture_epoch_weights:
+        assert args.token_mixture, "mixture_epoch_weights requires token_mixture"
+        args.mixture_epoch_weights = [[float(weight) for weight in epoch_weights.split(",")]
+                                      for epoch_weights in args.mixture_epoch_weights]
+        for epoch_weights in args.mixture_epoch_weights:
+            assert len(epoch_weights) == len(args.train_file), "Each mixture_epoch_weights list must have a weight per train file"
+
+    if args.do_packing and args.use_flash_attention_2:
+        raise ValueError("Flash attention 2 ignores the 4D block attention mask of packing, the packed examples "
+                         "would attend to each other, please disable do_packing or use_flash_attention_2")
 
     if args.use_8bit and args.use_4bit:
         raise "Can't use 8bit and 4bit quantization at the same time"
@@ -236,6 +274,18 @@ if __name__=="__main__":
         "block_size": args.block_size,
         "no_preprocess_data": args.no_preprocess_data,
         "do_group_texts": args.do_group_texts,
+        "do_packing": args.do_packing,
+        "streaming": args.streaming,
+        "shuffle_buffer_size": args.shuffle_buffer_size,
+        "num_worker": args.num_worker,
+        "tokenize_num_proc": args.tokenize_num_proc,
+        "token_mixture": args.token_mixture,
+        "mixture_temperature": args.mixture_temperature,
+        "mixture_epoch_weights": args.mixture_epoch_weights,
+        "prefetch_factor": args.prefetch_factor,
+        "persistent_workers": not args.no_persistent_workers,
+        "group_by_length": args.group_by_length,
+        "length_grouping_mega_batch_mult": args.length_grouping_mega_batch_mult,
         "do_perplexity_eval": args.do_perplexity_eval,
         "do_generative_eval": args.do_generative_eval,
         "model_max_length": args.model_max_length,
@@ -243,7 +293,9 @@ if __name__=="__main__":
         "response_template": args.response_template,
         "add_tokens_list": args.add_tokens_list,
         "max_eval_generative_samples": args.max_eval_generative_samples,
-        "max_eval_perplexity_samples": args.max_eval_perplexity_samples
+        "max_eval_perplexity_samples": args.max_eval_perplexity_samples,
+        "tokenized_cache_dir": args.tokenized_cache_dir,
+        "cache_wait_timeout": args.cache_wait_timeout
     }
 
     qa_dataloader = QADataloader(**dataloader_args)